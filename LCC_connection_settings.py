@@ -54,7 +54,7 @@ BASEPATH_TEXT = """Path to images (on machine running CellProfiler, excluding "S
 class LCConnect(cpm.CPModule):
     
     ################### Name ##########################
-    variable_revision_number = 1
+    variable_revision_number = 2
     module_name = "LCConnect"
     category = "MicroscopeAutomation"
 
@@ -75,16 +75,27 @@ class LCConnect(cpm.CPModule):
                                  Basepath to images on the computer running cellprofiler. Use the path seperators for the operating system that Cellprofiler is running on.""")
 
         self.sysID = cps.Integer("Leica /sys value (typically 0)", value = 0, minval = 0, doc = """some Matrix screener CAM commands require passing in a system identifier. On most microscopes I have seen this ID is zero, but in some rare cases you may have to use a value of 1 (or something else)""")
+
+        self.use_broker = cps.Binary("Connect through CAM broker", False, doc = """Tick this to talk to the CAM server through the CAM broker
+                                     instead of connecting directly, e.g. when analysing with several worker processes. The broker owns the
+                                     connection to the CAM server, hands each image to one worker and sends the commands of the workers one
+                                     at a time. Start it before the analysis with <i>python cam_broker.py --ip address --basepath path</i>.""")
+
+        self.broker_port = cps.Integer("CAM broker port", value = cc.BROKER_PORT, minval = 1, maxval = 65535, doc = """Local port the CAM broker listens on (its --listen option).""")
         
         
     def do_connect(self):
         print "Connecting"
         CAMC.setIP(self.IP_address.value)
         CAMC.setSysID(self.sysID.value)
+        self.set_broker()
+        CAMC.resetCancel()
         CAMC.open()
 
     def do_disconnect(self):
         print "Disconnecting"
+        # stops a pending wait for the CAM server of a running pipeline, too
+        CAMC.cancel()
         CAMC.close()
 
     def do_check_status(self):
@@ -93,10 +104,25 @@ class LCConnect(cpm.CPModule):
         print "Socket is", ("disconnected","connected")[CAMC.isConnected()]
 
     def settings(self):
-        return [ self.IP_address,  self.basepath, self.sysID] 
+        return [ self.IP_address,  self.basepath, self.sysID, self.use_broker, self.broker_port] 
     
     def visible_settings(self):
-        return self.settings()
+        if self.use_broker.value:
+            return self.settings()
+        return [ self.IP_address,  self.basepath, self.sysID, self.use_broker]
+
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            # added CAM broker
+            setting_values = setting_values + [cps.NO, str(cc.BROKER_PORT)]
+            variable_revision_number = 2
+        return setting_values, variable_revision_number, from_matlab
+
+    def set_broker(self):
+        if self.use_broker.value:
+            CAMC.setBroker(('localhost', self.broker_port.value))
+        else:
+            CAMC.setBroker(None)
     
     def getCAMCommunicator(self):
         return CAMC
@@ -108,3 +134,9 @@ class LCConnect(cpm.CPModule):
         print "setting IP address ", self.IP_address.value
         CAMC.setIP(self.IP_address.value)
         CAMC.setSysID(self.sysID.value)
+        self.set_broker()
+        if not CAMC.isConnected():
+            # with several analysis workers only the one that gets the first image set is connected by
+            # LCCwaitForImage, the others connect here
+            print "Not connected, connecting to", ("CAM server", "CAM broker")[CAMC.isBrokered()]
+            CAMC.open()
@@ -62,9 +62,18 @@ import cellprofiler.cpmodule as cpm
 import cellprofiler.measurements as cpmeas
 import cellprofiler.objects as cpo
 import cellprofiler.settings as cps
+import numpy as np
+import collections
+import os
+import time
 
 from cellprofiler.modules.identify import M_LOCATION_CENTER_X, M_LOCATION_CENTER_Y
 import cam_communicator_class as cc
+from mosaic import get_current_mosaic
+from camlist_planner import TopKSelector, cluster_points, order_jobs, job_positions, job_field, JobAccumulator
+from acquisition_cost import CostModel
+from stage_calibration import legacy_affine, apply_affine, field_limits, CalibrationStore
+from checkpoint import get_current_checkpoint
 
 
 from LCC_connection_settings import CAMC
@@ -90,9 +99,41 @@ CENTER_LOCATION = "Location_X/Y (default)"
 CENTER_AREASHAPECENTER = "AreaShape_Center_X/Y (if available)"
 CENTER_BB = "Bounding Box Center (if available)"
 
+SELECT_FIRST = "First objects found (default)"
+SELECT_RANKED = "Best ranked objects"
+
+RANK_LARGEST = "Largest values"
+RANK_SMALLEST = "Smallest values"
+
+FLUSH_IMAGESET = "After each image set (default)"
+FLUSH_JOBS = "After a number of jobs"
+FLUSH_FIELDS = "After a number of image sets"
+FLUSH_WELL = "At the end of each well"
+FLUSH_TIMEPOINT = "At the end of each time point"
+FLUSH_DEADLINE = "After a time limit"
+
+TRANSFORM_FLAGS = "Flip, swap and offset (default)"
+TRANSFORM_AFFINE = "Calibrated affine transform"
+
+OUT_OF_RANGE_KEEP = "Keep (default)"
+OUT_OF_RANGE_CLIP = "Clip to the field"
+OUT_OF_RANGE_REJECT = "Reject"
+
 '''This is the measurement template category'''
 C_MEASUREMENT_TEMPLATE = "MT"
 
+'''The object measurement category for the CAM list job an object is imaged by'''
+C_CAM = "CAM"
+'''Number of the CAM list job (cluster) within the image set, 0 if the object is not imaged'''
+F_CLUSTER = "Cluster"
+'''Image measurement: number of objects (or clusters) in the image set whose job offsets lie outside the lowres field'''
+F_OUT_OF_RANGE = "OutOfRange"
+
+# the arguments of CAMcommunicator.addJobToCAMlist, jobs may carry further entries (e.g. their rank)
+CAM_JOB_ARGS = ('jobname', 'dxpos', 'dypos', 'slide', 'wellx', 'welly', 'fieldx', 'fieldy')
+# number of jobs sent that are remembered in the checkpoint, so they aren't sent again after a restart
+MAX_SENT_JOBS = 10000
+
 #########
 # Globals
 #########
@@ -112,7 +153,7 @@ class LCCimageObject(cpm.CPModule):
     module_name = "LCCimageObject"
 
     category = "MicroscopeAutomation"
-    variable_revision_number = 1
+    variable_revision_number = 10
     
     ################# GUI Settings ########################
     def create_settings(self):
@@ -190,11 +231,154 @@ class LCCimageObject(cpm.CPModule):
         self.offsetY = cps.Integer(
             "Pixel offset along Y axis",
             0, doc=doc_offset)
+
+        self.useMosaic = cps.Binary(
+            "Objects were identified on the well mosaic",
+            False, doc="""Tick this if the objects were identified on the well mosaic assembled by LCCwaitForImage. Objects are only
+            added to the CAM list once the mosaic of the well is complete, and each object is mapped back to the field it lies in
+            (the field whose centre is closest, if the object lies in the overlap of several fields).""")
+
+        self.applyDrift = cps.Binary(
+            "Correct for the estimated drift",
+            False, doc="""Tick this to shift the object coordinates by the drift that LCCwaitForImage estimated for this field
+            since its previous time point (Drift_X/Drift_Y measurements). Assuming the drift is steady, this predicts where the
+            object will be when the job is executed.""")
+
+        self.driftFactor = cps.Float(
+            "Fraction of the estimated drift to apply",
+            1.0, doc="""The drift correction is the estimated drift times this factor. Use values below 1 if the drift between time points
+            is larger than the drift until the job is executed.""")
+
+        self.useBinning = cps.Binary(
+            "Objects were identified on binned images",
+            False, doc="""Tick this if the objects were identified on the binned preview images of LCCwaitForImage. The object
+            coordinates are scaled back to full resolution with the Binning_Factor measurement.""")
+
+        self.selectionMode = cps.Choice(
+            "Which objects to image if there are more than the maximum per well ?",
+            [SELECT_FIRST, SELECT_RANKED], doc="""<ul>
+            <li>First objects found - objects are added to the CAM list as they are found, until the maximum number of objects for
+            the well is reached.
+            <li>Best ranked objects - the objects of all fields of a well are ranked by the measurement below and only the best
+            ones are added to the CAM list, once all fields of the well have been analysed (i.e. when the first field of the next
+            well arrives, after the time limit below or at the end of the run).
+            </ul>""")
+
+        self.rankMeasurement = cps.Measurement(
+            "Rank objects by",
+            lambda : self.input_object_name.value, "AreaShape_Area",
+            doc="""Measurement used to rank the objects, e.g. area, intensity or a classifier score.""")
+
+        self.rankOrder = cps.Choice(
+            "Image objects with the",
+            [RANK_LARGEST, RANK_SMALLEST], doc="""Whether the objects with the largest or the smallest values are imaged.""")
+
+        self.rankDeadline = cps.Integer(
+            "Add the best objects of a well after (seconds, 0 = when the well is complete)",
+            0, minval=0, doc="""Time after the first objects of a well were found, after which the best objects found so far are added
+            to the CAM list even if the well is not complete yet. Objects found in the well afterwards are ranked among themselves
+            and fill the places left, so no more than the maximum number of objects per well are imaged.""")
+
+        self.clusterObjects = cps.Binary(
+            "Image nearby objects with a single job",
+            False, doc="""Tick this to group objects whose centres fit into one hires field of view (size below) into clusters.
+            One CAM list job is added per cluster, centred on the cluster. The number of the job that images an object is recorded as
+            CAM_Cluster object measurement (0 if the object is not imaged). With ranked selection a cluster ranks like its best object,
+            the maximum number of objects per well then limits the number of jobs, and CAM_Cluster numbers the candidate jobs, as the
+            selection is only made once the well is complete.""")
+
+        self.hiresFieldWidth = cps.Integer(
+            "Width of the hires field of view (lowres pixels)",
+            100, minval=1, doc="""Width of the field of view of the hires job, in pixels of the images the objects were found in
+            (before binning), less a margin for the size of the objects.""")
+
+        self.hiresFieldHeight = cps.Integer(
+            "Height of the hires field of view (lowres pixels)",
+            100, minval=1, doc="""Height of the field of view of the hires job, in pixels of the images the objects were found in
+            (before binning), less a margin for the size of the objects.""")
+
+        self.orderJobs = cps.Binary(
+            "Order jobs to minimize stage travel",
+            False, doc="""Tick this to reorder the jobs that are sent to the CAM list together, so that the stage travels a short
+            path between them (nearest neighbour path improved by 2-opt). The stage positions are estimated from the well and field
+            indices and the pixel offsets, using the pitches and the pixel size below.""")
+
+        self.wellPitch = cps.Float(
+            "Distance between wells (um)",
+            9000.0, minval=0, doc="""Centre to centre distance of neighbouring wells, e.g. 9000 um for 96 well plates.""")
+
+        self.fieldPitch = cps.Float(
+            "Distance between fields (um)",
+            500.0, minval=0, doc="""Centre to centre distance of neighbouring fields within a well, as set up in Matrix Screener.""")
+
+        self.pixelSize = cps.Float(
+            "Pixel size (um)",
+            1.0, minval=0, doc="""Pixel size of the images the objects were found in (before binning).""")
+
+        self.flushPolicy = cps.Choice(
+            "When to send the jobs to the CAM server ?",
+            [FLUSH_IMAGESET, FLUSH_JOBS, FLUSH_FIELDS, FLUSH_WELL, FLUSH_TIMEPOINT, FLUSH_DEADLINE],
+            doc="""By default the CAM list is replaced by the jobs of each image set, so the microscope switches between the lowres
+            and the hires job for every field. The jobs can instead be collected over several image sets and sent together, which
+            means fewer switches at the expense of a later hires scan:<ul>
+            <li>After a number of jobs - once the number of jobs below has been collected.
+            <li>After a number of image sets - every n-th image set.
+            <li>At the end of each well - when the first image set of the next well arrives.
+            <li>At the end of each time point - when the first image set of the next time point arrives.
+            <li>After a time limit - once the first job collected has waited for the number of seconds below.
+            </ul>Jobs still collected are sent after the last image set. The existing CAM list is only deleted and the startcamjob
+            command only sent when the jobs are sent, the stopwaiting command is sent for every image set as before.""")
+
+        self.flushCount = cps.Integer(
+            "Number of jobs or image sets",
+            10, minval=1, doc="""Number of jobs or image sets after which the collected jobs are sent to the CAM server.""")
+
+        self.flushDeadline = cps.Integer(
+            "Time limit (seconds)",
+            60, minval=1, doc="""Time after which the collected jobs are sent to the CAM server. The time limit is checked whenever
+            an image set has been analysed.""")
+
+        self.timeBudget = cps.Float(
+            "Time budget per CAM list (seconds, 0 = no limit)",
+            0.0, minval=0, doc="""If the estimated duration of the jobs sent together exceeds this time, the jobs with the lowest priority
+            are dropped: with ranked selection the worst ranked objects of each well, otherwise the objects found last in each well.
+            The duration is estimated with a model of the time per job and the stage travel time (using the pitches and the pixel
+            size above), which is learned from the times at which the images of the hires job are reported.""")
+
+        self.costModelFile = cps.Text(
+            "File for the acquisition time model (optional)",
+            "", doc="""If set, the learned acquisition time model and the CAM lists it was learned from are saved to this file and
+            loaded again at the start of the next run. The file can be used to try different time budgets offline:
+            <i>python acquisition_cost.py file --budget 60 120 300 --interval 600</i>""")
+
+        self.transformMode = cps.Choice(
+            "How to map object centres to job offsets ?",
+            [TRANSFORM_FLAGS, TRANSFORM_AFFINE], doc="""<ul>
+            <li>Flip, swap and offset - the settings above.
+            <li>Calibrated affine transform - a transform fitted to reference points, which also corrects for rotation and scale
+            differences between the lowres and the hires objective. Create it with
+            <i>python stage_calibration.py file name points.csv</i>, where points.csv lists the pixel positions x, y of reference
+            points in the lowres image and the offsets dxpos, dypos that centre them in the hires image.
+            </ul>""")
+
+        self.calibrationFile = cps.Text(
+            "Calibration file",
+            "", doc="""The file written by stage_calibration.py.""")
+
+        self.calibrationName = cps.Text(
+            "Calibration name",
+            "10x-63x", doc="""Name of the transform in the calibration file, e.g. the objective pair it was measured for.""")
+
+        self.outOfRange = cps.Choice(
+            "Objects outside the lowres field after mapping",
+            [OUT_OF_RANGE_KEEP, OUT_OF_RANGE_CLIP, OUT_OF_RANGE_REJECT], doc="""What to do with objects (or clusters) whose job
+            offsets lie outside the lowres field, e.g. because the drift correction moved them across its border: keep them, move them to the
+            border of the field, or don't image them. Their number is recorded as the CAM_OutOfRange image measurement.""")
         
     #
     def settings(self):
         self.base_settings = [self.input_object_name, self.CAMJob,self.advancedOptions]
-        self.advanced_settings = [ self.stopWaitingForCAM,   self.startCAMJob, self.deleteCAMList, self.maxNrObjsPerWell, self.offsetX, self.offsetY,self.flipx, self.flipy, self.swapxy, self.centerMeasurement ]
+        self.advanced_settings = [ self.stopWaitingForCAM,   self.startCAMJob, self.deleteCAMList, self.maxNrObjsPerWell, self.offsetX, self.offsetY,self.flipx, self.flipy, self.swapxy, self.centerMeasurement, self.useMosaic, self.applyDrift, self.driftFactor, self.useBinning, self.selectionMode, self.rankMeasurement, self.rankOrder, self.rankDeadline, self.clusterObjects, self.hiresFieldWidth, self.hiresFieldHeight, self.orderJobs, self.wellPitch, self.fieldPitch, self.pixelSize, self.flushPolicy, self.flushCount, self.flushDeadline, self.timeBudget, self.costModelFile, self.transformMode, self.calibrationFile, self.calibrationName, self.outOfRange ]
         return  self.base_settings+self.advanced_settings
 
     def visible_settings(self):
@@ -202,11 +386,235 @@ class LCCimageObject(cpm.CPModule):
         if self.advancedOptions.value is False:
             return self.base_settings
         else:
-            return self.base_settings+self.advanced_settings
+            visible = [s for s in self.advanced_settings if s not in (self.rankMeasurement, self.rankOrder, self.rankDeadline,
+                                                                      self.hiresFieldWidth, self.hiresFieldHeight,
+                                                                      self.wellPitch, self.fieldPitch, self.pixelSize,
+                                                                      self.flushCount, self.flushDeadline,
+                                                                      self.calibrationFile, self.calibrationName)]
+            if self.selectionMode.value == SELECT_RANKED:
+                visible.insert(visible.index(self.selectionMode) + 1, self.rankDeadline)
+                visible.insert(visible.index(self.selectionMode) + 1, self.rankOrder)
+                visible.insert(visible.index(self.selectionMode) + 1, self.rankMeasurement)
+            if self.clusterObjects.value:
+                visible.insert(visible.index(self.clusterObjects) + 1, self.hiresFieldHeight)
+                visible.insert(visible.index(self.clusterObjects) + 1, self.hiresFieldWidth)
+            if self.orderJobs.value or self.timeBudget.value > 0:
+                visible.insert(visible.index(self.orderJobs) + 1, self.pixelSize)
+                visible.insert(visible.index(self.orderJobs) + 1, self.fieldPitch)
+                visible.insert(visible.index(self.orderJobs) + 1, self.wellPitch)
+            if self.flushPolicy.value in (FLUSH_JOBS, FLUSH_FIELDS):
+                visible.append(self.flushCount)
+            elif self.flushPolicy.value == FLUSH_DEADLINE:
+                visible.append(self.flushDeadline)
+            if self.transformMode.value == TRANSFORM_AFFINE:
+                visible = [s for s in visible if s not in (self.flipx, self.flipy, self.swapxy, self.offsetX, self.offsetY)]
+                visible.insert(visible.index(self.transformMode) + 1, self.calibrationName)
+                visible.insert(visible.index(self.transformMode) + 1, self.calibrationFile)
+            return self.base_settings+visible
+
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            # added mapping of objects on the well mosaic
+            setting_values = setting_values + [cps.NO]
+            variable_revision_number = 2
+        if variable_revision_number == 2:
+            # added drift correction
+            setting_values = setting_values + [cps.NO, "1.0"]
+            variable_revision_number = 3
+        if variable_revision_number == 3:
+            # added scaling of coordinates found on binned images
+            setting_values = setting_values + [cps.NO]
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            # added ranked selection of objects per well
+            setting_values = setting_values + [SELECT_FIRST, "AreaShape_Area", RANK_LARGEST, "0"]
+            variable_revision_number = 5
+        if variable_revision_number == 5:
+            # added clustering of nearby objects
+            setting_values = setting_values + [cps.NO, "100", "100"]
+            variable_revision_number = 6
+        if variable_revision_number == 6:
+            # added ordering of jobs
+            setting_values = setting_values + [cps.NO, "9000.0", "500.0", "1.0"]
+            variable_revision_number = 7
+        if variable_revision_number == 7:
+            # added collecting jobs over several image sets
+            setting_values = setting_values + [FLUSH_IMAGESET, "10", "60"]
+            variable_revision_number = 8
+        if variable_revision_number == 8:
+            # added time budget per CAM list
+            setting_values = setting_values + ["0.0", ""]
+            variable_revision_number = 9
+        if variable_revision_number == 9:
+            # added calibrated affine transform
+            setting_values = setting_values + [TRANSFORM_FLAGS, "", "10x-63x", OUT_OF_RANGE_KEEP]
+            variable_revision_number = 10
+        return setting_values, variable_revision_number, from_matlab
     
     def prepare_run(self, pipeline, image_set_list, frame):
         self.nr_objs_in_well = {}
+        self.selector = TopKSelector(self.maxNrObjsPerWell.value, self.rankOrder.value == RANK_LARGEST)
+        policy = self.flushPolicy.value
+        self.accumulator = JobAccumulator(max_jobs=self.flushCount.value if policy == FLUSH_JOBS else 0,
+                                          max_fields=1 if policy == FLUSH_IMAGESET else (self.flushCount.value if policy == FLUSH_FIELDS else 0),
+                                          max_age=self.flushDeadline.value if policy == FLUSH_DEADLINE else 0)
+        self.cost_model = CostModel()
+        if self.costModelFile.value != "" and os.path.exists(self.costModelFile.value):
+            try:
+                self.cost_model = CostModel.load(self.costModelFile.value)
+            except (IOError, ValueError), e:
+                print "Could not load acquisition time model from", self.costModelFile.value, e
+        self.last_round = None # (time of startcamscan, jobs sent) of the last CAM list
+        self.lowres_job = None # job number of the analysed images, their images are not matched to CAM list jobs
+        self.cost_warning_shown = False
+        self.calibration = None
+        if self.transformMode.value == TRANSFORM_AFFINE:
+            try:
+                self.calibration = CalibrationStore(self.calibrationFile.value).get(self.calibrationName.value)
+            except (IOError, ValueError), e:
+                print "Could not read calibration file", self.calibrationFile.value, e
+                return False
+            if self.calibration is None:
+                print "No calibration", self.calibrationName.value, "in", self.calibrationFile.value
+                return False
+        # signatures of the jobs sent, used as an ordered set
+        self.sent_jobs = collections.OrderedDict()
+        self.checkpoint = get_current_checkpoint()
+        if self.checkpoint is not None:
+            state = self.checkpoint.get(self.checkpoint_section())
+            if state is not None:
+                print "Resuming", self.checkpoint_section(), "from checkpoint"
+                self.restore_state(state)
         return True
+
+    def checkpoint_section(self):
+        return " ".join((self.module_name, self.input_object_name.value, self.CAMJob.value))
+
+    def save_state(self):
+        """puts the object counts, the ranked candidates and the jobs sent or held back into the checkpoint"""
+        if self.checkpoint is None:
+            return
+        self.checkpoint.set(self.checkpoint_section(), dict(nr_objs_in_well=self.nr_objs_in_well,
+                                                            selector=self.selector.state(),
+                                                            accumulator=self.accumulator.state(),
+                                                            sent_jobs=self.sent_jobs.keys()))
+
+    def restore_state(self, state):
+        self.nr_objs_in_well = dict(state['nr_objs_in_well'])
+        self.selector.restore(state['selector'])
+        self.accumulator.restore(state['accumulator'])
+        for signature in state['sent_jobs']:
+            self.sent_jobs[tuple(signature)] = True
+
+    def job_signature(self, job):
+        # the time point tells apart jobs for objects that didn't move
+        return tuple(str(job[key]) for key in CAM_JOB_ARGS) + (str(job.get('timepoint')),)
+
+    def pixel_transform(self, nx, ny):
+        """the transform from pixel positions to job offsets, see stage_calibration"""
+        if self.calibration is not None:
+            return self.calibration
+        return legacy_affine(nx, ny, self.flipx.value, self.flipy.value, self.swapxy.value, self.offsetX.value, self.offsetY.value)
+
+    def ranked_selection(self):
+        return self.selectionMode.value == SELECT_RANKED and self.maxNrObjsPerWell.value > 0
+
+    def submit_ranked(self, current_well=None):
+        """returns the jobs for the best objects of all wells other than current_well, and of wells whose time limit has passed"""
+        jobs = []
+        for well in self.selector.keys():
+            if well == current_well and (self.rankDeadline.value == 0 or self.selector.age(well) < self.rankDeadline.value):
+                continue
+            # the current well can still get objects after its deadline, they only fill the remaining places
+            well_jobs = self.selector.pop(well, done=(well != current_well))
+            if len(well_jobs) == 0:
+                continue
+            for rank, job in enumerate(well_jobs):
+                job['rank'] = rank
+            print "Adding the", len(well_jobs), "best objects of", well, "to the CAM list"
+            jobs += well_jobs
+        return jobs
+
+    def positions(self, jobs):
+        return job_positions(jobs, self.wellPitch.value, self.fieldPitch.value, self.pixelSize.value)
+
+    def send_jobs(self, jobs):
+        """adds jobs to the CAM list, ordered for short stage travel and capped to the time budget if selected.
+        Returns the jobs sent."""
+        if self.orderJobs.value and len(jobs) > 2:
+            jobs = order_jobs(jobs, self.wellPitch.value, self.fieldPitch.value, self.pixelSize.value)
+        if self.timeBudget.value > 0 and len(jobs) > 0:
+            keep = self.cost_model.cap(self.positions(jobs), [job.get('rank', 0) for job in jobs], self.timeBudget.value)
+            if len(keep) < len(jobs):
+                print "Dropping", len(jobs) - len(keep), "of", len(jobs), "jobs to stay within the time budget of", self.timeBudget.value, "seconds"
+            jobs = [jobs[k] for k in keep]
+        if self.checkpoint is not None:
+            # after a restart, the field that was being analysed is analysed again
+            nr_of_jobs = len(jobs)
+            jobs = [job for job in jobs if self.job_signature(job) not in self.sent_jobs]
+            if len(jobs) < nr_of_jobs:
+                print "Not sending", nr_of_jobs - len(jobs), "jobs that were sent before the restart"
+            for job in jobs:
+                self.sent_jobs[self.job_signature(job)] = True
+            while len(self.sent_jobs) > MAX_SENT_JOBS:
+                self.sent_jobs.popitem(last=False)
+        for job in jobs:
+            CAMC.addJobToCAMlist(**dict((key, job[key]) for key in CAM_JOB_ARGS))
+        return jobs
+
+    def learn_costs(self):
+        """updates the acquisition time model with the images reported for the last CAM list"""
+        if self.last_round is None:
+            return
+        start, jobs = self.last_round
+        self.last_round = None
+        arrivals = CAMC.getImageArrivals(since=start, jobname=self.CAMJob.value)
+        if len(arrivals) < len(jobs):
+            # the notifications may not carry the job name, match the images by the fields of the jobs instead
+            arrivals = CAMC.getImageArrivals(since=start, excludeJobnr=self.lowres_job, fields=[job_field(job) for job in jobs])
+        if len(arrivals) < len(jobs):
+            print "Only", len(arrivals), "images reported for", len(jobs), "jobs, not updating the acquisition time model"
+            if len(arrivals) == 0 and not self.cost_warning_shown:
+                print "WARNING: no images were reported for the jobs of the CAM list, the acquisition time model is not learned and"
+                print "the time budget is based on the default estimates (%.1f s per job)" % self.cost_model.job_time
+                self.cost_warning_shown = True
+            return
+        self.cost_model.observe(start, self.positions(jobs), [job.get('rank', 0) for job in jobs], arrivals)
+        print "Acquisition time model: %.1f s per job, %.5f s per um, %.1f s per CAM list" % (
+            self.cost_model.job_time, self.cost_model.move_time, self.cost_model.overhead)
+        if self.costModelFile.value != "":
+            try:
+                self.cost_model.save(self.costModelFile.value)
+            except (IOError, OSError), e:
+                print "Could not save acquisition time model to", self.costModelFile.value, e
+
+    def flush_group(self, measurements):
+        """the group of the current image set for the end of well / end of time point policies, None otherwise"""
+        if self.flushPolicy.value == FLUSH_WELL:
+            return tuple(str(measurements.get_current_image_measurement(feature))
+                         for feature in ("Metadata_T", "Metadata_Slide", "Metadata_ChamberU", "Metadata_ChamberV"))
+        if self.flushPolicy.value == FLUSH_TIMEPOINT:
+            return str(measurements.get_current_image_measurement("Metadata_T"))
+        return None
+
+    def flush_jobs(self, jobs):
+        """replaces the CAM list by jobs (if selected) and starts the CAM scan (if selected)"""
+        # the previous CAM list has been imaged by now
+        self.learn_costs()
+        # through a CAM broker, the commands of other workers must not end up in between
+        CAMC.beginCommands()
+        # delete existing CAM list even when there are no objects found, otherwise
+        # we end up imaging the "old" cam list again.
+        if self.deleteCAMList.value:
+            CAMC.deleteCAMList()
+        jobs = self.send_jobs(jobs)
+        if self.startCAMJob.value in (CHOICE_STARTCAMJOB_DEFAULT):
+            start = time.time()
+            CAMC.startCAMScan()
+            if len(jobs) > 0:
+                self.last_round = (start, jobs)
+        CAMC.endCommands()
+
     # Main
     def run(self, workspace):
         global CAMC
@@ -248,11 +656,42 @@ class LCCimageObject(cpm.CPModule):
         # x and y will be arrays if there are multiple objects.
         # if no object is present they will be empty lists.
 
-        # delete existing CAM list even when there are no objects found, otherwise
-        # we end up imaging the "old" cam list again.
-        if self.deleteCAMList.value:
-            CAMC.deleteCAMList()
-        
+        mosaic = None
+        if self.useMosaic.value:
+            mosaic = get_current_mosaic()
+            if mosaic is None or not mosaic.isComplete():
+                # objects on a partial mosaic will be found again on the complete one
+                print "Well mosaic not complete yet, not adding objects to CAM list"
+                xcentres, ycentres = [], []
+
+        binning = 1
+        if self.useBinning.value:
+            try: # only available if LCCwaitForImage creates binned images
+                binning = int(measurements.get_current_image_measurement("Binning_Factor"))
+            except:
+                print "No Binning_Factor measurement, enable binned images in LCCwaitForImage"
+
+        drift_x, drift_y = 0.0, 0.0
+        if self.applyDrift.value:
+            try: # only available if LCCwaitForImage estimates the drift
+                drift_x = self.driftFactor.value * float(measurements.get_current_image_measurement("Drift_X"))
+                drift_y = self.driftFactor.value * float(measurements.get_current_image_measurement("Drift_Y"))
+                print "Correcting for drift x:", drift_x, "y:", drift_y
+            except:
+                print "No drift measurements, enable drift estimation in LCCwaitForImage"
+
+        ranked = self.ranked_selection()
+        candidates = [] # (object indices, CAM list job) for ranked selection
+        imaged = [] # object indices of each job added to the CAM list
+        pending = [] # jobs to be added to the CAM list, see send_jobs()
+        nr_out_of_range = 0
+        if ranked or len(xcentres) > 0:
+            # unique string index from time point, well coordinates and object name
+            time_well_index = ",".join((str(measurements.get_current_image_measurement("Metadata_T")),
+                                        str(measurements.get_current_image_measurement("Metadata_ChamberU")),
+                                        str(measurements.get_current_image_measurement("Metadata_ChamberV")),
+                                        self.input_object_name.value))
+
         if len(xcentres)==0:
             print "No object found in current image."
             # TODO how to handle this
@@ -277,39 +716,91 @@ class LCCimageObject(cpm.CPModule):
             #print "Offset x: ", self.offsetX.value
             #print "Offset y: ", self.offsetY.value
                 
-            for x,y in zip(xcentres, ycentres): 
+            PosX = str(measurements.get_current_image_measurement("Metadata_PosX"))
+            PosY = str(measurements.get_current_image_measurement("Metadata_PosY"))
+
+            # object centres in the coordinates of the field they lie in: (object index, field x, field y, x, y)
+            points = []
+            for i, (x,y) in enumerate(zip(xcentres, ycentres)): 
                 # print some debugging info to the console:
                
                 print "Object centre X coordinate :",  x
                 print "Object centre Y coordinate :",  y
 
-                if self.flipx.value:
-                    x=(nx-1)-x
-                if self.flipy.value:
-                    y=(ny-1)-y
-
-                if self.swapxy.value:
-                    x,y = y,x # isn't python great ! we can swap variables without a temporary variable ! 
+                if binning > 1:
+                    # centre of the binned pixel in full resolution coordinates
+                    x = (x + 0.5) * binning - 0.5
+                    y = (y + 0.5) * binning - 0.5
+
+                field_pos = None
+                if mosaic is not None:
+                    # mosaic coordinates -> field and coordinates within the field
+                    field_pos = mosaic.fieldAt(x, y)
+                    if field_pos is None:
+                        print "Object is not covered by any field of the mosaic"
+                        continue
+                    x, y = field_pos[2], field_pos[3]
+
+                # before flipping, the drift is in image coordinates
+                x = x + drift_x
+                y = y + drift_y
+
+                if field_pos is not None:
+                    points.append((i, str(field_pos[0]), str(field_pos[1]), x, y))
+                else:
+                    points.append((i, PosX, PosY, x, y))
+
+            # the objects (or clusters of objects) to image: (object indices, field x, field y, x, y)
+            if self.clusterObjects.value:
+                targets = []
+                fields = {}
+                for i, fieldx, fieldy, x, y in points:
+                    fields.setdefault((fieldx, fieldy), []).append((i, x, y))
+                for (fieldx, fieldy), field_points in sorted(fields.items()):
+                    labels, centres = cluster_points([p[1] for p in field_points], [p[2] for p in field_points],
+                                                     self.hiresFieldWidth.value, self.hiresFieldHeight.value)
+                    for label, (x, y) in enumerate(centres):
+                        members = [field_points[k][0] for k in range(len(field_points)) if labels[k] == label]
+                        targets.append((members, fieldx, fieldy, x, y))
+                print len(points), "objects in", len(targets), "clusters"
+            else:
+                targets = [([i], fieldx, fieldy, x, y) for i, fieldx, fieldy, x, y in points]
+
+            # job offsets of all targets at once
+            matrix = self.pixel_transform(nx, ny)
+            dx, dy = apply_affine(matrix, [t[3] for t in targets], [t[4] for t in targets])
+            (umin, umax), (vmin, vmax) = field_limits(matrix, nx, ny)
+            outside = (dx < umin) | (dx > umax) | (dy < vmin) | (dy > vmax)
+            nr_out_of_range = int(outside.sum())
+            if nr_out_of_range > 0:
+                print nr_out_of_range, "of", len(targets), "job offsets outside the lowres field:", self.outOfRange.value
+                if self.outOfRange.value == OUT_OF_RANGE_CLIP:
+                    np.clip(dx, umin, umax, out=dx)
+                    np.clip(dy, vmin, vmax, out=dy)
+
+            for k, (members, PosX, PosY, x, y) in enumerate(targets):
+                if outside[k] and self.outOfRange.value == OUT_OF_RANGE_REJECT:
+                    continue
 
                 U = str(measurements.get_current_image_measurement("Metadata_ChamberU"))
                 V = str(measurements.get_current_image_measurement("Metadata_ChamberV"))
-                PosX = str(measurements.get_current_image_measurement("Metadata_PosX"))
-                PosY = str(measurements.get_current_image_measurement("Metadata_PosY"))
                 Slide = str(measurements.get_current_image_measurement("Metadata_Slide"))
                 TimePoint = str(measurements.get_current_image_measurement("Metadata_T"))
 
-                # TODO make sure the coordinates are still within range after adding offset, either by clipping
-                # the values or sending an error message
+                dxpos = `int(round(dx[k]))` # might have to use nx-1, ny-1
+                dypos = `int(round(dy[k]))` # depending on whether Leica starts counting at 1 or 0 
 
-                dxpos =  `int(round(float(x)-(float(nx))/2.0)+self.offsetX.value)` # might have to use nx-1, ny-1
-                dypos = `int(round(float(y)-(float(ny))/2.0)+self.offsetY.value)` # depending on whether Leica starts counting at 1 or 0 
+                job = dict(jobname=self.CAMJob.value, dxpos=dxpos, dypos=dypos, slide=`int(Slide)+1`, wellx= `int(U)+1`, welly= `int(V)+1`, fieldx=`int(PosX)+1`, fieldy=`int(PosY)+1`, timepoint=TimePoint)
+                if ranked:
+                    # selected once the well is complete, see submit_ranked()
+                    candidates.append((members, job))
+                    continue
 
                 # Increase counter for this type of object in this well.
                 # This feature can be used to limit the number of CAM jobs 
                 # to be called for a particular type of object in each well.
                 # To keep track of the count we create a unique string index from 
                 # object name and well coordinates. 
-                time_well_index =   ",".join((TimePoint, U, V, self.input_object_name.value))
                 if time_well_index in self.nr_objs_in_well.keys():
                     self.nr_objs_in_well[time_well_index] +=1
                 else: 
@@ -317,16 +808,52 @@ class LCCimageObject(cpm.CPModule):
                 print time_well_index, " count is ", self.nr_objs_in_well[time_well_index]
 
                 if self.maxNrObjsPerWell.value==-1 or self.nr_objs_in_well[time_well_index] <= self.maxNrObjsPerWell.value:
-                    CAMC.addJobToCAMlist(jobname=self.CAMJob.value, dxpos=dxpos, dypos=dypos, slide=`int(Slide)+1`, wellx= `int(U)+1`, welly= `int(V)+1`, fieldx=`int(PosX)+1`, fieldy=`int(PosY)+1` )
+                    job['rank'] = self.nr_objs_in_well[time_well_index] - 1
+                    pending.append(job)
+                    imaged.append(members)
                 else:
                     print "Max nr of objects to image for this well reached. Not adding to CAM list"
-                    
-        if self.startCAMJob.value in (CHOICE_STARTCAMJOB_DEFAULT):
-            CAMC.startCAMScan()
+
+        if ranked:
+            if len(candidates) > 0:
+                scores = np.asarray(measurements.get_current_measurement(self.input_object_name.value, self.rankMeasurement.value), np.float64)
+                # a cluster ranks like its best object
+                if self.rankOrder.value == RANK_LARGEST:
+                    candidate_scores = [np.max(scores[members]) for members, job in candidates]
+                else:
+                    candidate_scores = [np.min(scores[members]) for members, job in candidates]
+                self.selector.addField(time_well_index, candidate_scores, [job for members, job in candidates])
+                # whether they are imaged is only known once the well is complete
+                imaged = [members for members, job in candidates]
+            pending += self.submit_ranked(time_well_index)
+
+        try: # only available with LCCwaitForImage
+            self.lowres_job = int(measurements.get_current_image_measurement("Metadata_Job"))
+        except:
+            pass
+        due = self.accumulator.add(pending, self.flush_group(measurements))
+        if due is None:
+            print len(self.accumulator), "jobs collected, not sending them to the CAM server yet"
+        elif len(due) > 0 or self.flushPolicy.value == FLUSH_IMAGESET:
+            self.flush_jobs(due)
+
+        if self.clusterObjects.value:
+            clusters = np.zeros(len(xcentres), int)
+            for job_nr, members in enumerate(imaged):
+                clusters[members] = job_nr + 1
+            measurements.add_measurement(self.input_object_name.value, "_".join((C_CAM, F_CLUSTER)), clusters)
+        measurements.add_measurement("Image", "_".join((C_CAM, F_OUT_OF_RANGE)), np.array(nr_out_of_range), can_overwrite=True)
+        self.save_state()
 
         if self.stopWaitingForCAM.value in (CHOICE_STOPWAITING_DEFAULT):
             CAMC.stopWaitingForCAM()
 
+    def get_measurement_columns(self, pipeline):
+        columns = [("Image", "_".join((C_CAM, F_OUT_OF_RANGE)), cpmeas.COLTYPE_INTEGER)]
+        if self.clusterObjects.value:
+            columns.append((self.input_object_name.value, "_".join((C_CAM, F_CLUSTER)), cpmeas.COLTYPE_INTEGER))
+        return columns
+
     def is_interactive(self):
         return False
     
@@ -339,13 +866,24 @@ class LCCimageObject(cpm.CPModule):
             return
 
         global CAMC
-        if CAMC is None or not CAMC.isConnected():
+        if CAMC is None:
+            return
+        if not CAMC.isConnected():
             print "No Connection to CAM Server. Connecting"    
-        else:
-             CAMC.close()
+            CAMC.open()
+
+        # the jobs still collected and the best objects of the last well(s)
+        jobs = self.accumulator.flush()
+        if self.ranked_selection():
+            jobs += self.submit_ranked()
+        if len(jobs) > 0:
+            self.flush_jobs(jobs)
+        if self.checkpoint is not None:
+            self.save_state()
+            self.checkpoint.save(force=True)
 
         # send Post-Run commands if selected:
         if self.startCAMJob.value in (CHOICE_STARTCAMJOB_POSTRUN):
             CAMC.startCAMScan()
         if self.stopWaitingForCAM.value in (CHOICE_STOPWAITING_POSTRUN):
-            CANC.stopWaitingForCAM()
+            CAMC.stopWaitingForCAM()
@@ -45,6 +45,8 @@ The images are provided to the CP pipeline. You can read in several input images
 
 #TODO:
 # * the current loop is structure is not very nice. Unless the number of images is known exactly in advance, the   post_run() functions won't be called for any module. This means that data can't be exported to CSV.
+#   As a workaround the end of the experiment is detected (scan finished and/or idle timeout) and the remaining
+#   preallocated image sets are skipped, so the run finishes and post_run() is called.
 
 
 
@@ -54,30 +56,24 @@ import numpy as np
 import os.path
 import os.path
 import sys
+import time
 import pdb  
 
 import cellprofiler.measurements as cpmeas
-from cellprofiler.modules.loadimages import load_using_bioformats 
 import cam_communicator_class as cc
+from image_readers import load_plane, wait_for_file, preload_bioformats, BioformatsReaderPool
+from field_index import FieldIndex, fieldKey, fieldTimepoint
+from folder_replay import FolderReplay
+from mosaic import WellMosaic, set_current_mosaic, get_current_mosaic
+from image_registration import DriftEstimator, downsample
+from illumination import RunningFlatField
+from checkpoint import Checkpoint, checkpoint_filename, set_current_checkpoint, ProcessedFields
+from stack_projection import StackProjector, PROJ_MEAN, PROJ_MAX, PROJ_MIN, PROJ_SUM, PROJ_STD
+from stack_projection import BestFocusSelector, FOCUS_NORMALIZED_VARIANCE, FOCUS_LAPLACIAN, FOCUS_BRENNER
 
 from LCC_connection_settings import CAMC
 
 import re
-try:
-    import bioformats.formatreader as formatreader
-    import bioformats.metadatatools as metadatatools
-    formatreader.jutil.attach()
-    try:
-        FormatTools = formatreader.make_format_tools_class()
-        ImageReader = formatreader.make_image_reader_class()
-        ChannelSeparator = formatreader.make_reader_wrapper_class(
-            "loci/formats/ChannelSeparator")
-        has_bioformats = True
-    finally:
-        formatreader.jutil.detach()
-except:
-    traceback.print_exc()
-    has_bioformats = False
 
 
 #### CP imports  #############################
@@ -87,7 +83,9 @@ import cellprofiler.cpimage as cpi
 import cellprofiler.cpmodule as cpm
 import cellprofiler.measurements as cpmeas
 import cellprofiler.objects as cpo
+import cellprofiler.pipeline as cpp
 import cellprofiler.settings as cps
+import cellprofiler.workspace as cpw
 
 
 #### Constants ##############################
@@ -104,13 +102,86 @@ MIC_DONOTHING = "Do nothing"
 STACK_NONE = "None"
 STACK_MEAN = "Mean projection"
 STACK_MAX  = "Max projection"
+STACK_MIN  = "Min projection"
+STACK_SUM  = "Sum projection"
+STACK_STD  = "Standard deviation projection"
 STACK_BEST_FOCUS = "Best focused slice"
 
+# maps the stack handling choices to the projections of the streaming projector
+STACK_PROJECTIONS = {STACK_MEAN: PROJ_MEAN,
+                     STACK_MAX: PROJ_MAX,
+                     STACK_MIN: PROJ_MIN,
+                     STACK_SUM: PROJ_SUM,
+                     STACK_STD: PROJ_STD}
+
+FOCUS_METRIC_NORMVAR = "Normalized variance"
+FOCUS_METRIC_LAPLACIAN = "Laplacian energy"
+FOCUS_METRIC_BRENNER = "Brenner gradient"
+FOCUS_METRICS = {FOCUS_METRIC_NORMVAR: FOCUS_NORMALIZED_VARIANCE,
+                 FOCUS_METRIC_LAPLACIAN: FOCUS_LAPLACIAN,
+                 FOCUS_METRIC_BRENNER: FOCUS_BRENNER}
+
+BINNING_NONE = "No binned images"
+BINNING_2 = "2x2"
+BINNING_4 = "4x4"
+BINNING_8 = "8x8"
+BINNING_FACTORS = {BINNING_NONE: 1, BINNING_2: 2, BINNING_4: 4, BINNING_8: 8}
+
+SOURCE_CAM = "CAM server notifications"
+SOURCE_FOLDER = "Replay export folder"
+
+
+READER_NATIVE = "Native TIFF reader (fallback to bioformats)"
+READER_BIOFORMATS = "Bioformats"
+
+OUTPUT_SCALED = "Floating point, scaled to 0-1"
+OUTPUT_FLOAT32 = "float32, scaled to 0-1"
+OUTPUT_NATIVE = "Acquired data type, unscaled"
+
+ACC_FLOAT32 = "float32"
+ACC_FLOAT64 = "float64"
+ACC_DTYPES = {ACC_FLOAT32: np.float32,
+              ACC_FLOAT64: np.float64}
+
 # these are copied from loadimages
 '''The FileName measurement category'''
 C_FILE_NAME = "FileName"
 '''The PathName measurement category'''
 C_PATH_NAME = "PathName"
+'''The Scaling measurement category, maximum intensity of the acquired data type'''
+C_SCALING = "Scaling"
+'''The measurement category for the best focused slice'''
+C_FOCUS = "Focus"
+F_BEST_Z = "BestZ"
+F_SCORE = "Score"
+'''The measurement category for the time (in seconds) spent in the stages of run().
+With the native reader pixel data is memory-mapped and only transferred when it is first used,
+so for Z stacks most of the I/O time shows up as projection time'''
+C_TIMING = "Timing"
+F_WAIT_NOTIFICATION = "WaitNotification"
+F_WAIT_FILE_READY = "WaitFileReady"
+F_READ = "Read"
+F_PROJECTION = "Projection"
+'''The measurement category for the number of bytes of pixel data read per image'''
+C_BYTES_READ = "BytesRead"
+'''The measurement category for the well mosaic'''
+C_MOSAIC = "Mosaic"
+F_COMPLETE = "Complete"
+F_ORIGIN_X = "FieldOriginX"
+F_ORIGIN_Y = "FieldOriginY"
+F_SHIFT_X = "ShiftX"
+F_SHIFT_Y = "ShiftY"
+'''The measurement category for the drift of a field since its previous time point, in pixels'''
+C_DRIFT = "Drift"
+F_DRIFT_X = "X"
+F_DRIFT_Y = "Y"
+F_DRIFT_PEAK = "Peak"
+'''The measurement category for the binning of the binned preview images'''
+C_BINNING = "Binning"
+F_FACTOR = "Factor"
+'''The measurement category for the running flat-field correction, number of fields the model is based on (0 if uncorrected)'''
+C_FLATFIELD = "FlatField"
+F_NR_OF_IMAGES = "NrOfImages"
 
 IP_ADDRESS_TEXT = "IP Address of CAM server"
 BASEPATH_TEXT = """Path to images (on local machine, excluding "Subfolder")"""
@@ -122,7 +193,86 @@ doc_channel = """which channel - warning - there's no check on the actual channe
 
 doc_nrimages =  """Because Cellprofiler is originally designed as a batch processing application that works on image files, it first creates a python list structure with as many elements as the image sets to be batch processed. When images come from the microscope, Cellprofiler cannot know how many images to expect and when to terminate. With this parameter you can tell CellProfiler after how many image sets to stop processing and call post_run() events such as ExportToSpreadsheet. If you want to run indefintely, put in a very large number here but be aware that you will have to terminate manually. """
 
-doc_stack =  """Choose a method for handling Z-Stacks. None - read single image reported by CAM. Mean/Max Projection - check for filename variations with different Z - then read all slices while performing a mean or maximum projection."""
+doc_stack =  """Choose a method for handling Z-Stacks. None - read single image reported by CAM. Mean/Max/Min/Sum/Standard deviation Projection - check for filename variations with different Z - then read all slices while performing the projection on the fly. Slices are streamed, i.e. the full stack is never held in memory. Best focused slice - score all slices with a focus metric and only keep the sharpest one. The selected Z index and its score are recorded as Focus_BestZ_[image name] and Focus_Score_[image name] measurements."""
+
+doc_focus = """Focus metric used to pick the best focused slice. Normalized variance (variance divided by mean) is robust and works for most fluorescence images. Laplacian energy and Brenner gradient respond to fine detail and are more selective for thin, high-contrast structures. Each channel is scored independently."""
+
+doc_accumulation = """Data type used for accumulating Z projections. float32 (default) halves the memory needed compared to float64 and is precise enough for most purposes. Use float64 for very deep stacks or if you need maximum precision for sum or standard deviation projections."""
+
+doc_reader = """Choose how image files are read. The native TIFF reader memory-maps the uncompressed single-plane .ome.tif files written by Matrix Screener directly, without going through bioformats and the Java virtual machine, which is considerably faster. Files the native reader can't handle (e.g. compressed or multi-plane files) are automatically read with bioformats. Choose Bioformats to always use bioformats."""
+
+doc_scanfinished = """End the run when the CAM server reports that the scan has finished (inf:scanfinished). The remaining image sets are skipped without waiting for images, so the run finishes and post-run modules such as ExportToSpreadsheet are executed. Skipped image sets still take a moment each and appear in exports without measurements, so don't choose the number of image sets much larger than needed."""
+
+doc_idletimeout = """End the run if no image was received for this many seconds, like at the end of the scan (see above). Use 0 to wait indefinitely."""
+
+doc_output_dtype = """Data type of the output images. <ul>
+<li>Floating point, scaled to 0-1 - the classic CellProfiler representation. Single planes are float64, projections use the accumulation data type.
+<li>float32, scaled to 0-1 - half the memory of float64 and precise enough for most analyses.
+<li>Acquired data type, unscaled - keep the integer data type of the acquired images (e.g. uint8/uint16; mean, sum and standard deviation projections are float). This needs the least memory, but downstream modules have to be able to handle unscaled images.
+</ul>
+In all cases the maximum intensity of the acquired data type is recorded as Scaling_[image name] measurement."""
+
+doc_collect = """The CAM server notifies us about the images of all jobs. Images of the job of interest are analysed by this pipeline, images of all other jobs (e.g. hires images triggered by LCCimageObject) are kept in per-job queues. Tick this option to hand them to a collector, which appends their arrival time, job, job name and file name to a list file."""
+
+doc_collector_file = """Name of the file listing the collected images of other jobs. Relative file names are relative to the image base path set in LCConnect."""
+
+doc_complete_fields = """By default the announced image is assumed to be the last Z slice of the field, and the file names of the other slices and channels are derived from it and read right away, whether they have been acquired or not. Tick this option to keep track of all announced planes instead: a field is only handed to the pipeline once all Z slices of all active channels have been announced (or the timeout below has expired), and only announced planes are read. This requires the CAM server to notify about every plane."""
+
+doc_nr_of_slices = """Number of Z slices per field. Use 1 if you don't acquire Z stacks."""
+
+doc_field_timeout = """Seconds after the first plane of a field was announced, after which the field is handed to the pipeline even if not all planes have been announced."""
+
+doc_image_source = """Where the images come from. <ul>
+<li>CAM server notifications - wait for the CAM server to announce newly acquired images (online feedback microscopy).
+<li>Replay export folder - re-analyse a finished screen: the image base path set in LCConnect is scanned once, the planes are grouped into fields and the fields are fed to the pipeline in acquisition order (by file time). No CAM server is needed, commands that downstream modules (e.g. LCCimageObject) send to the microscope are written to a file instead.
+</ul>"""
+
+doc_prefetch = """Number of fields whose files are read ahead in the background while the current field is analysed. This hides the latency of network shares. Use 0 to disable prefetching."""
+
+doc_replay_cmdfile = """When replaying an export folder, CAM commands are appended to this file instead of being sent to the microscope. Relative file names are relative to the image base path set in LCConnect."""
+
+doc_mosaic = """Stitch the fields of each well into a mosaic as they arrive, so that objects on field borders are not cut. The first channel of every field is placed on a canvas (a memory-mapped temporary file) according to its X/Y field index and the overlap below. The mosaic is added to every image set, it is partial until the last field of the well has arrived (see the Mosaic_Complete measurement). LCCimageObject can map objects found on the complete mosaic back to the field they lie in."""
+
+doc_mosaic_fields = """Number of fields per well along this axis."""
+
+doc_mosaic_overlap = """Overlap between neighbouring fields, in percent of the field size, as set up in Matrix Screener."""
+
+doc_mosaic_refine = """Refine the position of each field by registering its overlap with an already placed neighbour (phase correlation). Use this if the stage positioning is not precise enough for stitching with the nominal overlap."""
+
+doc_mosaic_max_shift = """Largest correction (in pixels) that refinement may apply. Larger shifts are considered registration failures and the nominal position is used."""
+
+doc_mosaic_image_name = """Name of the mosaic image in subsequent modules."""
+
+doc_drift = """Estimate the drift of each field (slide, well and field position) since its previous time point by phase correlation of the first channel with the image of that field at the previous time point. The drift is recorded as Drift_X and Drift_Y measurements (in pixels, 0 at the first time point) and can be applied by LCCimageObject. Drift_Peak is the height of the correlation peak, values close to 0 indicate that the estimate is unreliable."""
+
+doc_drift_downsample = """The images are block averaged by this factor before the drift is estimated. This saves time and memory, the drift is only determined in multiples of this factor."""
+
+doc_drift_cache = """Maximum number of fields for which the previous time point is kept. Each field needs 8 bytes per pixel of the downsampled image. If more fields are imaged, the least recently imaged field is dropped and gets no drift estimate at its next time point."""
+
+doc_binning = """Add a block-binned copy of every channel, e.g. to segment on a small image where full resolution isn't needed to find object centres. Each block of pixels is averaged. The binned images are named after the channel's output image name followed by the suffix below. The binning factor is recorded as Binning_Factor measurement, LCCimageObject can use it to scale object coordinates back to full resolution."""
+
+doc_binning_suffix = """The binned copy of a channel is named after its output image name followed by this suffix, e.g. OutputImageBinned."""
+
+doc_flatfield = """Correct every channel for uneven illumination with a flat-field model learned from the fields analysed so far. Each field is downsampled and kept in a buffer of the last fields, the illumination function is the pixel-wise median over the buffer. This works if objects are distributed randomly over the fields, so that the median only keeps the illumination pattern. No correction is applied until the minimum number of fields below has been seen. The number of fields the correction is based on is recorded as FlatField_NrOfImages_[image name] measurement."""
+
+doc_flatfield_factor = """The fields are block averaged by this factor before they are added to the model. Illumination varies slowly, so a large factor saves memory and time."""
+
+doc_flatfield_history = """Number of (downsampled) fields kept per channel."""
+
+doc_flatfield_min = """Number of fields that have to be seen before the correction is applied."""
+
+doc_flatfield_update = """The illumination function is recomputed after this many new fields, in between the cached correction is applied."""
+
+doc_checkpoint = """Tick this to keep track of the fields that have been analysed, and of the state of the LCCimageObject modules (objects
+imaged per well, jobs sent or held back), in a file next to the image base path (e.g. D:\\data\\screen1.lcc_checkpoint.json).
+A field counts as analysed once all modules have run on it. If CellProfiler or the connection dies, the run can be restarted
+with the option below and carries on where it stopped."""
+
+doc_resume = """Tick this to load the checkpoint of a previous run. Fields that were analysed in the previous run are skipped (the stopwaiting
+command is sent for them, so the microscope carries on), LCCimageObject continues counting the objects per well and doesn't send
+jobs again. If no checkpoint is found the run starts from scratch."""
+
+doc_checkpoint_interval = """The checkpoint file is written at most once per this many seconds, and at the end of the run."""
 
 doc_flush = """this will flush any outstanding messages from the CAM server before starting. In most cases you want to enable this option to discard any outstanding messages from previous experiments"""
 
@@ -136,7 +286,7 @@ class LCCwaitForImage(cpm.CPModule):
 
     module_name = "LCCwaitForImage"
     category = "MicroscopeAutomation"
-    variable_revision_number = 1
+    variable_revision_number = 14
     
     filename = ""
 
@@ -152,7 +302,76 @@ class LCCwaitForImage(cpm.CPModule):
 
         self.nr_of_images = cps.Integer("Number of image sets to process", value = 100000, minval = -1, doc = doc_nrimages)
 
-        self.stackOption = cps.Choice("Z Stack handling:", [STACK_NONE, STACK_MEAN, STACK_MAX], STACK_NONE,  doc = doc_stack)
+
+        self.end_on_scanfinished = cps.Binary("End run when scan finishes:", True, doc = doc_scanfinished)
+
+        self.idle_timeout = cps.Integer("End run after idle time (seconds):", value = 400, minval = 0, doc = doc_idletimeout)
+
+        self.stackOption = cps.Choice("Z Stack handling:", [STACK_NONE, STACK_MEAN, STACK_MAX, STACK_MIN, STACK_SUM, STACK_STD, STACK_BEST_FOCUS], STACK_NONE,  doc = doc_stack)
+
+        self.focus_metric = cps.Choice("Focus metric:", [FOCUS_METRIC_NORMVAR, FOCUS_METRIC_LAPLACIAN, FOCUS_METRIC_BRENNER], FOCUS_METRIC_NORMVAR, doc = doc_focus)
+
+        self.accumulation_dtype = cps.Choice("Accumulation data type for projections:", [ACC_FLOAT32, ACC_FLOAT64], ACC_FLOAT32, doc = doc_accumulation)
+
+        self.output_dtype = cps.Choice("Output image data type:", [OUTPUT_SCALED, OUTPUT_FLOAT32, OUTPUT_NATIVE], OUTPUT_SCALED, doc = doc_output_dtype)
+
+        self.image_reader = cps.Choice("Image reader:", [READER_NATIVE, READER_BIOFORMATS], READER_NATIVE, doc = doc_reader)
+
+        self.collect_other_jobs = cps.Binary("Collect images from other jobs:", False, doc = doc_collect)
+
+        self.collector_file = cps.Text("Collected image list file:", "LCC_collected_images.csv", doc = doc_collector_file)
+
+        self.wait_for_complete_fields = cps.Binary("Wait until all planes of a field are announced:", False, doc = doc_complete_fields)
+
+        self.nr_of_slices = cps.Integer("Number of Z slices per field:", value = 1, minval = 1, doc = doc_nr_of_slices)
+
+        self.field_timeout = cps.Integer("Field completion timeout (seconds):", value = 60, minval = 0, doc = doc_field_timeout)
+
+        self.image_source = cps.Choice("Image source:", [SOURCE_CAM, SOURCE_FOLDER], SOURCE_CAM, doc = doc_image_source)
+
+        self.prefetch_fields = cps.Integer("Number of fields to prefetch:", value = 2, minval = 0, doc = doc_prefetch)
+
+        self.replay_cmdfile = cps.Text("CAM command file:", "LCC_replay_CAM_commands.txt", doc = doc_replay_cmdfile)
+
+        self.mosaic = cps.Binary("Assemble well mosaic:", False, doc = doc_mosaic)
+
+        self.mosaic_fields_x = cps.Integer("Number of fields per well along X:", value = 1, minval = 1, doc = doc_mosaic_fields)
+
+        self.mosaic_fields_y = cps.Integer("Number of fields per well along Y:", value = 1, minval = 1, doc = doc_mosaic_fields)
+
+        self.mosaic_overlap = cps.Float("Field overlap (%):", value = 10, minval = 0, maxval = 90, doc = doc_mosaic_overlap)
+
+        self.mosaic_refine = cps.Binary("Refine field positions by phase correlation:", False, doc = doc_mosaic_refine)
+
+        self.mosaic_max_shift = cps.Integer("Maximum refinement shift (pixels):", value = 20, minval = 0, doc = doc_mosaic_max_shift)
+
+        self.mosaic_image_name = cps.ImageNameProvider("Mosaic image name:", "Mosaic", doc = doc_mosaic_image_name)
+
+        self.estimate_drift = cps.Binary("Estimate drift between time points:", False, doc = doc_drift)
+
+        self.drift_downsample = cps.Integer("Downsampling factor for drift estimation:", value = 4, minval = 1, doc = doc_drift_downsample)
+
+        self.drift_cache_size = cps.Integer("Number of fields to keep for drift estimation:", value = 200, minval = 1, doc = doc_drift_cache)
+
+        self.binning = cps.Choice("Binned preview images:", [BINNING_NONE, BINNING_2, BINNING_4, BINNING_8], BINNING_NONE, doc = doc_binning)
+
+        self.binning_suffix = cps.Text("Binned image name suffix:", "Binned", doc = doc_binning_suffix)
+
+        self.flatfield = cps.Binary("Running flat-field correction:", False, doc = doc_flatfield)
+
+        self.flatfield_factor = cps.Integer("Downsampling factor for the flat-field model:", value = 16, minval = 1, doc = doc_flatfield_factor)
+
+        self.flatfield_history = cps.Integer("Number of fields in the flat-field model:", value = 50, minval = 1, doc = doc_flatfield_history)
+
+        self.flatfield_min_images = cps.Integer("Minimum number of fields before correcting:", value = 10, minval = 1, doc = doc_flatfield_min)
+
+        self.flatfield_update = cps.Integer("Update the flat-field correction every (fields):", value = 5, minval = 1, doc = doc_flatfield_update)
+
+        self.checkpoint = cps.Binary("Checkpoint progress:", False, doc = doc_checkpoint)
+
+        self.resume = cps.Binary("Resume from checkpoint:", False, doc = doc_resume)
+
+        self.checkpoint_interval = cps.Integer("Checkpoint interval (seconds):", value = 30, minval = 0, doc = doc_checkpoint_interval)
 
         self.flush_input = cps.Binary("Flush pending messages from CAM server:", False, doc=doc_flush)
 
@@ -185,12 +404,50 @@ class LCCwaitForImage(cpm.CPModule):
         self.ch4_settings = [self.channel4, self.output_image_name_ch4, self.ch5_active]
         self.ch5_settings = [self.channel5, self.output_image_name_ch5]
         
+        # settings added in later revisions are appended at the end, see upgrade_settings()
+        self.stack_settings = [self.accumulation_dtype, self.focus_metric, self.image_reader, self.end_on_scanfinished, self.idle_timeout, self.nr_of_images, self.output_dtype, self.collect_other_jobs, self.collector_file, self.wait_for_complete_fields, self.nr_of_slices, self.field_timeout, self.image_source, self.prefetch_fields, self.replay_cmdfile, self.mosaic, self.mosaic_fields_x, self.mosaic_fields_y, self.mosaic_overlap, self.mosaic_refine, self.mosaic_max_shift, self.mosaic_image_name, self.estimate_drift, self.drift_downsample, self.drift_cache_size, self.binning, self.binning_suffix, self.flatfield, self.flatfield_factor, self.flatfield_history, self.flatfield_min_images, self.flatfield_update, self.checkpoint, self.resume, self.checkpoint_interval]
+        
         #return [self.zeissaction_choice, self.microscope_choice,self.channel, self.output_image_name]
-        return self.base_settings + self.ch2_settings + self.ch3_settings + self.ch4_settings + self.ch5_settings
+        return self.base_settings + self.ch2_settings + self.ch3_settings + self.ch4_settings + self.ch5_settings + self.stack_settings
 
     def visible_settings(self):
         # TODO boilerplate code very similar to settings(). How to avoid ?
-        self.base_settings = [self.job_of_interest, self.flush_input, self.nr_of_images, self.channel, self.output_image_name, self.stackOption, self.ch2_active]
+        self.base_settings = [self.image_source, self.job_of_interest]
+        if self.image_source.value == SOURCE_FOLDER:
+            self.base_settings += [self.prefetch_fields, self.replay_cmdfile, self.nr_of_images]
+        else:
+            self.base_settings += [self.collect_other_jobs]
+            if self.collect_other_jobs.value:
+                self.base_settings += [self.collector_file]
+            self.base_settings += [self.flush_input, self.nr_of_images, self.end_on_scanfinished, self.idle_timeout]
+            self.base_settings += [self.wait_for_complete_fields]
+            if self.wait_for_complete_fields.value:
+                self.base_settings += [self.nr_of_slices, self.field_timeout]
+        self.base_settings += [self.channel, self.output_image_name, self.stackOption]
+        if self.stackOption.value == STACK_BEST_FOCUS:
+            self.base_settings += [self.focus_metric]
+        if self.stackOption.value != STACK_NONE:
+            self.base_settings += [self.accumulation_dtype]
+        self.base_settings += [self.output_dtype, self.image_reader]
+        self.base_settings += [self.flatfield]
+        if self.flatfield.value:
+            self.base_settings += [self.flatfield_factor, self.flatfield_history, self.flatfield_min_images, self.flatfield_update]
+        self.base_settings += [self.binning]
+        if self.binning.value != BINNING_NONE:
+            self.base_settings += [self.binning_suffix]
+        self.base_settings += [self.mosaic]
+        if self.mosaic.value:
+            self.base_settings += [self.mosaic_fields_x, self.mosaic_fields_y, self.mosaic_overlap, self.mosaic_refine]
+            if self.mosaic_refine.value:
+                self.base_settings += [self.mosaic_max_shift]
+            self.base_settings += [self.mosaic_image_name]
+        self.base_settings += [self.estimate_drift]
+        if self.estimate_drift.value:
+            self.base_settings += [self.drift_downsample, self.drift_cache_size]
+        self.base_settings += [self.checkpoint]
+        if self.checkpoint.value:
+            self.base_settings += [self.resume, self.checkpoint_interval]
+        self.base_settings += [self.ch2_active]
         self.ch2_settings = [self.channel2, self.output_image_name_ch2, self.ch3_active]
         self.ch3_settings = [self.channel3, self.output_image_name_ch3, self.ch4_active]
         self.ch4_settings = [self.channel4, self.output_image_name_ch4, self.ch5_active]
@@ -206,41 +463,445 @@ class LCCwaitForImage(cpm.CPModule):
             return self.base_settings + self.ch2_settings
         return self.base_settings
 
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            # added accumulation data type for projections
+            setting_values = setting_values + [ACC_FLOAT32]
+            variable_revision_number = 2
+        if variable_revision_number == 2:
+            # added focus metric for best focused slice
+            setting_values = setting_values + [FOCUS_METRIC_NORMVAR]
+            variable_revision_number = 3
+        if variable_revision_number == 3:
+            # added image reader choice
+            setting_values = setting_values + [READER_NATIVE]
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            # added end of experiment detection,
+            # the number of image sets is now saved with the pipeline
+            setting_values = setting_values + [cps.YES, "400", "100000"]
+            variable_revision_number = 5
+        if variable_revision_number == 5:
+            # added output data type
+            setting_values = setting_values + [OUTPUT_SCALED]
+            variable_revision_number = 6
+        if variable_revision_number == 6:
+            # added collector for images of other jobs
+            setting_values = setting_values + [cps.NO, "LCC_collected_images.csv"]
+            variable_revision_number = 7
+        if variable_revision_number == 7:
+            # added tracking of complete fields
+            setting_values = setting_values + [cps.NO, "1", "60"]
+            variable_revision_number = 8
+        if variable_revision_number == 8:
+            # added offline replay of an export folder
+            setting_values = setting_values + [SOURCE_CAM, "2", "LCC_replay_CAM_commands.txt"]
+            variable_revision_number = 9
+        if variable_revision_number == 9:
+            # added well mosaic
+            setting_values = setting_values + [cps.NO, "1", "1", "10", cps.NO, "20", "Mosaic"]
+            variable_revision_number = 10
+        if variable_revision_number == 10:
+            # added drift estimation
+            setting_values = setting_values + [cps.NO, "4", "200"]
+            variable_revision_number = 11
+        if variable_revision_number == 11:
+            # added binned preview images
+            setting_values = setting_values + [BINNING_NONE, "Binned"]
+            variable_revision_number = 12
+        if variable_revision_number == 12:
+            # added running flat-field correction
+            setting_values = setting_values + [cps.NO, "16", "50", "10", "5"]
+            variable_revision_number = 13
+        if variable_revision_number == 13:
+            # added checkpointing
+            setting_values = setting_values + [cps.NO, cps.NO, "30"]
+            variable_revision_number = 14
+        return setting_values, variable_revision_number, from_matlab
+
+    def get_active_channels(self):
+        """returns a list of (channel, output_image_name) settings for all channels that should be read"""
+        channels = [(self.channel, self.output_image_name)]
+        for active, channel, output_image_name in ((self.ch2_active, self.channel2, self.output_image_name_ch2),
+                                                   (self.ch3_active, self.channel3, self.output_image_name_ch3),
+                                                   (self.ch4_active, self.channel4, self.output_image_name_ch4),
+                                                   (self.ch5_active, self.channel5, self.output_image_name_ch5)):
+            if active.value:
+                channels.append((channel, output_image_name))
+        return channels
+
+    def validate_module(self, pipeline):
+        if self.checkpoint.value and self.get_basepath(pipeline).strip() == "":
+            raise cps.ValidationError("Checkpointing needs the image base path (set in LCConnect), the checkpoint file is written next to it", self.checkpoint)
+
     def prepare_run(self, pipeline, image_set_list, frame):
         """ prepare_run gets called by the cellprofiler framework. This is where you populate
         the list of images that Analyze Images will batch process. We initialize a very large image list as
         a dirty hack so that the pipeline doesn't stop before the microscope is finished with the low-resolution
-        scan. You may have to increase this number for very large experiments."""
+        scan. You may have to increase this number for very large experiments. Once the end of the experiment
+        is detected, run() skips the remaining image sets.
+        When an export folder is replayed, the folder is scanned here and exactly one image set per field is created."""
+
+        self.detected_job = None
+        self.experiment_finished = False
+        # pressing Stop ends the run, which cancels a pending wait for the CAM server
+        self.gui_frame = frame
+        try:
+            pipeline.remove_listener(self.on_pipeline_event)
+        except ValueError:
+            pass
+        pipeline.add_listener(self.on_pipeline_event)
+        if self.image_reader.value == READER_BIOFORMATS:
+            # every plane will be read with bioformats, import it while the run starts
+            preload_bioformats()
+        self.close_readers()
+        self.close_replay()
+        self.reader_pool = BioformatsReaderPool()
+        # release the mosaic of the previous run
+        set_current_mosaic(None)
+        # one flat-field model per channel number
+        self.flatfield_models = {}
+        if self.estimate_drift.value:
+            self.drift_estimator = DriftEstimator(self.drift_downsample.value, self.drift_cache_size.value)
+        else:
+            self.drift_estimator = None
+        if self.wait_for_complete_fields.value:
+            channels = [int(channel.value)-1 for channel, output_image_name in self.get_active_channels()]
+            self.field_index = FieldIndex(self.nr_of_slices.value, channels, self.field_timeout.value)
+        else:
+            self.field_index = None
+
+        # fields analysed in this and, when resuming, previous runs
+        self.processed_fields = ProcessedFields()
+        self.current_field = None # (key, timepoint) of the field being analysed
+        self.checkpoint_file = None
+        if self.checkpoint.value:
+            self.checkpoint_file = Checkpoint(checkpoint_filename(self.get_basepath(pipeline)), self.checkpoint_interval.value)
+            if self.resume.value and self.checkpoint_file.load():
+                if self.checkpoint_file.get("processed_fields") is not None:
+                    self.processed_fields.restore(self.checkpoint_file.get("processed_fields"))
+                print "Resuming from", self.checkpoint_file.filename + ",", len(self.processed_fields), "fields of the latest timepoint analysed before"
+        set_current_checkpoint(self.checkpoint_file)
+
+        if self.image_source.value == SOURCE_FOLDER:
+            basepath = self.get_basepath(pipeline)
+            if self.job_of_interest.value >= 0:
+                jobnr = self.job_of_interest.value
+            else:
+                jobnr = None
+            self.replay = FolderReplay(basepath, CAMC.parseLeicaFilename, jobnr)
+            nr_of_sets = self.replay.scan()
+            if nr_of_sets == 0:
+                print "No images of the job of interest found in", basepath
+                return False
+            if self.nr_of_images.value > 0:
+                nr_of_sets = min(nr_of_sets, self.nr_of_images.value)
+            for i in range(nr_of_sets):
+                image_set = image_set_list.get_image_set(i)
+            return True
 
         for i in range(self.nr_of_images.value):
             image_set = image_set_list.get_image_set(i)
         return True
 
+    def add_to_mosaic(self, workspace, md, pixel_data, scale):
+        """places the field on the mosaic of its well and adds the mosaic to the image set"""
+        key = (md['tpoint'], md['slide'], md['U'], md['V'])
+        fx = int(md['X'][3:])
+        fy = int(md['Y'][3:])
+        mosaic = get_current_mosaic()
+        if mosaic is None or mosaic.key != key or (fx, fy) in mosaic.positions or mosaic.tile_shape != pixel_data.shape:
+            # first field of a new well (or the well is imaged again)
+            mosaic = WellMosaic(key, self.mosaic_fields_x.value, self.mosaic_fields_y.value, pixel_data.shape, pixel_data.dtype,
+                                self.mosaic_overlap.value / 100.0, self.mosaic_refine.value, self.mosaic_max_shift.value)
+            set_current_mosaic(mosaic)
+        if fx < mosaic.nr_fields_x and fy < mosaic.nr_fields_y:
+            y0, x0 = mosaic.add(fx, fy, pixel_data)
+            dy, dx = mosaic.shifts[(fx, fy)]
+        else:
+            print "Field", (fx, fy), "is outside of the configured mosaic of", mosaic.nr_fields_x, "x", mosaic.nr_fields_y, "fields"
+            y0, x0, dy, dx = -1, -1, 0, 0
+        if self.output_dtype.value == OUTPUT_NATIVE:
+            mosaic_image = cpi.Image(mosaic.image(), scale=scale, convert=False)
+        else:
+            mosaic_image = cpi.Image(mosaic.image())
+        workspace.image_set.add(self.mosaic_image_name.value, mosaic_image)
+        print "Mosaic of well", key, ":", len(mosaic.positions), "of", mosaic.nr_fields_x * mosaic.nr_fields_y, "fields placed"
+        measurements = workspace.measurements
+        measurements.add_measurement("Image", "_".join((C_MOSAIC, F_COMPLETE)), np.array(int(mosaic.isComplete())), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_MOSAIC, F_ORIGIN_X)), np.array(x0), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_MOSAIC, F_ORIGIN_Y)), np.array(y0), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_MOSAIC, F_SHIFT_X)), np.array(dx), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_MOSAIC, F_SHIFT_Y)), np.array(dy), can_overwrite=True)
+
+    def correct_illumination(self, workspace, channel, output_image_name, pixel_data):
+        """adds the field to the flat-field model of its channel and returns the corrected field"""
+        model = self.flatfield_models.get(channel)
+        if model is None:
+            model = self.flatfield_models[channel] = RunningFlatField(self.flatfield_factor.value, self.flatfield_history.value,
+                                                                      self.flatfield_min_images.value, self.flatfield_update.value)
+        model.add(pixel_data)
+        corrected = model.apply(pixel_data)
+        if model.illumination() is None:
+            # not enough fields yet, the field is not corrected
+            nr_of_images = 0
+        else:
+            nr_of_images = model.nrOfImages()
+        workspace.measurements.add_measurement("Image", "_".join((C_FLATFIELD, F_NR_OF_IMAGES, output_image_name)), np.array(nr_of_images), can_overwrite=True)
+        return corrected
+
+    def measure_drift(self, workspace, md, pixel_data):
+        """estimates the drift of the field since its previous time point and records it as measurements"""
+        key = (md['slide'], md['U'], md['V'], md['X'], md['Y'])
+        drift = self.drift_estimator.estimate(key, pixel_data)
+        if drift is None:
+            # first time point of this field
+            dy, dx, peak = 0, 0, 0.0
+        else:
+            dy, dx, peak = drift
+            print "Drift of field", key, "x:", dx, "y:", dy, "peak:", peak
+        measurements = workspace.measurements
+        measurements.add_measurement("Image", "_".join((C_DRIFT, F_DRIFT_X)), np.array(dx), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_DRIFT, F_DRIFT_Y)), np.array(dy), can_overwrite=True)
+        measurements.add_measurement("Image", "_".join((C_DRIFT, F_DRIFT_PEAK)), np.array(peak), can_overwrite=True)
+
+    def on_pipeline_event(self, caller, event):
+        """cancels waits for the CAM server when the run ends, e.g. because the user pressed Stop"""
+        if isinstance(event, cpp.EndRunEvent):
+            CAMC.cancel()
+
+    def process_gui_events(self):
+        """called while waiting for the CAM server. When the pipeline runs in the GUI thread, this keeps the GUI
+        (and its Stop button) responsive"""
+        if getattr(self, 'gui_frame', None) is None:
+            return
+        import wx
+        app = wx.GetApp()
+        if app is not None and wx.Thread_IsMain():
+            app.Yield(True)
+
+    def close_readers(self):
+        """closes the bioformats readers kept open during the run"""
+        if getattr(self, 'reader_pool', None) is not None:
+            self.reader_pool.close()
+            self.reader_pool = None
+
+    def close_replay(self):
+        """stops the prefetch threads of the folder replay"""
+        if getattr(self, 'replay', None) is not None:
+            self.replay.close()
+            self.replay = None
+
+    def checkpoint_key(self, md):
+        """the field key of an image, relative to the base path so that the checkpoint survives a change of drive letter"""
+        key = fieldKey(md)
+        if CAMC.basepath != "" and key.startswith(CAMC.basepath):
+            key = key[len(CAMC.basepath):]
+        return key
+
+    def commit_field(self):
+        """records the field of the previous image set as analysed, all modules have run on it by now"""
+        if self.checkpoint_file is None:
+            return
+        if self.current_field is not None:
+            self.processed_fields.add(*self.current_field)
+            self.current_field = None
+            # only the fields of the current timepoint are kept, see ProcessedFields
+            self.checkpoint_file.set("processed_fields", self.processed_fields.state())
+        if CAMC.previous_file != self.checkpoint_file.get("previous_file"):
+            self.checkpoint_file.set("previous_file", CAMC.previous_file)
+
+    def get_basepath(self, pipeline):
+        """the image base path. LCConnect only sets it in CAMC when it runs, so it is taken from its settings if possible"""
+        for module in pipeline.modules():
+            if module.module_name == "LCConnect":
+                CAMC.basepath = module.basepath.value
+        return CAMC.basepath
+
+    def replay_command_file(self):
+        """the file CAM commands are written to when replaying an export folder"""
+        cmdfile = self.replay_cmdfile.value
+        if not os.path.isabs(cmdfile):
+            cmdfile = os.path.join(CAMC.basepath, cmdfile)
+        return cmdfile
+
+    def next_replay_field(self, workspace):
+        """returns the field for the current image set when replaying an export folder, as a tuple
+        (fullfilename, metadata, field) like wait_for_field(), or None if all fields have been replayed"""
+        index = workspace.measurements.image_set_number - 1
+        if index >= len(self.replay):
+            return None
+        self.replay.prefetch(index, self.prefetch_fields.value)
+        field = self.replay.field(index)
+        return field.filename, field.metadata, field
+
+    def wait_for_field(self):
+        """Waits for the next image of the job of interest. If complete fields are awaited, images are collected in the
+        field index until all Z slices and channels of a field have been announced (or the field timed out).
+        Returns a tuple (fullfilename, metadata, field), where field is None unless complete fields are awaited,
+        or None if the end of the experiment was detected (scan finished or idle timeout)."""
+        jobnr = self.job_of_interest.value
+        if jobnr < 0:
+            # None until the first image was received, then the job of that image
+            jobnr = self.detected_job
+        if self.idle_timeout.value > 0:
+            idle_timeout = self.idle_timeout.value
+            CAMC.timeout = min(CAMC.timeout, idle_timeout)
+        else:
+            idle_timeout = None
+        stop_on_scanfinished = self.end_on_scanfinished.value
+        index = self.field_index
+        if index is not None and CAMC.isBrokered():
+            return self.wait_for_brokered_field(jobnr, idle_timeout, stop_on_scanfinished)
+        if index is not None:
+            # make sure we get control back in time to hand out fields that timed out
+            CAMC.timeout = min(CAMC.timeout, max(1, index.timeout))
+
+        last_image = time.time()
+        while True:
+            if index is not None:
+                field = index.popReady()
+                if field is not None:
+                    return field.filename, field.metadata, field
+                waittime = None
+                if idle_timeout is not None:
+                    waittime = max(0, idle_timeout - (time.time() - last_image))
+                deadline = index.nextDeadline()
+                if deadline is not None:
+                    waittime = max(0, min(waittime, deadline - time.time()) if waittime is not None else deadline - time.time())
+            else:
+                waittime = idle_timeout
+
+            imageresponse = CAMC.waitforimage(jobnr=jobnr, timeout=waittime, processGUIEvents=self.process_gui_events,
+                                              stopOnScanFinished=stop_on_scanfinished)
+            self.collect_other_images(jobnr)
+            if imageresponse is None:
+                if CAMC.isCancelled():
+                    raise Exception("Waiting for image cancelled")
+                idle = idle_timeout is not None and time.time() - last_image >= idle_timeout
+                finished = stop_on_scanfinished and CAMC.scan_finished
+                if index is not None:
+                    if not (idle or finished or waittime is None):
+                        # an incomplete field timed out, popReady() hands it out
+                        continue
+                    # no further planes will arrive, hand out what we have
+                    field = index.popOldest()
+                    if field is not None:
+                        return field.filename, field.metadata, field
+                if idle or finished:
+                    return None
+                print "No image received ... Timeout ?"
+                raise Exception("Timeout")
+
+            fullfilename, md = imageresponse
+            if jobnr is None:
+                self.detected_job = int(md['job'][3:])
+                jobnr = self.detected_job
+                print "Job of interest is J" + str(self.detected_job).zfill(2)
+            if index is None:
+                return fullfilename, md, None
+            last_image = time.time()
+            index.add(fullfilename, md)
+
+    def wait_for_brokered_field(self, jobnr, idle_timeout, stop_on_scanfinished):
+        """wait_for_field() through a CAM broker shared with other workers. The broker collects the planes into fields
+        itself, so that all planes of a field go to the same worker."""
+        index = self.field_index
+        wait_start = time.time()
+        field = CAMC.waitforfieldFromBroker(jobnr, index.nr_of_slices, index.channels, index.timeout,
+                                            timeout=idle_timeout, processGUIEvents=self.process_gui_events,
+                                            stopOnScanFinished=stop_on_scanfinished)
+        self.collect_other_images(jobnr)
+        if field is None:
+            if CAMC.isCancelled():
+                raise Exception("Waiting for image cancelled")
+            idle = idle_timeout is not None and time.time() - wait_start >= idle_timeout
+            if idle or (stop_on_scanfinished and CAMC.scan_finished):
+                return None
+            print "No image received ... Timeout ?"
+            raise Exception("Timeout")
+        if jobnr is None:
+            self.detected_job = int(field.metadata['job'][3:])
+            print "Job of interest is J" + str(self.detected_job).zfill(2)
+        return field.filename, field.metadata, field
+
+    def collect_other_images(self, jobnr):
+        """Hands images of all jobs other than jobnr that were reported so far to the collector,
+        which appends them to the collected image list file."""
+        if not self.collect_other_jobs.value or jobnr is None:
+            return
+        collected = CAMC.getQueuedImages(excludeJobnr=jobnr)
+        if len(collected) == 0:
+            return
+        listfile = self.collector_file.value
+        if not os.path.isabs(listfile):
+            listfile = os.path.join(CAMC.basepath, listfile)
+        print "Collecting", len(collected), "images from other jobs into", listfile
+        f = open(listfile, 'a')
+        try:
+            for arrival, fname, md, jobname in collected:
+                f.write(",".join((time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(arrival)), md['job'][2:], str(jobname or ""), fname)) + "\n")
+        finally:
+            f.close()
+
+    def end_of_experiment(self, workspace):
+        """Called when no further images will arrive. This and all remaining preallocated image sets are skipped
+        without waiting, so the run finishes and post_run() is called for all modules."""
+        print "End of experiment, skipping the remaining image sets"
+        self.experiment_finished = True
+        # there is no image for this image set, skip the remaining modules
+        workspace.disposition = cpw.DISPOSITION_SKIP
+
     def get_measurement_columns(self, pipeline):
         # Publish the metadata fields here, so we can use them in export
         # TODO: what to do with Metadata_M ? It is not always present, currently it is not published
         # to the pipeline
-        return [(cpmeas.IMAGE, "Metadata_image_width", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_image_height", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_PosX", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_PosY", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Slide", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_ChamberU", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_ChamberV", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Loop", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Zpos", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_PosX", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_PosY", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Other", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Job", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_Channel", cpmeas.COLTYPE_INTEGER),
-                (cpmeas.IMAGE, "Metadata_T", cpmeas.COLTYPE_INTEGER)
-                #,
-                #(cpmeas.IMAGE, "_".join((C_FILE_NAME,self.output_image_name.value), cpmeas.COLTYPE_VARCHAR_FILE_NAME)),
-                #(cpmeas.IMAGE, "_".join((C_PATH_NAME,self.output_image_name.value), cpmeas.COLTYPE_VARCHAR_FILE_NAME))
-                # publishing these like this appears to break everything to do with measurements in the pipeline - unclear why
-                # maybe try changing COLTYPE_VARCHAR_FILE_NAME to COLTYPE_VARCHAR
-                ]
+        columns = [(cpmeas.IMAGE, "Metadata_image_width", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_image_height", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_PosX", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_PosY", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Slide", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_ChamberU", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_ChamberV", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Loop", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Zpos", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_PosX", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_PosY", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Other", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Job", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_Channel", cpmeas.COLTYPE_INTEGER),
+                   (cpmeas.IMAGE, "Metadata_T", cpmeas.COLTYPE_INTEGER)
+                   #,
+                   #(cpmeas.IMAGE, "_".join((C_FILE_NAME,self.output_image_name.value), cpmeas.COLTYPE_VARCHAR_FILE_NAME)),
+                   #(cpmeas.IMAGE, "_".join((C_PATH_NAME,self.output_image_name.value), cpmeas.COLTYPE_VARCHAR_FILE_NAME))
+                   # publishing these like this appears to break everything to do with measurements in the pipeline - unclear why
+                   # maybe try changing COLTYPE_VARCHAR_FILE_NAME to COLTYPE_VARCHAR
+                   ]
+        for channel, output_image_name in self.get_active_channels():
+            columns += [(cpmeas.IMAGE, "_".join((C_SCALING, output_image_name.value)), cpmeas.COLTYPE_FLOAT)]
+        if self.stackOption.value == STACK_BEST_FOCUS:
+            for channel, output_image_name in self.get_active_channels():
+                columns += [(cpmeas.IMAGE, "_".join((C_FOCUS, F_BEST_Z, output_image_name.value)), cpmeas.COLTYPE_INTEGER),
+                            (cpmeas.IMAGE, "_".join((C_FOCUS, F_SCORE, output_image_name.value)), cpmeas.COLTYPE_FLOAT)]
+        columns += [(cpmeas.IMAGE, "_".join((C_TIMING, F_WAIT_NOTIFICATION)), cpmeas.COLTYPE_FLOAT),
+                    (cpmeas.IMAGE, "_".join((C_TIMING, F_WAIT_FILE_READY)), cpmeas.COLTYPE_FLOAT)]
+        for channel, output_image_name in self.get_active_channels():
+            columns += [(cpmeas.IMAGE, "_".join((C_TIMING, F_READ, output_image_name.value)), cpmeas.COLTYPE_FLOAT),
+                        (cpmeas.IMAGE, "_".join((C_TIMING, F_PROJECTION, output_image_name.value)), cpmeas.COLTYPE_FLOAT),
+                        (cpmeas.IMAGE, "_".join((C_BYTES_READ, output_image_name.value)), cpmeas.COLTYPE_INTEGER)]
+        if self.mosaic.value:
+            columns += [(cpmeas.IMAGE, "_".join((C_MOSAIC, feature)), cpmeas.COLTYPE_INTEGER)
+                        for feature in (F_COMPLETE, F_ORIGIN_X, F_ORIGIN_Y, F_SHIFT_X, F_SHIFT_Y)]
+        if self.estimate_drift.value:
+            columns += [(cpmeas.IMAGE, "_".join((C_DRIFT, F_DRIFT_X)), cpmeas.COLTYPE_INTEGER),
+                        (cpmeas.IMAGE, "_".join((C_DRIFT, F_DRIFT_Y)), cpmeas.COLTYPE_INTEGER),
+                        (cpmeas.IMAGE, "_".join((C_DRIFT, F_DRIFT_PEAK)), cpmeas.COLTYPE_FLOAT)]
+        if self.binning.value != BINNING_NONE:
+            columns += [(cpmeas.IMAGE, "_".join((C_BINNING, F_FACTOR)), cpmeas.COLTYPE_INTEGER)]
+        if self.flatfield.value:
+            columns += [(cpmeas.IMAGE, "_".join((C_FLATFIELD, F_NR_OF_IMAGES, output_image_name.value)), cpmeas.COLTYPE_INTEGER)
+                        for channel, output_image_name in self.get_active_channels()]
+        return columns
 
     # Main 
     def run(self, workspace):
@@ -252,40 +913,68 @@ class LCCwaitForImage(cpm.CPModule):
 
         global CAMC
 
+        if self.experiment_finished:
+            # skip the remaining image sets as quickly as possible, see end_of_experiment()
+            workspace.disposition = cpw.DISPOSITION_SKIP
+            return
+
         # some debugging output on the console
         print "entering run in leica_interface.py"
         print "Ip address of CAM server ", CAMC.getIP()
         print "Baspath for files", CAMC.basepath
         #print self.flush_input.value
 
+        replay = self.image_source.value == SOURCE_FOLDER
+
         if workspace.measurements.is_first_image: 
             print "First image of analysis run, closeing/reopening connection resetting previous_filename"
             print "closing"
             CAMC.close()
+            # a cancelled wait of the previous run must not cancel this one
+            CAMC.resetCancel()
+            if replay:
+                # no microscope, commands of downstream modules go to a file
+                CAMC.setOfflineCommandFile(self.replay_command_file())
+            else:
+                CAMC.setOfflineCommandFile(None)
             
             print "reopening"
             CAMC.open()
             CAMC.previous_file = ""  
             CAMC.timeout=400
-
-        # make sure we are connected
-        if CAMC.isConnected():
-          if self.flush_input.value:
-            print("flushing input buffer on CAM server connection")
-            CAMC.flushCAMreceivebuffer()
-        else:
-          print "No connection to cam server. Establish connection using LeicaCAMConnect module first"
-          raise Exception("No Connection")
-          
-
-
-        # wait for an image from the microscope 
-        imageresponse = CAMC.waitforimage(jobnr=self.job_of_interest.value)
-        if imageresponse is not None:
-            self.fullfilename, md = imageresponse # get file name and metadata
+            CAMC.resetScanFinished()
+            if self.checkpoint_file is not None:
+                CAMC.previous_file = self.checkpoint_file.get("previous_file", "")
+
+        self.commit_field()
+        if self.checkpoint_file is not None:
+            self.checkpoint_file.save()
+
+        wait_start = time.time()
+        if replay:
+            # the fields of the export folder are known, nothing to wait for
+            response = self.next_replay_field(workspace)
         else:
-            print "No image received ... Timeout ?"
-            raise Exception("Timeout")
+            # make sure we are connected, e.g. in analysis workers that didn't get the first image set
+            if not CAMC.isConnected():
+                print "Not connected, trying to connect"
+                CAMC.open()
+            if CAMC.isConnected():
+              if self.flush_input.value and workspace.measurements.is_first_image:
+                print("flushing input buffer on CAM server connection")
+                CAMC.flushCAMreceivebuffer()
+                CAMC.clearImageQueues()
+            else:
+              print "No connection to cam server. Establish connection using LeicaCAMConnect module first"
+              raise Exception("No Connection")
+
+            # wait for an image (or a complete field) from the microscope 
+            response = self.wait_for_field()
+        if response is None:
+            self.end_of_experiment(workspace)
+            return
+        self.fullfilename, md, field = response # get file name, metadata and the planes of the field
+        wait_notification = time.time() - wait_start
         print "New input file ", self.fullfilename
         print "Metadata "
         print md
@@ -300,125 +989,196 @@ class LCCwaitForImage(cpm.CPModule):
             print "Error - no metadata for file"
             raise Exception("no metadata")
 
+        if self.checkpoint_file is not None:
+            key = self.checkpoint_key(md)
+            timepoint = fieldTimepoint(md)
+            if self.processed_fields.contains(key, timepoint):
+                print "Field was analysed before the restart, skipping it"
+                if not replay:
+                    # the microscope may be waiting for the CAM list of this field
+                    CAMC.stopWaitingForCAM()
+                workspace.disposition = cpw.DISPOSITION_SKIP
+                return
+            self.current_field = (key, timepoint)
+
         # reassemble base name
         base= md['prefix']+md['loop']+md['slide']+md['M']+md['U']+md['V']+md['job']+md['E']+md['other']+md['X']+md['Y']+md['tpoint']+md['zpos']
 
-        def read_stack(filename):
-            slicedigits = len(md['zpos'][3:])
-            lastslice=int(md['zpos'][3:])
+        # try the memory-mapped TIFF reader first, unless bioformats was chosen
+        native = self.image_reader.value == READER_NATIVE
+
+        # keep the acquired data type instead of converting to scaled floating point
+        keep_dtype = self.output_dtype.value == OUTPUT_NATIVE
+
+        # best focused slice and its score for each file, filled in by read_stack
+        focus = {}
+
+        # time spent waiting for files to become ready, summed over all planes
+        wait_file_ready = [0.0]
+
+        # files of this field that bioformats reads share a reader
+        reader_key = fieldKey(md)
+
+        def read_plane(slicefile, stats, z, c):
+            """waits for slicefile (plane z of channel c) to become ready and reads it. Read time and bytes are added to stats"""
+            t0 = time.time()
+            wait_for_file(slicefile)
+            t1 = time.time()
+            img, scale = load_plane(slicefile, native, self.reader_pool, reader_key, z, c)
+            wait_file_ready[0] += t1 - t0
+            stats[F_READ] += time.time() - t1
+            stats[C_BYTES_READ] += img.nbytes
+            return img, scale
+
+        def read_stack(filename, slices, stats, c):
+            """reads a single plane or a Z stack of channel c and returns (pixel data, scale) with the pixel data still unscaled.
+            slices is the list of (z, file name) of the announced slices, if it is empty the slice file names are
+            derived from filename, assuming that it is the last slice.
+            Read and projection times and the bytes read are added to stats"""
+            if len(slices) == 0:
+                slicedigits = len(md['zpos'][3:])
+                lastslice=int(md['zpos'][3:])
+                for z in range(0,lastslice+1):
+                    # cobble together filename for the current slice
+                    currentslice_string = '--Z' + str(z).zfill(slicedigits)
+                    slices.append((z, filename.replace(md['zpos'], currentslice_string)))
             #pdb.set_trace()
 
             if  self.stackOption.value == STACK_NONE:
                 # Read single image
-                tmpimg, scale = load_using_bioformats(
-                    filename,
-                    rescale = False,
-                    wants_max_intensity = True)
-                img = tmpimg.astype(np.float64)
+                img, scale = read_plane(filename, stats, slices[-1][0], c)
+            elif self.stackOption.value == STACK_BEST_FOCUS:
+                # Score every slice while streaming, only the best slice so far is kept
+                selector = BestFocusSelector(FOCUS_METRICS[self.focus_metric.value])
+                for i, (z, slicefile) in enumerate(slices):
+                    tmpimg, tmpscale = read_plane(slicefile, stats, z, c)
+                    if i == 0:
+                        scale = tmpscale
+                    t0 = time.time()
+                    selector.add(tmpimg, z)
+                    stats[F_PROJECTION] += time.time() - t0
+                img, best_z, best_score = selector.result()
+                print "best focused slice:", best_z, "score:", best_score
+                focus[filename] = (best_z, best_score)
             else:
-                # Read stack and calculate projection on the fly
-                slices = range(0,lastslice+1) 
+                # Read stack and calculate projection on the fly.
+                # Only the current slice and the accumulators are held in memory.
+                projection = STACK_PROJECTIONS[self.stackOption.value]
+                if keep_dtype and projection in (PROJ_MAX, PROJ_MIN):
+                    # max and min can be accumulated in the acquired data type
+                    acc_dtype = None
+                else:
+                    acc_dtype = ACC_DTYPES[self.accumulation_dtype.value]
+                projector = StackProjector(projection, acc_dtype)
                         
-                for z in slices:
-                    # cobble together filename for the current slice
-                    currentslice_string = '--Z' + str(z).zfill(slicedigits)
-                    slicefile = filename.replace(md['zpos'], currentslice_string)
+                for i, (z, slicefile) in enumerate(slices):
                     #print "slicefile ", slicefile
                     # now read as usual 
-                    tmpimg, tmpscale = load_using_bioformats(
-                        slicefile, 
-                        rescale = False,
-                        wants_max_intensity = True)
-                    if z == 0:
-                        # copy first image and change type
-                        img = tmpimg.astype(np.float64)
-                        # store scale in this module
+                    tmpimg, tmpscale = read_plane(slicefile, stats, z, c)
+                    if i == 0:
+                        # all slices of a stack share the same scale
                         scale = tmpscale
                         print "data type:", tmpimg.dtype, "slice:", z, "scale:", scale
-                    else:
-                        if  self.stackOption.value == STACK_MEAN:
-                            img += tmpimg
-                            scale += tmpscale # increase scale with each slice
-                        elif  self.stackOption.value == STACK_MAX:
-                            img = np.maximum(img, tmpimg)
-                        else:
-                            print "stack option not implemented"
-                            pass
-
+                    t0 = time.time()
+                    projector.add(tmpimg)
+                    stats[F_PROJECTION] += time.time() - t0
+                t0 = time.time()
+                img = projector.result()
+                stats[F_PROJECTION] += time.time() - t0
+            return img, scale
+
+        def convert_output(img, scale):
+            """converts the pixel data returned by read_stack to the chosen output data type"""
             print "maxpix ", img.max()
-            img /= scale
+            if keep_dtype:
+                # no scaling, but don't keep a view of the image file
+                if not img.flags.owndata:
+                    img = img.copy()
+                return img
+            if self.output_dtype.value == OUTPUT_FLOAT32:
+                out_dtype = np.float32
+            elif self.stackOption.value == STACK_NONE:
+                out_dtype = np.float64
+            else:
+                # projections keep the accumulation data type
+                out_dtype = ACC_DTYPES[self.accumulation_dtype.value]
+            if img.dtype == out_dtype and img.flags.owndata and img.flags.writeable:
+                # the projection accumulator can be rescaled in place
+                img /= scale
+            else:
+                img = img.astype(out_dtype)
+                img /= scale
             print "maxpix after rescaling", img.max()
             return img
 
-        # TODO: turn this into a loop or similar to avoid boilerplate code
-        self.filech1 = base + "--C0"+str(int(self.channel.value)-1)+md['suffix']+".ome.tif"
-        print "Reading " + self.filech1
-
-        pixel_data=read_stack(self.filech1)
-       
-        if self.ch2_active.value:
-            self.filech2 = base+"--C0"+str(int(self.channel2.value)-1)+md['suffix']+".ome.tif"
-            print "Reading " + self.filech2
-            pixel_data_ch2=read_stack(self.filech2)
-
-        if self.ch3_active.value:
-            self.filech3 = base+"--C0"+str(int(self.channel3.value)-1)+md['suffix']+".ome.tif"
-            print "Reading " + self.filech3
-            pixel_data_ch3=read_stack(self.filech3)
-
-        if self.ch4_active.value:
-            self.filech4 = base+"--C0"+str(int(self.channel4.value)-1)+md['suffix']+".ome.tif"
-            print "Reading " + self.filech4
-            pixel_data_ch4=read_stack(self.filech4)
-
-        if self.ch5_active.value:
-            self.filech5 = base+"--C0"+str(int(self.channel5.value)-1)+md['suffix']+".ome.tif"
-            print "Reading " + self.filech5
-            pixel_data_ch5=read_stack(self.filech5)
-
-
-
         # create the cellprofiler image objects from the pixel data and add the image objects to the set of images
-        # Lots of boilerplate code for the differnt channels - TODO make this neater with a loop
-
-        tmppath, tmpfile= os.path.split(self.filech1)
-        output_image = cpi.Image(pixel_data, path_name=tmppath,file_name = tmpfile, scale=255)
-        image_set.add(self.output_image_name.value, output_image)
-        workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,self.output_image_name.value)), tmpfile, can_overwrite=True)
-        workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,self.output_image_name.value)), tmppath, can_overwrite=True)
-        print "added ", self.output_image_name.value, " to image_set."
-        
-        if self.ch2_active.value:
-            tmppath, tmpfile= os.path.split(self.filech2)
-            output_image_ch2 = cpi.Image(pixel_data_ch2, path_name=tmppath,file_name = tmpfile)
-            image_set.add(self.output_image_name_ch2.value, output_image_ch2)
-            workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,self.output_image_name_ch2.value)), tmpfile, can_overwrite=True)
-            workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,self.output_image_name_ch2.value)), tmppath, can_overwrite=True)
-            print "added ", self.output_image_name_ch2.value, " to image_set."
-
-        if self.ch3_active.value:
-            tmppath, tmpfile= os.path.split(self.filech2)
-            output_image_ch3 = cpi.Image(pixel_data_ch3, path_name=tmppath,file_name = tmpfile)
-            image_set.add(self.output_image_name_ch3.value, output_image_ch3)
-            workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,self.output_image_name_ch3.value)), tmpfile, can_overwrite=True)
-            workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,self.output_image_name_ch3.value)), tmppath, can_overwrite=True)
-            print "added ", self.output_image_name_ch3.value, " to image_set."
-
-        if self.ch4_active.value:
-            tmppath, tmpfile= os.path.split(self.filech4)
-            output_image_ch4 = cpi.Image(pixel_data_ch4, path_name=tmppath,file_name = tmpfile)
-            image_set.add(self.output_image_name_ch4.value, output_image_ch4)
-            workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,self.output_image_name_ch4.value)), tmpfile, can_overwrite=True)
-            workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,self.output_image_name_ch4.value)), tmppath, can_overwrite=True)
-            print "added ", self.output_image_name_ch4.value, " to image_set."
-
-        if self.ch5_active.value:
-            tmppath, tmpfile= os.path.split(self.filech5)
-            output_image_ch5 = cpi.Image(pixel_data_ch5, path_name=tmppath,file_name = tmpfile)
-            image_set.add(self.output_image_name_ch5.value, output_image_ch5)
-            workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,self.output_image_name_ch5.value)), tmpfile, can_overwrite=True)
-            workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,self.output_image_name_ch5.value)), tmppath, can_overwrite=True)
-            print "added ", self.output_image_name_ch5.value, " to image_set."
+        pixel_data = None
+        binning = BINNING_FACTORS[self.binning.value]
+        for channel, output_image_name in self.get_active_channels():
+            filename = base+"--C0"+str(int(channel.value)-1)+md['suffix']+".ome.tif"
+            if field is not None:
+                slices = field.slices(int(channel.value)-1)
+                if len(slices) > 0:
+                    # the last announced slice, whatever its Z index
+                    filename = slices[-1][1]
+                else:
+                    print "No planes announced for channel", channel.value, "- guessing file names"
+            else:
+                slices = []
+            print "Reading " + filename
+            stats = {F_READ: 0.0, F_PROJECTION: 0.0, C_BYTES_READ: 0}
+            channel_data, scale = read_stack(filename, slices, stats, int(channel.value)-1)
+            channel_data = convert_output(channel_data, scale)
+            if self.flatfield.value:
+                channel_data = self.correct_illumination(workspace, channel.value, output_image_name.value, channel_data)
+            tmppath, tmpfile= os.path.split(filename)
+            if keep_dtype:
+                # CellProfiler must not convert the image, the scale travels along with it
+                output_image = cpi.Image(channel_data, path_name=tmppath,file_name = tmpfile, scale=scale, convert=False)
+            elif pixel_data is None:
+                output_image = cpi.Image(channel_data, path_name=tmppath,file_name = tmpfile, scale=255)
+            else:
+                output_image = cpi.Image(channel_data, path_name=tmppath,file_name = tmpfile)
+            if pixel_data is None:
+                # first channel
+                pixel_data = channel_data
+                pixel_scale = scale
+                self.filech1 = filename
+            image_set.add(output_image_name.value, output_image)
+            if binning > 1:
+                # block average in one reshape-and-reduce, integer data keeps its type
+                binned_data = downsample(channel_data, binning)
+                if keep_dtype and binned_data.dtype != channel_data.dtype:
+                    binned_data = binned_data.astype(channel_data.dtype)
+                if keep_dtype:
+                    binned_image = cpi.Image(binned_data, scale=scale, convert=False)
+                else:
+                    binned_image = cpi.Image(binned_data)
+                image_set.add(output_image_name.value + self.binning_suffix.value, binned_image)
+            workspace.measurements.add_measurement("Image","_".join((C_FILE_NAME,output_image_name.value)), tmpfile, can_overwrite=True)
+            workspace.measurements.add_measurement("Image","_".join((C_PATH_NAME,output_image_name.value)), tmppath, can_overwrite=True)
+            print "added ", output_image_name.value, " to image_set."
+            workspace.measurements.add_measurement("Image","_".join((C_SCALING,output_image_name.value)), np.array(float(scale)), can_overwrite=True)
+            if filename in focus:
+                best_z, best_score = focus[filename]
+                workspace.measurements.add_measurement("Image","_".join((C_FOCUS, F_BEST_Z, output_image_name.value)), np.array(best_z), can_overwrite=True)
+                workspace.measurements.add_measurement("Image","_".join((C_FOCUS, F_SCORE, output_image_name.value)), np.array(best_score), can_overwrite=True)
+            workspace.measurements.add_measurement("Image","_".join((C_TIMING, F_READ, output_image_name.value)), np.array(stats[F_READ]), can_overwrite=True)
+            workspace.measurements.add_measurement("Image","_".join((C_TIMING, F_PROJECTION, output_image_name.value)), np.array(stats[F_PROJECTION]), can_overwrite=True)
+            workspace.measurements.add_measurement("Image","_".join((C_BYTES_READ, output_image_name.value)), np.array(stats[C_BYTES_READ]), can_overwrite=True)
+            print output_image_name.value, "read: %.3fs projection: %.3fs bytes: %d" % (stats[F_READ], stats[F_PROJECTION], stats[C_BYTES_READ])
+
+        workspace.measurements.add_measurement("Image","_".join((C_TIMING, F_WAIT_NOTIFICATION)), np.array(wait_notification), can_overwrite=True)
+        workspace.measurements.add_measurement("Image","_".join((C_TIMING, F_WAIT_FILE_READY)), np.array(wait_file_ready[0]), can_overwrite=True)
+
+        if binning > 1:
+            workspace.measurements.add_measurement("Image", "_".join((C_BINNING, F_FACTOR)), np.array(binning), can_overwrite=True)
+
+        if self.mosaic.value:
+            self.add_to_mosaic(workspace, md, pixel_data, pixel_scale)
+
+        if self.drift_estimator is not None:
+            self.measure_drift(workspace, md, pixel_data)
 
         width = pixel_data.shape[0]
         height = pixel_data.shape[1]
@@ -450,7 +1210,12 @@ class LCCwaitForImage(cpm.CPModule):
 
     def other_providers(self, group):
         if group == 'imagegroup':
-            return [self.output_image_name.value]
+            names = [self.output_image_name.value]
+            if self.binning.value != BINNING_NONE:
+                names += [output_image_name.value + self.binning_suffix.value for channel, output_image_name in self.get_active_channels()]
+            if self.mosaic.value:
+                names.append(self.mosaic_image_name.value)
+            return names
         return []
 
     def is_load_module(self):
@@ -460,7 +1225,11 @@ class LCCwaitForImage(cpm.CPModule):
         return True
 
     def post_run(self, workspace):
-        #
-        # No post-run needed
-        #
-        return
+        # the last image set has been analysed
+        self.close_readers()
+        self.close_replay()
+        if workspace.pipeline.test_mode:
+            return
+        if self.checkpoint_file is not None:
+            self.commit_field()
+            self.checkpoint_file.save(force=True)
@@ -0,0 +1,199 @@
+####################################################################
+#  CostModel
+#  Acquisition time model for the "LCC Module" suite
+#
+#  Learns how long the jobs of a CAM list take from the times the
+#  hires images are reported, so that a CAM list can be capped to
+#  a time budget.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCimageObject module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Acquisition cost model.
+
+The time a job of a CAM list takes is modelled as
+
+    job_time + move_time * (stage travel from the previous job)
+
+and a CAM list additionally takes overhead seconds from the startcamscan command to the
+start of its first job. A round is one CAM list: the time of the startcamscan command, the
+estimated stage positions of its jobs (see camlist_planner.job_positions) in the order they
+were sent, and the times at which the hires images were reported. Every job is assumed to
+produce the same number of images, in the order of the list, so the last image of a job marks
+its end. The parameters are fitted by least squares over the durations of all jobs of the
+recorded rounds.
+
+cap() drops the jobs with the highest rank (e.g. the worst ranked objects of a well, or the
+ones found last) until the estimated duration of the list fits a time budget.
+
+The rounds can be saved to a JSON file and loaded again, both to start a run with the
+parameters learned before and to replay a screen with simulate():
+
+    model = CostModel.load("costs.json")
+    for budget in (60, 120, 300):
+        print budget, simulate(model, budget, interval=600)
+
+or from the command line: python acquisition_cost.py costs.json --budget 60 120 300 --interval 600
+"""
+
+import json
+import os
+import numpy as np
+
+# used until enough jobs have been observed
+DEFAULT_JOB_TIME = 30.0 # seconds per job
+DEFAULT_MOVE_TIME = 0.0005 # seconds per um of stage travel
+DEFAULT_OVERHEAD = 5.0 # seconds per CAM list
+
+# minimum number of observed jobs before the parameters are fitted
+MIN_OBSERVATIONS = 3
+
+
+def path_length(positions):
+    """travel along positions (N x 2 array) in the given order"""
+    if len(positions) < 2:
+        return 0.0
+    return float(np.sqrt((np.diff(positions, axis=0) ** 2).sum(axis=1)).sum())
+
+
+class CostModel:
+    def __init__(self, job_time=DEFAULT_JOB_TIME, move_time=DEFAULT_MOVE_TIME, overhead=DEFAULT_OVERHEAD, max_rounds=200):
+        self.job_time = job_time
+        self.move_time = move_time
+        self.overhead = overhead
+        self.max_rounds = max_rounds
+        self.rounds = [] # dicts with start, positions, ranks and arrivals, see observe()
+
+    def observe(self, start, positions, ranks, arrivals):
+        """records a round and refits the model.
+        start - time of the startcamscan command
+        positions - N x 2 stage positions of the jobs, in the order they were sent
+        ranks - rank of each job (lower ranks are kept first by cap())
+        arrivals - times at which the hires images of the round were reported"""
+        self.rounds.append(dict(start=float(start),
+                                positions=np.asarray(positions, np.float64).reshape(-1, 2).tolist(),
+                                ranks=[int(r) for r in ranks],
+                                arrivals=sorted(float(t) for t in arrivals)))
+        del self.rounds[:-self.max_rounds]
+        self.fit()
+
+    def jobDurations(self, r):
+        """durations of the jobs of round r as (durations, travel from the previous job, is first job) arrays,
+        empty if there are fewer images than jobs"""
+        positions = np.asarray(r['positions'], np.float64).reshape(-1, 2)
+        arrivals = np.asarray(r['arrivals'], np.float64)
+        n = len(positions)
+        m = len(arrivals)
+        if n == 0 or m < n:
+            return np.empty(0), np.empty(0), np.empty(0)
+        # index of the last image of each job
+        last = (np.arange(1, n + 1) * m) // n - 1
+        ends = arrivals[last]
+        durations = np.diff(np.concatenate(([r['start']], ends)))
+        travel = np.zeros(n)
+        travel[1:] = np.sqrt((np.diff(positions, axis=0) ** 2).sum(axis=1))
+        first = np.zeros(n)
+        first[0] = 1
+        return durations, travel, first
+
+    def fit(self):
+        """least squares fit of job_time, move_time and overhead to the recorded rounds"""
+        parts = [self.jobDurations(r) for r in self.rounds]
+        durations = np.concatenate([p[0] for p in parts])
+        if len(durations) < MIN_OBSERVATIONS:
+            return
+        travel = np.concatenate([p[1] for p in parts])
+        first = np.concatenate([p[2] for p in parts])
+        A = np.column_stack((np.ones(len(durations)), travel, first))
+        params = np.linalg.lstsq(A, durations, rcond=-1)[0]
+        # travel (or a first job) may not vary in the observations, negative times make no sense
+        self.job_time, self.move_time, self.overhead = [max(float(p), 0.0) for p in params]
+
+    def estimate(self, positions):
+        """estimated duration in seconds of a CAM list with jobs at positions (N x 2), in that order"""
+        if len(positions) == 0:
+            return 0.0
+        return self.overhead + len(positions) * self.job_time + self.move_time * path_length(positions)
+
+    def cap(self, positions, ranks, budget):
+        """indices of the jobs to keep, in their original order, so that the estimated duration fits the budget.
+        Jobs with the highest rank are dropped first, the later job first among jobs of the same rank."""
+        positions = np.asarray(positions, np.float64).reshape(-1, 2)
+        keep = range(len(positions))
+        # drop order: highest rank first, later jobs first
+        drop = sorted(keep, key=lambda k: (ranks[k], k), reverse=True)
+        while len(keep) > 0 and self.estimate(positions[keep]) > budget:
+            keep.remove(drop.pop(0))
+        return keep
+
+    def save(self, filename):
+        """writes the parameters and the recorded rounds to a JSON file"""
+        tmpname = filename + ".tmp"
+        f = open(tmpname, 'w')
+        try:
+            json.dump(dict(job_time=self.job_time, move_time=self.move_time, overhead=self.overhead, rounds=self.rounds), f)
+        finally:
+            f.close()
+        if os.path.exists(filename):
+            os.remove(filename) # os.rename doesn't replace files on Windows
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """a model with the parameters and rounds saved by save()"""
+        f = open(filename)
+        try:
+            d = json.load(f)
+        finally:
+            f.close()
+        model = cls(d.get('job_time', DEFAULT_JOB_TIME), d.get('move_time', DEFAULT_MOVE_TIME), d.get('overhead', DEFAULT_OVERHEAD))
+        model.rounds = d.get('rounds', [])
+        return model
+
+
+def simulate(model, budget, interval=0):
+    """replays the rounds recorded in model with a time budget per round (0 = no limit).
+    Returns a dict with the number of rounds, jobs, jobs kept, the total estimated acquisition time and the
+    number of rounds whose estimated duration exceeds interval (if interval > 0)."""
+    result = dict(rounds=0, jobs=0, kept=0, time=0.0, overruns=0)
+    for r in model.rounds:
+        positions = np.asarray(r['positions'], np.float64).reshape(-1, 2)
+        if budget > 0:
+            keep = model.cap(positions, r['ranks'], budget)
+        else:
+            keep = range(len(positions))
+        duration = model.estimate(positions[keep])
+        result['rounds'] += 1
+        result['jobs'] += len(positions)
+        result['kept'] += len(keep)
+        result['time'] += duration
+        if interval > 0 and duration > interval:
+            result['overruns'] += 1
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Replays the CAM lists recorded by LCCimageObject with different time budgets")
+    parser.add_argument("filename", help="cost model file written by LCCimageObject")
+    parser.add_argument("--budget", type=float, nargs="+", default=[0], help="time budgets per CAM list in seconds (0 = no limit)")
+    parser.add_argument("--interval", type=float, default=0, help="time-lapse interval in seconds, for counting overruns")
+    args = parser.parse_args()
+    model = CostModel.load(args.filename)
+    model.fit()
+    print "job time %.1f s, move time %.5f s/um, overhead %.1f s, %d rounds" % (model.job_time, model.move_time, model.overhead, len(model.rounds))
+    print "budget\tjobs\tkept\ttime\toverruns"
+    for budget in args.budget:
+        r = simulate(model, budget, args.interval)
+        print "%g\t%d\t%d\t%.0f\t%d" % (budget, r['jobs'], r['kept'], r['time'], r['overruns'])
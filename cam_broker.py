@@ -0,0 +1,247 @@
+####################################################################
+#  CAMBroker
+#  Shared CAM server connection for the "LCC Module" suite
+#
+#  Owns the connection to the Leica CAM server and shares it between
+#  several processes, e.g. CellProfiler analysis workers.
+#
+######################################################################
+#
+#  NOTE: this is a stand-alone program, the LCC modules use it when
+#        "Connect through CAM broker" is ticked in LCConnect.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+CAM broker.
+
+With CellProfiler's multiprocess analysis every worker would open its own connection to
+the CAM server, and the workers would take each other's image notifications. The broker owns
+the only connection:
+
+* a reader thread receives the notifications and puts the images into the job queues of its
+  CAMcommunicator (see CAMcommunicator.waitforimage()),
+* every worker process connects to the broker over a local multiprocessing connection, and
+  each image is handed to exactly one of the workers waiting for its job. Workers waiting for
+  complete fields (see CAMcommunicator.waitforfieldFromBroker()) get all planes of a field: the
+  broker collects the planes in a FieldIndex and hands out each complete (or timed out) field
+  to exactly one worker,
+* commands of the workers are sent one request at a time, a batch of commands (e.g. deleting
+  the CAM list, adding the jobs and starting the CAM scan, see CAMcommunicator.beginCommands())
+  is sent without commands of other workers in between.
+
+Workers can't clear the broker's image queues, they hold the images the other workers are
+waiting for. Restart the broker to start from empty queues.
+
+Only file names and metadata travel between the processes. The workers read the pixel data
+from the image files themselves, all of them share the operating system's file cache.
+
+Start the broker before the analysis, on the computer running CellProfiler:
+
+    python cam_broker.py --ip 10.11.112.16 --basepath Z:\\MatrixExportFolder
+"""
+
+import socket
+import select
+import threading
+import time
+from multiprocessing.connection import Listener
+
+import cam_communicator_class as cc
+from field_index import FieldIndex
+
+
+class CAMBroker:
+    def __init__(self, camc, address=('localhost', cc.BROKER_PORT)):
+        self.camc = camc
+        self.address = address
+        self.socket_lock = threading.Lock() # sending and receiving on the CAM server connection
+        self.images = threading.Condition() # the image queues of camc, notified when images arrive
+        self.field_indices = {} # (jobnr, jobname, nr_of_slices, channels, timeout) -> FieldIndex, see do_waitforfield()
+        self.running = False
+
+    def serve_forever(self):
+        """connects to the CAM server and serves workers until interrupted"""
+        self.camc.open()
+        self.running = True
+        reader = threading.Thread(target=self.read_notifications)
+        reader.daemon = True
+        reader.start()
+        listener = Listener(self.address, authkey=cc.BROKER_AUTHKEY)
+        print "CAM broker listening on", self.address
+        try:
+            while True:
+                conn = listener.accept()
+                print "Worker connected"
+                worker = threading.Thread(target=self.serve_worker, args=(conn,))
+                worker.daemon = True
+                worker.start()
+        finally:
+            self.running = False
+            listener.close()
+            self.camc.close()
+
+    def read_notifications(self):
+        """receives the CAM server's notifications and queues the reported images"""
+        camc = self.camc
+        while self.running:
+            if not camc.isConnected():
+                time.sleep(1)
+                self.socket_lock.acquire()
+                try:
+                    print "Reconnecting to CAM server"
+                    camc.open()
+                finally:
+                    self.socket_lock.release()
+                continue
+            # wait without the lock, so commands can be sent in the meantime
+            try:
+                readable = select.select([camc.leicasocket], [], [], camc.poll_interval)[0]
+            except (select.error, socket.error), e:
+                print "Error waiting for CAM server:", e
+                camc.connected = False
+                continue
+            if not readable:
+                continue
+            self.socket_lock.acquire()
+            try:
+                msgs = camc.readandparseCAM(deadline=time.time() + camc.poll_interval)
+            finally:
+                self.socket_lock.release()
+            if msgs:
+                self.images.acquire()
+                try:
+                    camc.queueImagesFromMessages(msgs)
+                    self.images.notify_all()
+                finally:
+                    self.images.release()
+
+    def serve_worker(self, conn):
+        """answers the requests (method name, arguments) of one worker with ("ok", result) or ("error", message)"""
+        try:
+            while True:
+                try:
+                    name, args = conn.recv()
+                except EOFError:
+                    break
+                method = getattr(self, "do_" + name, None)
+                if method is None:
+                    conn.send(("error", "unknown request " + name))
+                    continue
+                try:
+                    conn.send(("ok", method(*args)))
+                except Exception, e:
+                    conn.send(("error", repr(e)))
+        finally:
+            conn.close()
+            print "Worker disconnected"
+
+    def do_isConnected(self):
+        return self.camc.isConnected()
+
+    def do_waitforimage(self, jobnr, jobname, timeout, stopOnScanFinished):
+        """the oldest queued image of the job, waiting up to timeout seconds. Returns (image or None, scan finished)"""
+        deadline = time.time() + timeout
+        self.images.acquire()
+        try:
+            while True:
+                queued = self.camc.popQueuedImage(jobnr, jobname)
+                if queued is not None:
+                    return queued, self.camc.scan_finished
+                remaining = deadline - time.time()
+                if remaining <= 0 or (stopOnScanFinished and self.camc.scan_finished):
+                    return None, self.camc.scan_finished
+                self.images.wait(remaining)
+        finally:
+            self.images.release()
+
+    def do_waitforfield(self, jobnr, jobname, nr_of_slices, channels, field_timeout, timeout, stopOnScanFinished):
+        """the next complete (or timed out) field of the job, waiting up to timeout seconds. Returns (field or None, scan finished).
+        Once the scan has finished (and stopOnScanFinished is True), incomplete fields are handed out as well."""
+        deadline = time.time() + timeout
+        key = (jobnr, jobname, nr_of_slices, tuple(channels), field_timeout)
+        self.images.acquire()
+        try:
+            index = self.field_indices.get(key)
+            if index is None:
+                index = self.field_indices[key] = FieldIndex(nr_of_slices, channels, field_timeout)
+            while True:
+                while True:
+                    queued = self.camc.popQueuedImage(jobnr, jobname)
+                    if queued is None:
+                        break
+                    index.add(*queued)
+                field = index.popReady()
+                if field is not None:
+                    return field, self.camc.scan_finished
+                if stopOnScanFinished and self.camc.scan_finished:
+                    return index.popOldest(), True
+                now = time.time()
+                remaining = deadline - now
+                if remaining <= 0:
+                    return None, self.camc.scan_finished
+                field_deadline = index.nextDeadline()
+                if field_deadline is not None:
+                    remaining = max(0.01, min(remaining, field_deadline - now))
+                self.images.wait(remaining)
+        finally:
+            self.images.release()
+
+    def do_getQueuedImages(self, jobnr, jobname, excludeJobnr):
+        self.images.acquire()
+        try:
+            return self.camc.getQueuedImages(jobnr, jobname, excludeJobnr)
+        finally:
+            self.images.release()
+
+    def do_getImageArrivals(self, since, jobnr, jobname, excludeJobnr, fields):
+        self.images.acquire()
+        try:
+            return self.camc.getImageArrivals(since, jobnr, jobname, excludeJobnr, fields)
+        finally:
+            self.images.release()
+
+    def do_resetScanFinished(self):
+        self.camc.scan_finished = False
+
+    def do_sendCommands(self, cmds):
+        """sends the commands of one request without commands of other workers in between"""
+        self.socket_lock.acquire()
+        try:
+            # sendCMDstring() queues the images it finds in the receive buffer
+            self.images.acquire()
+            try:
+                for cmd in cmds:
+                    self.camc.sendCMDstring(cmd)
+                self.images.notify_all()
+            finally:
+                self.images.release()
+        finally:
+            self.socket_lock.release()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Shares one CAM server connection between several CellProfiler processes")
+    parser.add_argument("--ip", default=cc.iplocal, help="IP address of the CAM server")
+    parser.add_argument("--port", type=int, default=8895, help="port of the CAM server")
+    parser.add_argument("--sysid", default="0", help="Leica /sys value")
+    parser.add_argument("--basepath", default="", help="path to the exported images, as in LCConnect")
+    parser.add_argument("--listen", type=int, default=cc.BROKER_PORT, help="local port the workers connect to")
+    args = parser.parse_args()
+    camc = cc.CAMcommunicator()
+    camc.setIP(args.ip)
+    camc.port = args.port
+    camc.setSysID(args.sysid)
+    camc.basepath = args.basepath
+    try:
+        CAMBroker(camc, ('localhost', args.listen)).serve_forever()
+    except KeyboardInterrupt:
+        print "CAM broker stopped"
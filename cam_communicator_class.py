@@ -67,6 +67,9 @@ TODO:
 """ 
 
 import socket
+import select
+import errno
+import threading
 import time
 import sys
 import os
@@ -79,11 +82,17 @@ try:
 except:
     nolayoutmodule=True
 import re
+import collections
+from multiprocessing.connection import Client
 
 iplocal = "127.0.0.1"
 ipSP5A = "10.11.112.16" # these are convenient shorthands for internal use
 ipSP5B = "10.11.112.18" 
 
+# the broker (see cam_broker.py) listens on this port of the local host
+BROKER_PORT = 8896
+BROKER_AUTHKEY = "LCC broker"
+
 
 class CAMcommunicator:
     def __init__(self):
@@ -106,7 +115,19 @@ class CAMcommunicator:
         self.cmdlist = [] # CAM command list
         self.previous_file = ""
         self.previous_cmd = ""
+        self.scan_finished = False # set when the CAM server reports inf:scanfinished
+        self.image_queues = {} # per job queues of reported images, see waitforimage()
+        self.image_sequence = 0
+        self.max_queued_images = 10000 # per job, oldest images are dropped beyond this
+        self.image_log = collections.deque(maxlen=self.max_queued_images) # (arrival time, job, jobname, field) of every reported image
+        self.offline_cmdfile = None # if set, commands are written to this file instead of the CAM server
+        self.poll_interval = 0.2 # waits check for cancellation, stopcallback and deadlines at least this often (seconds)
+        self.cancel_event = threading.Event() # set by cancel(), see readandparseCAM()
+        self.broker_address = None # if set, the CAM server is reached through the broker at this address, see setBroker()
+        self.broker = None # connection to the broker
+        self.broker_lock = threading.Lock()
         self.stage_settle_time = 6.5
+        self.command_batch = None # commands collected between beginCommands() and endCommands()
         sequence_counter=0
 
     def setSysID(self, newsysID):
@@ -129,12 +150,75 @@ class CAMcommunicator:
 
 
 
+    def setOfflineCommandFile(self, filename):
+        """Offline mode, e.g. for replaying an export folder without a microscope. All commands are appended to
+        filename instead of being sent to the CAM server, open()/close() don't touch the network.
+        Pass None to switch back to the CAM server."""
+        if filename is not None and self.leicasocket is not None:
+            self.close()
+        self.offline_cmdfile = filename
+        self.connected = False
+
+    def setBroker(self, address):
+        """Talk to the CAM server through a broker process (see cam_broker.py) at address, e.g. ('localhost', BROKER_PORT),
+        which owns the connection to the CAM server. Several processes (e.g. CellProfiler analysis workers) can share the
+        broker: each reported image is handed to exactly one of them, and commands are sent one process at a time.
+        Pass None to talk to the CAM server directly."""
+        if address == self.broker_address:
+            return
+        if self.connected:
+            self.close()
+        self.broker_address = address
+
+    def isBrokered(self):
+        return self.broker_address is not None and not self.isOffline()
+
+    def brokerCall(self, name, *args):
+        """calls method name of the broker, returns its result or None if the broker couldn't be reached"""
+        self.broker_lock.acquire()
+        try:
+            try:
+                if self.broker is None:
+                    self.broker = Client(self.broker_address, authkey=BROKER_AUTHKEY)
+                self.broker.send((name, args))
+                status, result = self.broker.recv()
+            except (IOError, EOFError), e:
+                print "Error talking to CAM broker at", self.broker_address, e
+                self.broker = None
+                self.connected = False
+                return None
+        finally:
+            self.broker_lock.release()
+        if status != "ok":
+            print "CAM broker error in", name + ":", result
+            return None
+        return result
+
+    def resetScanFinished(self):
+        """forget about an inf:scanfinished reported before, e.g. at the start of a run"""
+        self.scan_finished = False
+        if self.isBrokered():
+            self.brokerCall("resetScanFinished")
+
+    def isOffline(self):
+        return self.offline_cmdfile is not None
+
     def printSettings(self):
         print "CAMCommunicator settings"
         print "not yet implemented"
 
     def open(self):
         """Open connection to CAM server. Returns True if successful, False otherwise"""
+        if self.isOffline():
+            if self.verbose:
+                print "Offline, writing CAM commands to", self.offline_cmdfile
+            self.connected=True
+            return True
+        if self.isBrokered():
+            self.connected = self.brokerCall("isConnected") is not None
+            if self.verbose:
+                print "Using CAM broker at", self.broker_address, ("failed", "connected")[self.connected]
+            return self.connected
         try:
             if self.verbose:
                 print "Trying to open connection to Leica at ",self.IP_address,":",str(self.port)
@@ -152,6 +236,15 @@ class CAMcommunicator:
 
     def close(self):
         """ Close connection to CAM server. Returns True if successful, False otherwise"""
+        if self.isOffline():
+            self.connected=False
+            return True
+        if self.broker is not None:
+            # the broker keeps its connection to the CAM server
+            self.broker.close()
+            self.broker = None
+            self.connected = False
+            return True
         if self.verbose:
             print "Disconnecting from ", self.IP_address
         if self.leicasocket is not None:
@@ -163,18 +256,45 @@ class CAMcommunicator:
                 print "Error closing connection. Did you pass in the correct socket object ?"
                 return False
 
+    def cancel(self):
+        """Cancels the current and all further waits for the CAM server until resetCancel() is called. Can be called from any
+        thread, the waiting thread returns within poll_interval seconds and closes the connection."""
+        self.cancel_event.set()
+
+    def resetCancel(self):
+        self.cancel_event.clear()
+
+    def isCancelled(self):
+        return self.cancel_event.is_set()
+
     def isConnected(self):
         """ returns true if connected to a CAM server, false otherwise. This does not actually test the connectivity, it simply
         returns a flag that is modified by the open() and close() methods. If the connection has been dropped by the server or
         lost due to a network error this function will not give the proper result"""
         return self.connected
     
-    def flushCAMreceivebuffer(self):
-        """ reads and discards all data waiting at socket """
+    def flushCAMreceivebuffer(self, keepImages=False):
+        """ reads and discards all data waiting at socket. If keepImages is True, image notifications
+        contained in the data are put into the image queues instead of being discarded.
+        Through a broker nothing is discarded: the broker reads the socket itself and its image queues are shared
+        with the other workers, see clearImageQueues()."""
+        if self.isBrokered():
+            return
         self.leicasocket.setblocking(False)
         try:
             while(True):
-                self.leicasocket.recv(self.buffersize)
+                fromCAMServer = self.leicasocket.recv(self.buffersize)
+                if not fromCAMServer:
+                    break
+                if keepImages:
+                    msgs = []
+                    for line in fromCAMServer.splitlines():
+                        try:
+                            msgs.append(self.parseCAMcmd(line))
+                        except ValueError:
+                            # incomplete line at the end of the buffer
+                            pass
+                    self.queueImagesFromMessages(msgs)
         except:
             pass
 
@@ -231,31 +351,203 @@ class CAMcommunicator:
             pass
 
 
-    def waitforimage(self,jobnr=None, jobname=None, ignoreduplicates = True, timeout=None, stopcallback=None, processGUIEvents=None): # timeeout option ?
+    ###############################################
+    #  receiving and demultiplexing image notifications
+    ###############################################
+
+    # default Leica CAM module file name pattern, e.g.
+    # image--L0003--S00--U00--V00--J07--E00--O00--X00--Y00--T0003--Z00--C01.ome.tif
+    re_pattern = "(?P<Prefix>.*)(?P<Loop>--[Ll][0-9]*)(?P<Slide>--S[0-9]*)(?P<U>--[Uu][0-9]*)(?P<V>--[Vv][0-9]*)(?P<Job>--J[0-9]*)(?P<E>--[Ee].*)(?P<O>--O.*)(?P<X>--[Xx][0-9]*)(?P<Y>--[Yy][0-9]*)(?P<T>--[Tt][0-9]*)(?P<Zpos>--[Zz][0-9]*)(?P<Channel>--[Cc][0-9]*)(?P<Suffix>.*)(\.ome.tif$)"
+    # on some systems, the file name includes an additional --M field, in this case we need to use a different regular
+    # expressen
+    re_pattern_m = """(?P<Prefix>.*)(?P<Loop>--[Ll][0-9]*)(?P<Slide>--S[0-9]*)(?P<M>--[Mm][0-9]*)(?P<U>--[Uu][0-9]*)(?P<V>--[Vv][0-9]*)(?P<Job>--J[0-9]*)(?P<E>--[Ee].*)(?P<O>--O.*)(?P<X>--[Xx][0-9]*)(?P<Y>--[Yy][0-9]*)(?P<T>--[Tt][0-9]*)(?P<Zpos>--[Zz][0-9]*)(?P<Channel>--[Cc][0-9]*)(?P<Suffix>.*)\.ome.tif$"""
+
+    def parseLeicaFilename(self, fname):
+        """extracts the metadata fields from a Matrix Screener file name. Returns a dict or None if the file name doesn't match the pattern.
+        Each field keeps its '--' prefix (e.g. metadata['job'] is '--J07') so that file names can be reassembled from the fields."""
+        # TODO: check whether filename contains the substring CAM and use different re pattern if necessary
+        if ("--m" in fname) or ("--M" in fname):
+            pattern = self.re_pattern_m
+            withM = True
+        else:
+            pattern = self.re_pattern
+            withM = False
+        re_m = re.match(pattern, fname)
+        if re_m is None:
+            return None
+        metadata = {}
+        metadata['prefix'] = (re_m.group('Prefix'))
+        metadata['loop'] = (re_m.group('Loop'))
+        metadata['slide'] = (re_m.group('Slide'))
+        if withM:
+            metadata['M'] = (re_m.group('M'))
+        else:
+            metadata['M'] = ''
+        metadata['U'] = (re_m.group('U'))
+        metadata['V'] = (re_m.group('V'))
+        metadata['job'] = (re_m.group('Job'))
+        metadata['E'] = (re_m.group('E'))
+        metadata['other'] = (re_m.group('O'))
+        metadata['X'] = (re_m.group('X'))
+        metadata['Y'] = (re_m.group('Y'))
+        metadata['tpoint'] = (re_m.group('T'))
+        metadata['zpos'] = (re_m.group('Zpos'))
+        metadata['channel'] = (re_m.group('Channel'))
+        metadata['suffix'] = (re_m.group('Suffix'))
+        return metadata
+
+    def jobKey(self, jobnr):
+        """key of the image queue for job number jobnr, e.g. 'J07'"""
+        return "J" + str(jobnr).zfill(2)
+
+    def queueImage(self, fname, metadata, jobname=None):
+        """puts a newly reported image into the queue of its job"""
+        key = metadata['job'][2:].upper()
+        queue = self.image_queues.setdefault(key, collections.deque())
+        if len(queue) >= self.max_queued_images:
+            dropped = queue.popleft()
+            print "Warning: more than", self.max_queued_images, "unclaimed images for job", key, "- dropping", dropped[2]
+        now = time.time()
+        queue.append((self.image_sequence, now, fname, metadata, jobname))
+        self.image_log.append((now, key, jobname, self.imageField(metadata)))
+        self.image_sequence += 1
+
+    def imageField(self, metadata):
+        """(slide, U, V, X, Y) indices of an image as integers"""
+        return tuple(int(metadata[name][3:] or 0) for name in ('slide', 'U', 'V', 'X', 'Y'))
+
+    def getImageArrivals(self, since=0, jobnr=None, jobname=None, excludeJobnr=None, fields=None):
+        """arrival times of the images reported after the time since, whether or not they have been taken from the queues.
+        Only images of job number jobnr and/or job name jobname are included if these are not None, images of job
+        excludeJobnr are left out. If fields is not None, only images of these fields (see imageField()) are included."""
+        if self.isBrokered():
+            return self.brokerCall("getImageArrivals", since, jobnr, jobname, excludeJobnr, fields) or []
+        key = None if jobnr is None else self.jobKey(jobnr)
+        exclude = None if excludeJobnr is None else self.jobKey(excludeJobnr)
+        if fields is not None:
+            fields = set(tuple(field) for field in fields)
+        return [t for t, entry_key, entry_jobname, entry_field in self.image_log
+                if t > since and (key is None or entry_key == key) and entry_key != exclude and
+                (jobname is None or (entry_jobname is not None and entry_jobname.lower() == jobname.lower())) and
+                (fields is None or entry_field in fields)]
+
+    def queueImagesFromMessages(self, msgs, ignoreduplicates=True):
+        """goes through parsed CAM messages in the order they were received and queues all newly reported images.
+        Returns the number of queued images."""
+        nr_queued = 0
+        for m in msgs:
+            if m.get('inf') == "scanfinished":
+                self.scan_finished = True
+            if 'relpath' not in m.keys():
+                continue
+            #fname = self.basepath + os.sep + m['relpath'].replace("\\",os.sep)
+            fname = self.basepath + m['relpath'].replace("\\",os.sep)
+            if ignoreduplicates and fname == self.previous_file:
+                print "Ignoring Duplicate! Cam server reported file twice."
+                continue
+            self.previous_file = fname # workaround as some files are reported twice
+            print "New file " + fname
+            metadata = self.parseLeicaFilename(fname)
+            if metadata is None:
+                print "Error  extracting metadata from filename ", fname
+                continue
+            self.queueImage(fname, metadata, m.get('jobname'))
+            nr_queued += 1
+        return nr_queued
+
+    def _queuedEntries(self, jobnr=None, jobname=None, excludeJobnr=None):
+        """generator over (queue, entry) for all queued images matching the criteria"""
+        if jobnr is not None:
+            keys = [self.jobKey(jobnr)]
+        else:
+            keys = self.image_queues.keys()
+        if excludeJobnr is not None and self.jobKey(excludeJobnr) in keys:
+            keys.remove(self.jobKey(excludeJobnr))
+        for key in keys:
+            queue = self.image_queues.get(key)
+            if queue is None:
+                continue
+            for entry in queue:
+                entry_jobname = entry[4]
+                if jobname is None or (entry_jobname is not None and entry_jobname.lower() == jobname.lower()):
+                    yield queue, entry
+
+    def popQueuedImage(self, jobnr=None, jobname=None):
+        """removes the oldest queued image matching jobnr and jobname (if not None) from its queue.
+        Returns (fullfilename, metadata) or None if no matching image has been received."""
+        oldest = None
+        for queue, entry in self._queuedEntries(jobnr, jobname):
+            if oldest is None or entry[0] < oldest[1][0]:
+                oldest = (queue, entry)
+        if oldest is None:
+            return None
+        queue, entry = oldest
+        queue.remove(entry)
+        return entry[2], entry[3]
+
+    def getQueuedImages(self, jobnr=None, jobname=None, excludeJobnr=None):
+        """removes all queued images matching the criteria from their queues and returns them in the order they were
+        received as a list of tuples (arrival time, fullfilename, metadata, jobname)"""
+        if self.isBrokered():
+            return self.brokerCall("getQueuedImages", jobnr, jobname, excludeJobnr) or []
+        matches = list(self._queuedEntries(jobnr, jobname, excludeJobnr))
+        for queue, entry in matches:
+            queue.remove(entry)
+        matches.sort(key=lambda qe: qe[1][0])
+        return [(entry[1], entry[2], entry[3], entry[4]) for queue, entry in matches]
+
+    def clearImageQueues(self):
+        """discards all queued image notifications.
+        Through a broker only this process' (empty) queues are cleared, the broker's queues also hold the images other
+        workers are waiting for. Restart the broker to start from empty queues."""
+        self.image_queues = {}
+
+    def waitforimage(self,jobnr=None, jobname=None, ignoreduplicates = True, timeout=None, stopcallback=None, processGUIEvents=None, stopOnScanFinished=False): # timeeout option ?
         """Waits for an image from the CAM server.
         Sometimes matrix screener will notify us about an image twice. If ignoreduplicates is True, such duplicates will be ignored on the second notification.
         If jobnr is not None, images which do not match the job number are ignored.
         If jobname is not None, images which do not match the job name are ignored.
         If both jobnr and jobname are not None both have to match.
+        If timeout is not None, the function returns None if no matching image was received within timeout seconds.
+        If stopOnScanFinished is True, the function returns None once the CAM server has reported inf:scanfinished
+        (self.scan_finished is set in any case, reset it to False before starting a new scan).
+
+        Images that don't match the criteria are not discarded: every reported image is put into a queue for its job
+        (the J field of the file name), and the next call of waitforimage() or popQueuedImage()/getQueuedImages() for that
+        job returns it. Images are returned in the order they were reported, each image exactly once.
+
+        Through a broker, the broker hands each image to only one of the processes waiting for it.
 
         the function returns a tuple (fullfilename, metadata)
 
         fullfilename is the full path assembled from self.basepath and the relpath given by the CAM server. Path separators are adjusted to match the operating system,
         backslashes on Windows, forward slashes on Mac/Unix.
-        metadata is a dict of metadata fields extracted from the filename (TODO- Test with CAM images)
+        metadata is a dict of metadata fields extracted from the filename, see parseLeicaFilename()
         """
 
-        re_pattern = "(?P<Prefix>.*)(?P<Loop>--[Ll][0-9]*)(?P<Slide>--S[0-9]*)(?P<U>--[Uu][0-9]*)(?P<V>--[Vv][0-9]*)(?P<Job>--J[0-9]*)(?P<E>--[Ee].*)(?P<O>--O.*)(?P<X>--[Xx][0-9]*)(?P<Y>--[Yy][0-9]*)(?P<T>--[Tt][0-9]*)(?P<Zpos>--[Zz][0-9]*)(?P<Channel>--[Cc][0-9]*)(?P<Suffix>.*)(\.ome.tif$)"
-        # on some systems, the file name includes an additional --M field, in this case we need to use a different regular
-        # expressen
-        re_pattern_m = """(?P<Prefix>.*)(?P<Loop>--[Ll][0-9]*)(?P<Slide>--S[0-9]*)(?P<M>--[Mm][0-9]*)(?P<U>--[Uu][0-9]*)(?P<V>--[Vv][0-9]*)(?P<Job>--J[0-9]*)(?P<E>--[Ee].*)(?P<O>--O.*)(?P<X>--[Xx][0-9]*)(?P<Y>--[Yy][0-9]*)(?P<T>--[Tt][0-9]*)(?P<Zpos>--[Zz][0-9]*)(?P<Channel>--[Cc][0-9]*)(?P<Suffix>.*)\.ome.tif$"""
-
+        if self.isBrokered():
+            return self.waitforimageFromBroker(jobnr, jobname, timeout, stopcallback, processGUIEvents, stopOnScanFinished)
         try:
             starttime = time.time()
+            if timeout is not None:
+                deadline = starttime + timeout
+            else:
+                deadline = None
             while True:
+                if self.isCancelled():
+                    print "Waiting for image cancelled"
+                    return None
+                # images may already have been received together with images of other jobs
+                queued = self.popQueuedImage(jobnr, jobname)
+                if queued is not None:
+                    print "file matches selection criteria. breaking out of loop"
+                    return queued
                 if timeout is not None:
                     if time.time()-starttime > timeout:
                         return None
+                if stopOnScanFinished and self.scan_finished:
+                    print "Scan finished, not waiting for further images"
+                    return None
                 if  processGUIEvents is not None:
                     processGUIEvents()
                 if stopcallback is not None:
@@ -263,77 +555,13 @@ class CAMcommunicator:
                         return None
                     
 
-                msgs=self.readandparseCAM(stopcallback=stopcallback, processGUIEvents=processGUIEvents)
+                msgs=self.readandparseCAM(stopcallback=stopcallback, processGUIEvents=processGUIEvents, deadline=deadline)
                 # when timed out msgs will be None. Need to make sure this is not the case
                 if msgs is not None: 
-                    metadata = {}
-                    if jobnr is not None:
-                        jobstr = "J" + str(jobnr).zfill(2)
-                    else:
-                        jobstr = ""
-
-                    # go through messages in reverse order
-                    #
-                    # WARNING: if several images were received this function will only return the last one as we analyze the different
-                    # messages from the CAM server in reverse order.
-                    #
-                    # For our purposes this is good enough but be aware of the limitation
-
-                    # TODO sometimes msgs appear to be None
-
-                    msgs.reverse()
-                    for m in msgs:
-                        if 'relpath' in m.keys():
-                            #print m['relpath']
-                            #fname = self.basepath + os.sep + m['relpath'].replace("\\",os.sep)
-                            fname = self.basepath + m['relpath'].replace("\\",os.sep)
-                            if ignoreduplicates is False or fname != self.previous_file:
-                                self.previous_file = fname # workaround as some files are reported twice
-                                print "New file " + fname
-                                # TODO: check whether filename contains the substring CAM and use different re pattern if necessary
-                                if ("--m" in fname) or ("--M" in fname):
-                                    pattern = re_pattern_m
-                                    withM = True
-                                    print("filename contains --M")
-                                else:
-                                    pattern = re_pattern
-                                    withM = False
-                                    print("regular filename")
-                                re_m = re.match(pattern, fname)
-                                if re_m is not None:
-                                    metadata['prefix'] = (re_m.group('Prefix'))
-                                    metadata['loop'] = (re_m.group('Loop'))
-                                    metadata['slide'] = (re_m.group('Slide'))
-                                    if withM:
-                                        metadata['M'] = (re_m.group('M'))
-                                    else:
-                                        metadata['M'] = ''
-                                    metadata['U'] = (re_m.group('U'))
-                                    metadata['V'] = (re_m.group('V'))
-                                    metadata['job'] = (re_m.group('Job'))
-                                    metadata['E'] = (re_m.group('E'))
-                                    metadata['other'] = (re_m.group('O'))
-                                    metadata['X'] = (re_m.group('X'))
-                                    metadata['Y'] = (re_m.group('Y'))
-                                    metadata['tpoint'] = (re_m.group('T'))
-                                    metadata['zpos'] = (re_m.group('Zpos'))
-                                    metadata['channel'] = (re_m.group('Channel'))
-                                    metadata['suffix'] = (re_m.group('Suffix'))
-                                else:
-                                    print "Error  extracting metadata from filename ", fname
-                                    raise
-
-                                if jobname is None or ('jobname' in m.keys() and m['jobname'].lower()==jobname.lower()):
-                                    if jobstr in metadata['job']:
-                                        # our job matches all criteria
-                                        print "file matches selection criteria. breaking out of loop"
-                                        return (fname, metadata)
-                                    else:
-                                        print "job number is different from requested"
-                                else:
-                                    print "job name does not match required name"
-                            else:
-                                print "Ignoring Duplicate! Cam server reported file twice."
+                    self.queueImagesFromMessages(msgs, ignoreduplicates)
+                elif not self.connected:
+                    # the CAM server closed the connection, nothing more will arrive
+                    return None
         except:
             print "Unexpected error:", sys.exc_info()
             # TODO ... make sure we actually catch the correct exception
@@ -341,29 +569,122 @@ class CAMcommunicator:
             
 
                                                 
-    def readandparseCAM(self, stopcallback=None, processGUIEvents=None):
+    def waitforimageFromBroker(self, jobnr, jobname, timeout, stopcallback, processGUIEvents, stopOnScanFinished):
+        """waitforimage() through the broker, which is asked in slices of poll_interval seconds so the wait stays cancellable"""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        while True:
+            if self.isCancelled():
+                print "Waiting for image cancelled"
+                return None
+            if stopcallback is not None and not stopcallback():
+                return None
+            if processGUIEvents is not None:
+                processGUIEvents()
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return None
+            result = self.brokerCall("waitforimage", jobnr, jobname, wait, stopOnScanFinished)
+            if result is None:
+                return None
+            response, self.scan_finished = result
+            if response is not None:
+                print "New file " + response[0]
+                return response
+            if stopOnScanFinished and self.scan_finished:
+                print "Scan finished, not waiting for further images"
+                return None
+
+    def waitforfieldFromBroker(self, jobnr, nr_of_slices, channels, field_timeout, timeout=None, stopcallback=None, processGUIEvents=None, stopOnScanFinished=False):
+        """Waits for a complete field of job jobnr through the broker, which collects the planes of all fields (see
+        field_index.FieldIndex with nr_of_slices, channels and field_timeout) and hands each field to exactly one worker.
+        Returns a field_index.Field, an incomplete one if it timed out or the scan finished (stopOnScanFinished), or None
+        if no field was ready within timeout seconds or the wait was cancelled."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        else:
+            deadline = None
+        while True:
+            if self.isCancelled():
+                print "Waiting for field cancelled"
+                return None
+            if stopcallback is not None and not stopcallback():
+                return None
+            if processGUIEvents is not None:
+                processGUIEvents()
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return None
+            result = self.brokerCall("waitforfield", jobnr, None, nr_of_slices, list(channels), field_timeout, wait, stopOnScanFinished)
+            if result is None:
+                return None
+            field, self.scan_finished = result
+            if field is not None:
+                print "New field " + field.filename
+                return field
+            if stopOnScanFinished and self.scan_finished:
+                print "Scan finished, not waiting for further fields"
+                return None
+
+    def readandparseCAM(self, stopcallback=None, processGUIEvents=None, deadline=None):
         """ reads pending (or waits for incoming until timeout) CAM responses from the server.
-        The responses are parsed into python dictionaries and a list with the parsed responses (each list entry is a dictionary) is returned. """
+        The responses are parsed into python dictionaries and a list with the parsed responses (each list entry is a dictionary) is returned.
+        The socket is polled with select() in slices of poll_interval seconds. In between, stopcallback and processGUIEvents are
+        called and cancel() is checked, so a wait can be stopped at any time. Returns None if nothing was received within
+        self.timeout seconds or before deadline (a time.time() value), if stopcallback returns False or if the wait was cancelled.
+        A cancelled wait closes the connection, so the socket is free for the next run. A connection that was closed or reset
+        by the CAM server is closed as well, isConnected() is False afterwards."""
         assert self.leicasocket is not None
         self.leicasocket.setblocking(True)
-        self.leicasocket.settimeout(self.timeout)
-        try:
-            while True:
-                if stopcallback is not None:
-                    if not stopcallback():
-                        return None
-                if  processGUIEvents is not None:
-                    processGUIEvents()
+        end = time.time() + self.timeout
+        if deadline is not None:
+            end = min(end, deadline)
+        while True:
+            if self.isCancelled():
+                print "Waiting for CAM server cancelled, closing connection"
+                self.close()
+                return None
+            if stopcallback is not None:
+                if not stopcallback():
+                    return None
+            if  processGUIEvents is not None:
+                processGUIEvents()
+            remaining = end - time.time()
+            if remaining <= 0:
+                if deadline is None:
+                    print("Didn't receive anything from CAM Server for " + str(self.timeout) + " seconds. Timed out.") 
+                return None
+            try:
+                readable = select.select([self.leicasocket], [], [], min(self.poll_interval, remaining))[0]
+                if not readable:
+                    continue
                 fromCAMServer=self.leicasocket.recv(self.buffersize)
-                lines=fromCAMServer.splitlines()
-                responses = []
-                for line in lines:
-                    parsed = self.parseCAMcmd(line)
-                    responses.append(parsed)
-                return(responses)
-        except:
-            print("Didn't receive anything from CAM Server for " + str(self.timeout) + " seconds. Timed out.") 
-            return None
+            except (select.error, socket.error), e:
+                if e.args and e.args[0] == errno.EINTR:
+                    # interrupted by a signal, e.g. the daemon's SIGTERM handler, the socket is fine
+                    continue
+                print "Error receiving from CAM server:", e, "- closing connection"
+                self.close()
+                self.connected = False
+                return None
+            if not fromCAMServer:
+                print "CAM server closed the connection"
+                self.close()
+                self.connected = False
+                return None
+            responses = []
+            for line in fromCAMServer.splitlines():
+                try:
+                    responses.append(self.parseCAMcmd(line))
+                except ValueError:
+                    print "Could not parse CAM server message", line
+            return(responses)
 
 
     #############################################################################
@@ -526,8 +847,8 @@ class CAMcommunicator:
         self.sendCMDstring("/cli:python /app:matrix /cmd:stopwaitingforcam")
 
     def waitForScanToFinish(self):
-        """"loop indefinitely until we receive scanfinished"""
-        while True:
+        """"loop indefinitely until we receive scanfinished (or the wait is cancelled)"""
+        while not self.isCancelled():
             answers = self.readandparseCAM()
             if answers is not None:
                 for a in answers:
@@ -566,12 +887,39 @@ class CAMcommunicator:
         f.close()
         return True
 
+    def beginCommands(self):
+        """Through a broker, the commands sent until endCommands() (e.g. deleting the CAM list, adding jobs and starting the
+        CAM scan) are sent together, without commands of other processes in between. Without a broker they are sent immediately."""
+        self.command_batch = []
+
+    def endCommands(self):
+        batch = self.command_batch
+        self.command_batch = None
+        if batch:
+            self.sendToBroker(batch)
+
+    def sendToBroker(self, cmds):
+        if self.command_batch is not None:
+            self.command_batch += cmds
+        else:
+            self.brokerCall("sendCommands", cmds)
+
     def sendCMDlist(self):
         """ This function sends each string in cmdlist to the CAMserver.
         A delay between successive commands can be specified  in self.delay (default is 0.2s).
         Line endings are fixed to be Windows-compatible, i.e. CR+LF.
-        After successful completion the list is emptied""" 
+        After successful completion the list is emptied.
+        In offline mode the commands are appended to self.offline_cmdfile instead.""" 
 
+        if self.cmdlist and self.isOffline():
+            f = open(self.offline_cmdfile, 'ab')
+            try:
+                for cmd in self.cmdlist:
+                    f.write(self.FixLineEndingsForWindows(cmd))
+            finally:
+                f.close()
+            self.emptyCMDlist()
+            return True
         if self.cmdlist:
             for cmd in self.cmdlist:
                 try:
@@ -592,7 +940,15 @@ class CAMcommunicator:
     def sendCMDstring(self, cmdstr, seq_counter=False):
         """Sends cmdstr to the leica. Internally the CMDlist is emptied, the string is added and the list is cleared"""
         
-        self.flushCAMreceivebuffer() # TODO ... can we really flush here ?
+        if self.isBrokered():
+            cmds = [cmdstr]
+            if seq_counter:
+                cmds.append("/cli:python /app:external /name:disambiguation /cmd:seq /par1:"+str(self.sequence_counter))
+                self.sequence_counter +=1
+            self.sendToBroker(cmds)
+            return
+        if not self.isOffline():
+            self.flushCAMreceivebuffer(keepImages=True) # TODO ... can we really flush here ? image notifications are kept
         self.emptyCMDlist()
         self.addtoCMDlist(cmdstr)
 
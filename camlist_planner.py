@@ -0,0 +1,286 @@
+####################################################################
+#  camlist_planner
+#  Selection of the objects to be imaged for the "LCC Module" suite
+#
+#  Helpers for LCCimageObject that decide which objects end up on
+#  the CAM list.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCimageObject module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+CAM list planning.
+
+TopKSelector keeps the K best objects per well (or any other key) over all fields of the
+well. Each field's candidates are first reduced to its K best with numpy.argpartition, which
+is linear in the number of objects, and then merged into a bounded min-heap per well, so the
+worst kept object can be replaced in O(log K). If a well is popped before it is done (e.g. after
+a deadline), the objects found later compete for the remaining K - (objects popped) places only.
+
+cluster_points() merges objects that fit into one hires field of view, so that they are
+imaged by a single job.
+
+order_jobs() reorders the pending jobs so that the stage travels a short path between them.
+
+JobAccumulator holds jobs back over several image sets, so that the microscope switches between
+the lowres and the hires job less often. The jobs are released when enough jobs or fields have
+been collected, when the group (e.g. the well or the time point) of the image sets changes or
+when the oldest job has waited long enough.
+"""
+
+import heapq
+import time
+import numpy as np
+
+
+class TopKSelector:
+    def __init__(self, k, largest=True):
+        """k - number of objects to keep per key
+        largest - keep the objects with the largest scores if True, the smallest otherwise"""
+        self.k = k
+        self.largest = largest
+        self.heaps = {} # key -> min-heap of (score, sequence number, item), heap[0] is the worst object kept
+        self.first_seen = {} # key -> time the first candidate was added
+        self.submitted = {} # key -> number of items popped before the key was done, see pop()
+        self.sequence = 0
+
+    def addField(self, key, scores, items):
+        """adds the candidates of one field. scores is an array with one score per item, NaN scores rank last."""
+        k = self.k - self.submitted.get(key, 0)
+        if k <= 0 or len(items) == 0:
+            return
+        scores = np.asarray(scores, np.float64)
+        if not self.largest:
+            scores = -scores
+        scores = np.where(np.isnan(scores), -np.inf, scores)
+        n = len(scores)
+        if n > k:
+            # the k largest scores of this field, in no particular order
+            best = np.argpartition(scores, n - k)[n - k:]
+        else:
+            best = np.arange(n)
+        heap = self.heaps.setdefault(key, [])
+        self.first_seen.setdefault(key, time.time())
+        for i in best:
+            entry = (scores[i], self.sequence, items[i])
+            self.sequence += 1
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry[0] > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    def keys(self):
+        """the keys with candidates, or with items popped before they were done"""
+        return list(set(self.heaps.keys()) | set(self.submitted.keys()))
+
+    def age(self, key):
+        """seconds since the first candidate for key was added (since it was last popped), 0 if there is none"""
+        if key not in self.first_seen:
+            return 0.0
+        return time.time() - self.first_seen[key]
+
+    def pop(self, key, done=True):
+        """removes key and returns its selected items, best first. If done is False, further candidates for key
+        are expected: the number of items returned is remembered and counts against k for them."""
+        heap = self.heaps.pop(key, [])
+        self.first_seen.pop(key, None)
+        if done:
+            self.submitted.pop(key, None)
+        else:
+            self.submitted[key] = self.submitted.get(key, 0) + len(heap)
+        # the sequence number breaks ties, so the items themselves are never compared
+        heap.sort(reverse=True)
+        return [item for score, sequence, item in heap]
+
+    def state(self):
+        """the candidates kept so far as a JSON serializable dict, see restore()"""
+        return dict(heaps=self.heaps, first_seen=self.first_seen, submitted=self.submitted, sequence=self.sequence)
+
+    def restore(self, state):
+        # JSON turns the heap entries into lists, which don't compare like tuples
+        self.heaps = dict((key, [tuple(entry) for entry in heap]) for key, heap in state['heaps'].items())
+        self.first_seen = dict(state['first_seen'])
+        self.submitted = dict(state['submitted'])
+        self.sequence = state['sequence']
+
+
+def cluster_points(x, y, width, height):
+    """Groups points into clusters that fit into a width x height field of view, e.g. a hires field in lowres pixels.
+    Greedy: points are visited in order of y, x and each unassigned point starts a new cluster, which takes up all
+    unassigned points from the neighbouring grid cells that keep its bounding box within width x height.
+    Neighbours are found with a grid hash of cell size width x height, so only the 3 x 3 cells around a point
+    are searched. Returns (labels, centres): labels[i] is the cluster of point i (0-based), centres is a list of
+    the (x, y) bounding box centres of the clusters."""
+    x = np.asarray(x, np.float64)
+    y = np.asarray(y, np.float64)
+    n = len(x)
+    labels = -np.ones(n, int)
+    centres = []
+    if n == 0:
+        return labels, centres
+    cx = np.floor(x / width).astype(int)
+    cy = np.floor(y / height).astype(int)
+    grid = {}
+    for i in range(n):
+        grid.setdefault((cx[i], cy[i]), []).append(i)
+    for seed in np.lexsort((x, y)):
+        if labels[seed] >= 0:
+            continue
+        label = len(centres)
+        labels[seed] = label
+        xmin = xmax = x[seed]
+        ymin = ymax = y[seed]
+        neighbours = []
+        for gx in (cx[seed] - 1, cx[seed], cx[seed] + 1):
+            for gy in (cy[seed] - 1, cy[seed], cy[seed] + 1):
+                neighbours.extend(grid.get((gx, gy), []))
+        # closest first, so that a cluster grows around its seed
+        neighbours.sort(key=lambda j: (x[j] - x[seed]) ** 2 + (y[j] - y[seed]) ** 2)
+        for j in neighbours:
+            if labels[j] >= 0:
+                continue
+            if max(xmax, x[j]) - min(xmin, x[j]) <= width and max(ymax, y[j]) - min(ymin, y[j]) <= height:
+                labels[j] = label
+                xmin, xmax = min(xmin, x[j]), max(xmax, x[j])
+                ymin, ymax = min(ymin, y[j]), max(ymax, y[j])
+        centres.append(((xmin + xmax) / 2.0, (ymin + ymax) / 2.0))
+    return labels, centres
+
+
+def job_positions(jobs, well_pitch, field_pitch, pixel_size):
+    """approximate stage positions (x, y) of CAM list jobs (dicts with the arguments of CAMcommunicator.addJobToCAMlist)
+    from their well and field indices and pixel offsets. Returns an N x 2 array in the unit of the pitches."""
+    positions = np.empty((len(jobs), 2), np.float64)
+    for i, job in enumerate(jobs):
+        positions[i, 0] = (int(job['wellx']) - 1) * well_pitch + (int(job['fieldx']) - 1) * field_pitch + int(job['dxpos']) * pixel_size
+        positions[i, 1] = (int(job['welly']) - 1) * well_pitch + (int(job['fieldy']) - 1) * field_pitch + int(job['dypos']) * pixel_size
+    return positions
+
+
+def job_field(job):
+    """the (slide, U, V, X, Y) indices in the file names of the images of a CAM list job, see CAMcommunicator.imageField()"""
+    return (int(job['slide']) - 1, int(job['wellx']) - 1, int(job['welly']) - 1, int(job['fieldx']) - 1, int(job['fieldy']) - 1)
+
+
+def order_positions(positions, max_iterations=50):
+    """Orders positions for a short path through all of them, starting at the first one: a nearest neighbour
+    path improved by 2-opt moves (reversing a section of the path if that shortens it).
+    The distances are computed as one matrix, and all 2-opt moves from one edge are evaluated at once.
+    Returns the order as an array of indices."""
+    n = len(positions)
+    if n <= 2:
+        return np.arange(n)
+    diff = positions[:, None, :] - positions[None, :, :]
+    dist = np.sqrt((diff ** 2).sum(axis=2))
+
+    # nearest neighbour path
+    order = np.empty(n, int)
+    visited = np.zeros(n, bool)
+    current = 0
+    for k in range(n):
+        order[k] = current
+        visited[current] = True
+        if k < n - 1:
+            d = np.where(visited, np.inf, dist[current])
+            current = int(np.argmin(d))
+
+    # 2-opt on the open path: reversing order[i+1..j] replaces edges (a,b) and (c,d) by (a,c) and (b,d)
+    for iteration in range(max_iterations):
+        improved = False
+        for i in range(n - 2):
+            a, b = order[i], order[i + 1]
+            j = np.arange(i + 2, n)
+            c = order[j]
+            gain = dist[a, b] - dist[a, c]
+            inner = j < n - 1
+            d = order[j[inner] + 1]
+            gain[inner] += dist[c[inner], d] - dist[b, d]
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                jbest = j[best]
+                order[i + 1:jbest + 1] = order[i + 1:jbest + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def order_jobs(jobs, well_pitch, field_pitch, pixel_size):
+    """reorders CAM list jobs to shorten the stage travel between them. Jobs of different slides are not mixed,
+    slides are visited in the order in which their first job appears."""
+    slides = []
+    by_slide = {}
+    for job in jobs:
+        if job['slide'] not in by_slide:
+            slides.append(job['slide'])
+        by_slide.setdefault(job['slide'], []).append(job)
+    ordered = []
+    for slide in slides:
+        slide_jobs = by_slide[slide]
+        order = order_positions(job_positions(slide_jobs, well_pitch, field_pitch, pixel_size))
+        ordered += [slide_jobs[k] for k in order]
+    return ordered
+
+
+class JobAccumulator:
+    def __init__(self, max_jobs=0, max_fields=0, max_age=0):
+        """max_jobs - release the jobs once there are this many (0 = no limit)
+        max_fields - release the jobs after this many image sets (0 = no limit)
+        max_age - release the jobs once the oldest one has waited this many seconds (0 = no limit)"""
+        self.max_jobs = max_jobs
+        self.max_fields = max_fields
+        self.max_age = max_age
+        self.jobs = []
+        self.fields = 0 # image sets since the jobs were last released
+        self.group = None # group of the last image set
+        self.since = None # time the oldest job held back was added
+
+    def add(self, jobs, group=None):
+        """adds the jobs of one image set. If the group differs from that of the previous image set, the jobs held back
+        are released before the new ones are added. Returns the released jobs, in the order in which they were added,
+        or None if the jobs are held back."""
+        due = None
+        if group is not None and self.group is not None and group != self.group:
+            due = self.flush()
+        self.group = group
+        if len(jobs) > 0 and self.since is None:
+            self.since = time.time()
+        self.jobs += jobs
+        self.fields += 1
+        if ((self.max_jobs > 0 and len(self.jobs) >= self.max_jobs) or
+            (self.max_fields > 0 and self.fields >= self.max_fields) or
+            (self.max_age > 0 and self.since is not None and time.time() - self.since >= self.max_age)):
+            due = (due or []) + self.flush()
+        return due
+
+    def flush(self):
+        """releases and returns all jobs held back"""
+        jobs = self.jobs
+        self.jobs = []
+        self.fields = 0
+        self.since = None
+        return jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def state(self):
+        """the jobs held back as a JSON serializable dict, see restore()"""
+        return dict(jobs=self.jobs, fields=self.fields, group=self.group, since=self.since)
+
+    def restore(self, state):
+        self.jobs = list(state['jobs'])
+        self.fields = state['fields']
+        # JSON turns tuples into lists, the group must compare equal to that of the next image set
+        self.group = tuple(state['group']) if isinstance(state['group'], list) else state['group']
+        self.since = state['since']
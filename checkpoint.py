@@ -0,0 +1,153 @@
+####################################################################
+#  Checkpoint
+#  Crash recovery for the "LCC Module" suite
+#
+#  Keeps the state of the feedback loop in a small file next to the
+#  export folder, so that a restarted run can carry on where the
+#  previous one stopped.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage and
+#        LCCimageObject modules.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Checkpoint.
+
+The state is a dict of sections, one per module (e.g. the fields LCCwaitForImage has
+processed, the object counts per well and the jobs LCCimageObject has sent or is holding
+back). Each section must be JSON serializable. Modules update their section with set()
+whenever their state changes, save() writes the whole state at most every interval seconds.
+
+The file is written to a temporary file first and then renamed, so a crash while saving
+leaves the previous checkpoint intact. os.rename() doesn't replace files on Windows, so the
+old file is removed first; load() falls back to the temporary file if the checkpoint itself
+is missing.
+
+LCCwaitForImage creates the checkpoint in prepare_run() and registers it with
+set_current_checkpoint(), LCCimageObject finds it with get_current_checkpoint().
+
+ProcessedFields records the fields analysed so far without growing over a long screen:
+only the keys of the latest timepoint are kept, all fields of earlier timepoints count
+as analysed once a later timepoint has started.
+"""
+
+import json
+import os
+import time
+
+CHECKPOINT_SUFFIX = ".lcc_checkpoint.json"
+
+
+def checkpoint_filename(basepath):
+    """the checkpoint file for an export folder, next to the folder. Raises ValueError if basepath is empty, which
+    would put the checkpoint into whatever the current directory happens to be."""
+    if basepath.strip() == "":
+        raise ValueError("no image base path, can't place the checkpoint file")
+    return os.path.normpath(basepath) + CHECKPOINT_SUFFIX
+
+
+class Checkpoint:
+    def __init__(self, filename, interval=30):
+        self.filename = filename
+        self.interval = interval
+        self.state = {} # section name -> JSON serializable state
+        self.last_save = 0
+        self.dirty = False
+
+    def load(self):
+        """reads the checkpoint file. Returns True if a checkpoint was found."""
+        for filename in (self.filename, self.filename + ".tmp"):
+            if not os.path.exists(filename):
+                continue
+            try:
+                f = open(filename)
+                try:
+                    self.state = json.load(f)
+                finally:
+                    f.close()
+                return True
+            except (IOError, ValueError), e:
+                print "Could not read checkpoint", filename, e
+        return False
+
+    def get(self, section, default=None):
+        return self.state.get(section, default)
+
+    def set(self, section, value):
+        self.state[section] = value
+        self.dirty = True
+
+    def save(self, force=False):
+        """writes the state if it changed and the last save is at least interval seconds ago (or force is True)"""
+        if not self.dirty or (not force and time.time() - self.last_save < self.interval):
+            return
+        tmpname = self.filename + ".tmp"
+        try:
+            f = open(tmpname, 'w')
+            try:
+                json.dump(self.state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError), e:
+            print "Could not write checkpoint", self.filename, e
+            return
+        self.last_save = time.time()
+        self.dirty = False
+
+
+class ProcessedFields:
+    def __init__(self):
+        self.timepoint = None # latest timepoint, see field_index.fieldTimepoint()
+        self.keys = set() # keys of the fields of that timepoint analysed so far
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, key, timepoint):
+        if self.timepoint is None:
+            return key in self.keys
+        return timepoint < self.timepoint or (timepoint == self.timepoint and key in self.keys)
+
+    def add(self, key, timepoint):
+        if self.timepoint is None or timepoint > self.timepoint:
+            if self.timepoint is not None:
+                # the previous timepoint is finished
+                self.keys = set()
+            self.timepoint = timepoint
+        self.keys.add(key)
+
+    def state(self):
+        return dict(timepoint=self.timepoint, keys=sorted(self.keys))
+
+    def restore(self, state):
+        """restores a state()"""
+        self.timepoint = tuple(state['timepoint']) if state['timepoint'] is not None else None
+        self.keys = set(state['keys'])
+
+
+# the checkpoint of the current run, see set_current_checkpoint()
+current_checkpoint = None
+
+
+def set_current_checkpoint(checkpoint):
+    global current_checkpoint
+    current_checkpoint = checkpoint
+
+
+def get_current_checkpoint():
+    return current_checkpoint
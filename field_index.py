@@ -0,0 +1,134 @@
+####################################################################
+#  FieldIndex
+#  Keeps track of the Z slices and channels received for each field
+#
+#  Used by LCCwaitForImage to hand a field to the pipeline only
+#  once all of its planes have been acquired.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Field index.
+
+Matrix Screener writes one file per Z slice and channel. The file names of all planes of a
+field only differ in the --Z and --C fields, so the file name without these two fields
+(the "field key") identifies the field.
+
+FieldIndex collects the planes announced by the CAM server per field key. A field is complete
+once all expected Z slices have been announced for all expected channels. Fields that don't
+complete within a timeout are handed out with the planes received so far.
+
+The metadata dictionaries are those returned by CAMcommunicator.parseLeicaFilename().
+"""
+
+import time
+
+
+def fieldKey(metadata):
+    """the reassembled file name without the Z and channel fields"""
+    md = metadata
+    return md['prefix']+md['loop']+md['slide']+md['M']+md['U']+md['V']+md['job']+md['E']+md['other']+md['X']+md['Y']+md['tpoint']+'|'+md['suffix']
+
+
+def fieldTimepoint(metadata):
+    """(loop, timepoint) of an image as integers, increases over the course of a screen"""
+    md = metadata
+    return int(md['loop'][3:] or 0), int(md['tpoint'][3:] or 0)
+
+
+class Field:
+    """all planes announced so far for one field"""
+    def __init__(self, key):
+        self.key = key
+        self.planes = {} # (z, c) -> filename
+        self.metadata = None # metadata of the plane with the highest Z index
+        self.filename = None # file name of the plane with the highest Z index
+        self.first_seen = time.time()
+        self.last_seen = self.first_seen
+
+    def add(self, filename, metadata):
+        z = int(metadata['zpos'][3:])
+        c = int(metadata['channel'][3:])
+        self.planes[(z, c)] = filename
+        if self.metadata is None or z >= int(self.metadata['zpos'][3:]):
+            self.metadata = metadata
+            self.filename = filename
+        self.last_seen = time.time()
+
+    def slices(self, c):
+        """list of (z, filename) of all announced slices of channel c, sorted by z"""
+        return sorted([(z, f) for (z, ch), f in self.planes.items() if ch == c])
+
+    def isComplete(self, nr_of_slices, channels):
+        for c in channels:
+            for z in range(nr_of_slices):
+                if (z, c) not in self.planes:
+                    return False
+        return True
+
+
+class FieldIndex:
+    def __init__(self, nr_of_slices=1, channels=(0,), timeout=60):
+        """nr_of_slices - number of Z slices expected per field
+        channels - channel indices (the number in the --C field) expected per field
+        timeout - seconds after the first plane of a field was announced after which the field is handed out anyway"""
+        self.nr_of_slices = nr_of_slices
+        self.channels = list(channels)
+        self.timeout = timeout
+        self.fields = {} # field key -> Field
+        self.ready = [] # complete fields in the order they were completed
+
+    def add(self, filename, metadata):
+        """records an announced plane. Returns True if this plane completed its field."""
+        key = fieldKey(metadata)
+        field = self.fields.get(key)
+        if field is None:
+            field = self.fields[key] = Field(key)
+        field.add(filename, metadata)
+        if field.isComplete(self.nr_of_slices, self.channels):
+            del self.fields[key]
+            self.ready.append(field)
+            return True
+        return False
+
+    def pending(self):
+        """number of fields that are incomplete"""
+        return len(self.fields)
+
+    def nextDeadline(self):
+        """time at which the oldest incomplete field times out, None if there is no incomplete field"""
+        if len(self.fields) == 0:
+            return None
+        return min([f.first_seen for f in self.fields.values()]) + self.timeout
+
+    def popReady(self):
+        """returns the next complete (or timed out) field, None if there is none"""
+        if len(self.ready) > 0:
+            return self.ready.pop(0)
+        now = time.time()
+        expired = [f for f in self.fields.values() if now - f.first_seen > self.timeout]
+        if len(expired) > 0:
+            return self.popOldest()
+        return None
+
+    def popOldest(self):
+        """returns the oldest field even if it is incomplete, e.g. at the end of the experiment"""
+        if len(self.ready) > 0:
+            return self.ready.pop(0)
+        if len(self.fields) == 0:
+            return None
+        field = min(self.fields.values(), key=lambda f: f.first_seen)
+        del self.fields[field.key]
+        print "Field incomplete, only", len(field.planes), "planes received:", field.key
+        return field
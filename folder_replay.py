@@ -0,0 +1,162 @@
+####################################################################
+#  FolderReplay
+#  Offline replay of a Matrix Screener export folder
+#
+#  Used by LCCwaitForImage to feed the images of a finished screen
+#  to the pipeline without a CAM server.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Folder replay.
+
+scan() walks the export folder once, parses every Leica file name and groups the planes
+into fields with the same field key that FieldIndex uses (the file name without the Z and C
+fields, i.e. T, slide, U, V, X, Y, job, ...). The fields are ordered by acquisition time, taken
+from the modification time of their first plane, and kept for the whole run, so the folder is
+never listed again.
+
+Reading from a network share is dominated by latency. prefetch() reads the files of the
+next few fields in background threads, so that they are in the operating system's file cache
+by the time the pipeline gets to them. The data read by the prefetch threads is discarded.
+close() stops the prefetch threads at the end of the run.
+
+Usage:
+
+    replay = FolderReplay(basepath, CAMC.parseLeicaFilename, jobnr=7)
+    replay.scan()
+    for i in range(len(replay)):
+        replay.prefetch(i, 4)
+        field = replay.field(i)
+    replay.close()
+"""
+
+import os
+import threading
+import Queue
+
+from field_index import Field, fieldKey
+
+IMAGE_SUFFIX = ".ome.tif"
+PREFETCH_THREADS = 2
+PREFETCH_CHUNK = 1 << 20
+
+
+def warmFile(filename):
+    """reads a file and discards the data, so that the next read is served from the file cache"""
+    try:
+        f = open(filename, 'rb')
+        try:
+            while f.read(PREFETCH_CHUNK):
+                pass
+        finally:
+            f.close()
+    except IOError, e:
+        print "Prefetch failed for", filename, e
+
+
+class FolderReplay:
+    def __init__(self, basepath, parse, jobnr=None):
+        """basepath - the data exporter folder to replay
+        parse - function returning the metadata dict of a file name, or None, e.g. CAMcommunicator.parseLeicaFilename
+        jobnr - only replay images of this job. If None, the job of the first acquired image is used"""
+        self.basepath = basepath
+        self.parse = parse
+        self.jobnr = jobnr
+        self.fields = []
+        self.prefetched = -1 # index of the last field handed to the prefetch threads
+        self.prefetch_queue = None
+        self.prefetch_threads = []
+
+    def scan(self):
+        """lists the folder and groups the planes into fields. Returns the number of fields."""
+        fields = {}
+        nr_of_planes = 0
+        for dirpath, dirnames, filenames in os.walk(self.basepath):
+            dirnames.sort()
+            for name in filenames:
+                if not name.endswith(IMAGE_SUFFIX):
+                    continue
+                fname = os.path.join(dirpath, name)
+                metadata = self.parse(fname)
+                if metadata is None:
+                    continue
+                key = fieldKey(metadata)
+                field = fields.get(key)
+                if field is None:
+                    field = fields[key] = Field(key)
+                    field.acquired = None
+                field.add(fname, metadata)
+                mtime = os.path.getmtime(fname)
+                if field.acquired is None or mtime < field.acquired:
+                    field.acquired = mtime
+                nr_of_planes += 1
+
+        # acquisition order, the key makes the order reproducible for files with the same time stamp
+        fields = sorted(fields.values(), key=lambda f: (f.acquired, f.key))
+        if self.jobnr is None and len(fields) > 0:
+            self.jobnr = int(fields[0].metadata['job'][3:])
+            print "Job of interest is J" + str(self.jobnr).zfill(2)
+        self.fields = [f for f in fields if int(f.metadata['job'][3:]) == self.jobnr]
+        print "Found", nr_of_planes, "planes,", len(self.fields), "fields of job", self.jobnr, "in", self.basepath
+        return len(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def field(self, index):
+        """the field with the given acquisition order index"""
+        return self.fields[index]
+
+    def prefetch(self, index, count):
+        """reads the files of the count fields following index in the background"""
+        if count <= 0:
+            return
+        if self.prefetch_queue is None:
+            self.prefetch_queue = Queue.Queue()
+            for i in range(PREFETCH_THREADS):
+                t = threading.Thread(target=self._prefetchWorker, args=(self.prefetch_queue,))
+                t.daemon = True
+                t.start()
+                self.prefetch_threads.append(t)
+        last = min(index + count, len(self.fields) - 1)
+        for i in range(max(index + 1, self.prefetched + 1), last + 1):
+            for fname in sorted(self.fields[i].planes.values()):
+                self.prefetch_queue.put(fname)
+        self.prefetched = max(self.prefetched, last)
+
+    def close(self, timeout=5):
+        """drops the files not prefetched yet and stops the prefetch threads. A file that is being read when
+        close() is called is finished first, threads still reading it after timeout seconds are left behind."""
+        if self.prefetch_queue is None:
+            return
+        try:
+            while True:
+                self.prefetch_queue.get_nowait()
+        except Queue.Empty:
+            pass
+        for t in self.prefetch_threads:
+            self.prefetch_queue.put(None)
+        for t in self.prefetch_threads:
+            t.join(timeout)
+        self.prefetch_queue = None
+        self.prefetch_threads = []
+        self.prefetched = -1
+
+    def _prefetchWorker(self, queue):
+        while True:
+            fname = queue.get()
+            if fname is None:
+                return
+            warmFile(fname)
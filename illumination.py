@@ -0,0 +1,128 @@
+####################################################################
+#  RunningFlatField
+#  Online illumination correction for the "LCC Module" suite
+#
+#  Maintains a flat-field estimate per channel from the fields
+#  analysed so far, so images can be corrected without a second
+#  pass over the plate.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Running flat-field model.
+
+Every field is block averaged (downsampled) and stored in a ring buffer holding the last
+history fields, so memory is bounded by history * (downsampled field size). The illumination
+function is the pixel-wise median over the ring buffer, normalized to a mean of 1 and
+interpolated back to full resolution. Objects move from field to field while the illumination
+pattern doesn't, so with enough fields the median only keeps the illumination pattern.
+
+The full resolution correction is cached and only recomputed every update_interval fields.
+No correction is applied until min_images fields have been seen.
+
+Usage:
+
+    ff = RunningFlatField(factor=16, history=50)
+    ff.add(img)
+    corrected = ff.apply(img)
+"""
+
+import numpy as np
+
+from image_registration import downsample
+
+# the illumination function is clipped to this fraction of its mean to avoid amplifying empty regions
+MIN_ILLUMINATION = 0.05
+
+
+def upsample_linear(small, shape, factor):
+    """bilinear interpolation of the block averages in small to an image of the given shape,
+    block i covers pixels i*factor ... (i+1)*factor-1"""
+    def weights(n_out, n_in):
+        pos = (np.arange(n_out) + 0.5) / factor - 0.5
+        pos = np.clip(pos, 0, n_in - 1)
+        i0 = np.floor(pos).astype(int)
+        i1 = np.minimum(i0 + 1, n_in - 1)
+        return i0, i1, (pos - i0).astype(np.float32)
+    r0, r1, wr = weights(shape[0], small.shape[0])
+    c0, c1, wc = weights(shape[1], small.shape[1])
+    rows = small[r0] * (1 - wr)[:, None] + small[r1] * wr[:, None]
+    return rows[:, c0] * (1 - wc)[None, :] + rows[:, c1] * wc[None, :]
+
+
+class RunningFlatField:
+    def __init__(self, factor=16, history=50, min_images=10, update_interval=5):
+        self.factor = factor
+        self.history = history
+        self.min_images = min_images
+        self.update_interval = update_interval
+        self.buffer = None # ring buffer of downsampled fields
+        self.shape = None # full resolution shape
+        self.count = 0 # number of fields added in total
+        self.correction = None # cached full resolution illumination function
+        self.correction_count = 0 # number of fields the cached correction is based on
+
+    def reset(self):
+        self.buffer = None
+        self.shape = None
+        self.count = 0
+        self.correction = None
+        self.correction_count = 0
+
+    def add(self, img):
+        """adds a field to the model"""
+        if self.shape != img.shape:
+            # e.g. a different scan format, start over
+            self.reset()
+            self.shape = img.shape
+        small = downsample(img, self.factor)
+        if self.buffer is None:
+            self.buffer = np.empty((self.history,) + small.shape, np.float32)
+        self.buffer[self.count % self.history] = small
+        self.count += 1
+
+    def nrOfImages(self):
+        """number of fields the current model is based on"""
+        return min(self.count, self.history)
+
+    def illumination(self):
+        """the full resolution illumination function (mean 1), or None if there are too few fields"""
+        if self.count < self.min_images or self.buffer is None:
+            return None
+        if self.correction is None or self.count - self.correction_count >= self.update_interval:
+            small = np.median(self.buffer[:self.nrOfImages()], axis=0)
+            mean = small.mean()
+            if mean <= 0:
+                return None
+            small /= mean
+            np.maximum(small, MIN_ILLUMINATION, out=small)
+            self.correction = upsample_linear(small, self.shape, self.factor).astype(np.float32)
+            self.correction_count = self.count
+        return self.correction
+
+    def apply(self, img):
+        """returns img divided by the illumination function. Floating point images that own their data are corrected in place,
+        integer images keep their data type (clipped to its range). Returns img unchanged if there are too few fields."""
+        illum = self.illumination()
+        if illum is None or illum.shape != img.shape:
+            return img
+        if img.dtype.kind == 'f':
+            if img.flags.owndata and img.flags.writeable:
+                img /= illum
+                return img
+            return img / illum
+        info = np.iinfo(img.dtype)
+        corrected = img / illum
+        np.clip(corrected, info.min, info.max, out=corrected)
+        return corrected.astype(img.dtype)
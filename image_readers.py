@@ -0,0 +1,318 @@
+####################################################################
+#  image_readers
+#  Image file readers for the "LCC Module" suite
+#
+#  Reads single image planes written by the Leica Matrix Screener
+#  data exporter.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Image readers.
+
+Matrix Screener exports every plane as an uncompressed, single-plane .ome.tif file.
+For such files we don't need bioformats (and the JVM): read_tiff_plane() parses the
+first IFD of the file and memory-maps the pixel data as a numpy view, so reading a
+plane costs one small header read and the page faults for the pixels actually used.
+
+Anything the native reader does not understand (compression, tiles, multiple planes,
+BigTIFF, RGB, ...) raises UnsupportedTiffError and load_plane() falls back to
+bioformats.
+
+Both readers return a tuple (pixel data, scale), where scale is the maximum intensity
+of the pixel type, as load_using_bioformats(..., rescale=False, wants_max_intensity=True) does.
+
+bioformats is only imported when the first file is read with it, so importing this module
+(e.g. when CellProfiler builds its module list, or in a worker that only reads native
+TIFFs) doesn't pull in the Java bridge. preload_bioformats() imports it in a background
+thread instead, e.g. while the pipeline prepares the run.
+
+BioformatsReaderPool keeps a bounded number of bioformats readers open, one per field, so
+a new Java reader isn't created (and its file format detected) for every plane. Matrix
+Screener writes one file per Z slice and channel: the field's reader is pointed at the next
+file with setId(), which still parses that file's header. If the OME-XML of the first file
+describes all files of the field, its reader reads the other Z slices and channels by index
+instead, without opening their files at all.
+"""
+
+import collections
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+# cellprofiler.modules.loadimages.load_using_bioformats, imported on first use, see bioformats_loader()
+_load_using_bioformats = None
+_bioformats_lock = threading.Lock()
+
+# number of bioformats readers kept open by default, see BioformatsReaderPool
+BIOFORMATS_POOL_SIZE = 8
+
+# how long to wait for an announced file to show up, see wait_for_file()
+FILE_READY_TIMEOUT = 10
+FILE_READY_INTERVAL = 0.05
+
+# TIFF tags we need
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_ROWS_PER_STRIP = 278
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_TILE_OFFSETS = 324
+TAG_SAMPLE_FORMAT = 339
+
+# TIFF field types we can decode: type -> (struct format, size in bytes)
+TIFF_TYPES = {1: ('B', 1),   # BYTE
+              3: ('H', 2),   # SHORT
+              4: ('I', 4),   # LONG
+              6: ('b', 1),   # SBYTE
+              8: ('h', 2),   # SSHORT
+              9: ('i', 4)}   # SLONG
+
+# (sample format, bits per sample) -> numpy type and scale as reported by bioformats
+SAMPLE_FORMAT_UINT = 1
+SAMPLE_FORMAT_INT = 2
+SAMPLE_FORMAT_FLOAT = 3
+PIXEL_TYPES = {(SAMPLE_FORMAT_UINT, 8): ('u1', 255),
+               (SAMPLE_FORMAT_UINT, 16): ('u2', 65535),
+               (SAMPLE_FORMAT_UINT, 32): ('u4', 4294967295),
+               (SAMPLE_FORMAT_INT, 8): ('i1', 127),
+               (SAMPLE_FORMAT_INT, 16): ('i2', 32767),
+               (SAMPLE_FORMAT_INT, 32): ('i4', 2147483647),
+               (SAMPLE_FORMAT_FLOAT, 32): ('f4', 1),
+               (SAMPLE_FORMAT_FLOAT, 64): ('f8', 1)}
+
+
+class UnsupportedTiffError(Exception):
+    """raised by the native reader for files it can't handle, the caller should fall back to bioformats"""
+    pass
+
+
+def unpack(fmt, data):
+    """struct.unpack that reports truncated files as UnsupportedTiffError"""
+    try:
+        return struct.unpack(fmt, data)
+    except struct.error:
+        raise UnsupportedTiffError("truncated TIFF")
+
+
+def read_tiff_layout(filename):
+    """Parses the first IFD of an uncompressed single-plane TIFF file.
+    Returns a tuple (byte offset of pixel data, shape, numpy dtype, scale).
+    Raises UnsupportedTiffError if the pixel data can't be memory-mapped directly,
+    including files that are truncated or malformed in ways the parser doesn't expect."""
+    try:
+        return parse_tiff_layout(filename)
+    except (struct.error, IndexError, ValueError, OverflowError, MemoryError), e:
+        raise UnsupportedTiffError("malformed TIFF (" + repr(e) + ")")
+
+
+def parse_tiff_layout(filename):
+    """read_tiff_layout() without turning unexpected parse errors into UnsupportedTiffError"""
+    filesize = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    try:
+        header = f.read(8)
+        if len(header) < 8:
+            raise UnsupportedTiffError("file too short")
+        if header[:2] == b'II':
+            bo = '<'
+        elif header[:2] == b'MM':
+            bo = '>'
+        else:
+            raise UnsupportedTiffError("not a TIFF file")
+        magic, ifd_offset = unpack(bo + 'HI', header[2:8])
+        if magic != 42:
+            # 43 is BigTIFF
+            raise UnsupportedTiffError("unsupported TIFF version " + str(magic))
+
+        f.seek(ifd_offset)
+        nentries, = unpack(bo + 'H', f.read(2))
+        entries = f.read(12 * nentries)
+        if len(entries) != 12 * nentries:
+            raise UnsupportedTiffError("truncated IFD")
+        next_ifd, = unpack(bo + 'I', f.read(4))
+        if next_ifd != 0:
+            raise UnsupportedTiffError("more than one plane in file")
+
+        tags = {}
+        for i in range(nentries):
+            tag, typ, count = unpack(bo + 'HHI', entries[12*i:12*i+8])
+            if typ not in TIFF_TYPES:
+                # we don't need any of the ASCII/RATIONAL/... tags
+                continue
+            fmt, size = TIFF_TYPES[typ]
+            if count * size > filesize:
+                raise UnsupportedTiffError("tag value larger than the file")
+            if count * size <= 4:
+                values = unpack(bo + fmt * count, entries[12*i+8:12*i+8+count*size])
+            else:
+                value_offset, = unpack(bo + 'I', entries[12*i+8:12*i+12])
+                f.seek(value_offset)
+                values = unpack(bo + fmt * count, f.read(count * size))
+            tags[tag] = values
+    finally:
+        f.close()
+
+    if TAG_TILE_OFFSETS in tags:
+        raise UnsupportedTiffError("tiled TIFF")
+    if tags.get(TAG_COMPRESSION, (1,))[0] != 1:
+        raise UnsupportedTiffError("compressed TIFF")
+    if tags.get(TAG_SAMPLES_PER_PIXEL, (1,))[0] != 1:
+        raise UnsupportedTiffError("more than one sample per pixel")
+    try:
+        width = tags[TAG_IMAGE_WIDTH][0]
+        height = tags[TAG_IMAGE_LENGTH][0]
+        offsets = tags[TAG_STRIP_OFFSETS]
+        counts = tags[TAG_STRIP_BYTE_COUNTS]
+    except (KeyError, IndexError):
+        raise UnsupportedTiffError("required TIFF tag missing")
+    if len(offsets) == 0 or len(offsets) != len(counts):
+        raise UnsupportedTiffError("invalid strip tags")
+    bits = tags.get(TAG_BITS_PER_SAMPLE, (1,))[0]
+    sample_format = tags.get(TAG_SAMPLE_FORMAT, (SAMPLE_FORMAT_UINT,))[0]
+    if (sample_format, bits) not in PIXEL_TYPES:
+        raise UnsupportedTiffError("unsupported pixel type")
+    typestr, scale = PIXEL_TYPES[(sample_format, bits)]
+    dtype = np.dtype(bo + typestr)
+
+    # the strips have to form one contiguous block to be mapped as a single array
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i-1] + counts[i-1]:
+            raise UnsupportedTiffError("strips are not contiguous")
+    if sum(counts) < width * height * dtype.itemsize:
+        raise UnsupportedTiffError("strip data shorter than image")
+    if offsets[0] + width * height * dtype.itemsize > filesize:
+        raise UnsupportedTiffError("file is incomplete")
+    return offsets[0], (height, width), dtype, scale
+
+
+def read_tiff_plane(filename):
+    """Memory-maps the pixel data of an uncompressed single-plane TIFF file.
+    Returns (pixel data, scale). The pixel data is a read-only view of the file,
+    no data is read until the pixels are accessed. Big endian files are read into
+    a copy in native byte order instead, so callers never see swapped dtypes."""
+    offset, shape, dtype, scale = read_tiff_layout(filename)
+    img = np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+    if not dtype.isnative:
+        return np.asarray(img).astype(dtype.newbyteorder('=')), scale
+    # hand out a plain ndarray view, so results of arithmetic on it aren't memmaps
+    return img.view(np.ndarray), scale
+
+
+def wait_for_file(filename, timeout=FILE_READY_TIMEOUT, interval=FILE_READY_INTERVAL):
+    """Waits until filename exists and is not empty. The CAM server may announce a file before it is
+    visible on a network share. Returns True if the file is ready, False if it isn't after timeout seconds."""
+    starttime = time.time()
+    while True:
+        try:
+            if os.path.getsize(filename) > 0:
+                return True
+        except OSError:
+            pass
+        if time.time() - starttime > timeout:
+            print "File not ready after", timeout, "seconds:", filename
+            return False
+        time.sleep(interval)
+
+
+def bioformats_loader():
+    """cellprofiler's load_using_bioformats, imported on the first call"""
+    global _load_using_bioformats
+    _bioformats_lock.acquire()
+    try:
+        if _load_using_bioformats is None:
+            t0 = time.time()
+            from cellprofiler.modules.loadimages import load_using_bioformats
+            _load_using_bioformats = load_using_bioformats
+            print "Loaded bioformats reader in %.2fs" % (time.time() - t0)
+        return _load_using_bioformats
+    finally:
+        _bioformats_lock.release()
+
+
+def preload_bioformats():
+    """imports the bioformats reader in a background thread, so the first read with it doesn't pay for the import"""
+    if _load_using_bioformats is not None:
+        return
+    def preload():
+        try:
+            bioformats_loader()
+        except Exception, e:
+            print "Could not load bioformats reader:", e
+    t = threading.Thread(target=preload)
+    t.daemon = True
+    t.start()
+
+
+class BioformatsReaderPool:
+    """Keeps up to max_readers bioformats readers open, the least recently used one is closed first.
+    Readers are kept per key (e.g. the field, see field_index.fieldKey) or per file if no key is given."""
+    def __init__(self, max_readers=BIOFORMATS_POOL_SIZE):
+        self.max_readers = max_readers
+        self.readers = collections.OrderedDict() # key -> (reader, file name, size Z, size C)
+
+    def read(self, filename, key=None, z=0, c=0):
+        """reads plane (z, c) of filename. Returns (pixel data, scale).
+        If the reader kept for key describes more than one plane, the plane is read from it by index. Otherwise
+        the reader is switched to filename, a reader is only created for the first file of a key."""
+        try:
+            from bioformats.formatreader import ImageReader
+        except ImportError:
+            # older bioformats without reader objects
+            return bioformats_loader()(filename, rescale = False, wants_max_intensity = True)
+        if key is None:
+            key = filename
+        entry = self.readers.pop(key, None)
+        if entry is None:
+            reader = ImageReader(path=filename)
+            entry = (reader, filename, reader.rdr.getSizeZ(), reader.rdr.getSizeC())
+            while len(self.readers) >= self.max_readers:
+                self.readers.popitem(last=False)[1][0].close()
+        reader, path, size_z, size_c = entry
+        if path != filename and not (size_z * size_c > 1 and z < size_z and c < size_c):
+            # a sibling file the reader's metadata doesn't cover, reuse the reader for it
+            reader.rdr.setId(filename)
+            reader.path = filename
+            entry = (reader, filename, reader.rdr.getSizeZ(), reader.rdr.getSizeC())
+            reader, path, size_z, size_c = entry
+        # most recently used
+        self.readers[key] = entry
+        if size_z * size_c > 1 and z < size_z and c < size_c:
+            return reader.read(z=z, c=c, rescale = False, wants_max_intensity = True)
+        return reader.read(rescale = False, wants_max_intensity = True)
+
+    def close(self):
+        """closes all readers"""
+        while len(self.readers) > 0:
+            self.readers.popitem()[1][0].close()
+
+
+def load_plane(filename, native=True, pool=None, key=None, z=0, c=0):
+    """Reads a single image plane. Returns (pixel data, scale).
+    If native is True the native TIFF reader is tried first and bioformats is used for
+    files it cannot handle, otherwise bioformats is used directly.
+    With a BioformatsReaderPool, bioformats reads plane (z, c) through the reader the pool keeps for key."""
+    if native:
+        try:
+            return read_tiff_plane(filename)
+        except UnsupportedTiffError, e:
+            print "Native reader can't read", filename, "(", e, ") - using bioformats"
+    if pool is not None:
+        return pool.read(filename, key, z, c)
+    return bioformats_loader()(filename, rescale = False, wants_max_intensity = True)
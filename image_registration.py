@@ -0,0 +1,115 @@
+####################################################################
+#  image_registration
+#  Translation estimation for the "LCC Module" suite
+#
+#  Estimates the shift between two images by FFT phase correlation.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Phase correlation.
+
+The normalized cross power spectrum of two images that only differ by a translation is a
+pure phase ramp, its inverse transform is a sharp peak at the shift. This is robust against
+intensity differences between the images (e.g. bleaching) and costs three FFTs.
+
+phase_correlation(ref, img) returns the shift (dy, dx) of the image content of img in ref:
+ref[y, x] ~ img[y - dy, x - dx]. Shifts are integer and are only unambiguous up to half the
+image size in each direction.
+
+DriftEstimator applies the same method to successive time points of the same field.
+"""
+
+import collections
+import numpy as np
+
+# keeps the normalization finite for frequencies without energy
+EPS = 1e-12
+
+
+def phase_correlation(ref, img):
+    """Estimates the translation between ref and img, which must have the same shape.
+    Returns (dy, dx, peak), where peak is the height of the correlation peak (1 for a perfect match,
+    close to 0 if the images are unrelated)."""
+    if ref.shape != img.shape:
+        raise ValueError("image shapes " + str(ref.shape) + " and " + str(img.shape) + " differ")
+    a = np.fft.fft2(ref - ref.mean())
+    b = np.fft.fft2(img - img.mean())
+    # cross power spectrum, normalized in place
+    a *= np.conj(b)
+    a /= np.abs(a) + EPS
+    r = np.fft.ifft2(a).real
+    dy, dx = np.unravel_index(np.argmax(r), r.shape)
+    peak = r[dy, dx]
+    # peaks beyond half the size are negative shifts
+    if dy > r.shape[0] // 2:
+        dy -= r.shape[0]
+    if dx > r.shape[1] // 2:
+        dx -= r.shape[1]
+    return int(dy), int(dx), float(peak)
+
+
+def downsample(img, factor):
+    """block average of img over factor x factor pixels, as float32. Rows and columns that don't fill a block are dropped."""
+    if factor <= 1:
+        return np.asarray(img, np.float32)
+    h = img.shape[0] // factor
+    w = img.shape[1] // factor
+    blocks = img[:h * factor, :w * factor].reshape(h, factor, w, factor)
+    return blocks.mean(axis=3, dtype=np.float32).mean(axis=1)
+
+
+class DriftEstimator:
+    """Estimates the drift of each field between successive time points.
+
+    For every field key (e.g. (slide, U, V, X, Y)) the conjugate spectrum of the downsampled image of the
+    previous time point is kept, so each new image costs one forward and one inverse FFT. The spectrum of
+    the new image replaces the old one in place. At most cache_size fields are kept, the least recently
+    seen field is dropped first.
+    """
+    def __init__(self, factor=4, cache_size=200):
+        self.factor = factor
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict() # field key -> conjugate spectrum of the previous image
+
+    def reset(self):
+        self.cache.clear()
+
+    def estimate(self, key, img):
+        """Returns the drift (dy, dx, peak) of img relative to the previous image of the same field in full resolution
+        pixels, i.e. image content that was at (y, x) is now at (y + dy, x + dx). Returns None for the first image of a field
+        or if the image size changed."""
+        small = downsample(img, self.factor)
+        small -= small.mean()
+        spectrum = np.fft.fft2(small).astype(np.complex64)
+        previous = self.cache.pop(key, None)
+        result = None
+        if previous is not None and previous.shape == spectrum.shape:
+            # cross power spectrum of current and previous image, computed in the previous image's buffer
+            previous *= spectrum
+            previous /= np.abs(previous) + EPS
+            r = np.fft.ifft2(previous).real
+            dy, dx = np.unravel_index(np.argmax(r), r.shape)
+            peak = float(r[dy, dx])
+            if dy > r.shape[0] // 2:
+                dy -= r.shape[0]
+            if dx > r.shape[1] // 2:
+                dx -= r.shape[1]
+            result = (int(dy) * self.factor, int(dx) * self.factor, peak)
+        # keep the conjugate spectrum as reference for the next time point
+        np.conj(spectrum, out=spectrum)
+        self.cache[key] = spectrum
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
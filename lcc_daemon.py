@@ -0,0 +1,421 @@
+####################################################################
+#  FeedbackLoopDaemon
+#  Headless feedback loop for the "LCC Module" suite
+#
+#  Waits for the images reported by the CAM server, hands complete
+#  fields to an analysis and sends the jobs it returns as a CAM list,
+#  without CellProfiler.
+#
+######################################################################
+#
+#  NOTE: this is a stand-alone program, it does the work of the
+#        LCConnect, LCCwaitForImage and LCCimageObject modules.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Feedback loop daemon.
+
+The daemon keeps the connection to the CAM server (or to the CAM broker, see cam_broker.py)
+open for as long as it runs:
+
+* the images of the job of interest are collected into fields with a FieldIndex, a field is
+  complete once all Z slices and channels have been reported (or it timed out),
+* each field is passed to the analysis, a callable analysis(filename, metadata, field) that
+  returns a list of jobs, i.e. dicts with the keys dxpos and dypos and optionally jobname,
+  slide, wellx, welly, fieldx and fieldy (taken from the field if missing, like LCCimageObject does),
+* the jobs replace the CAM list and the CAM scan is started,
+* the "stop waiting for CAM" command is sent after every field, also if the analysis failed,
+  so a Matrix Screener template waiting for the CAM list carries on (see --stopwait).
+
+The analysis is either a Python function, given as module:function or file.py:function and
+reloaded whenever its file changes, so it can be fixed or replaced while the microscope keeps
+running, or a command run for every field (see CommandAnalysis), e.g. a CellProfiler pipeline
+run headless. An analysis that fails is reported and the field is skipped, jobs without valid
+dxpos and dypos are reported and dropped, the daemon carries on in both cases.
+
+The fields analysed are recorded in a checkpoint (see checkpoint.py and ProcessedFields) next
+to the export folder, a restarted daemon doesn't analyse them again. Counters and timings are printed
+regularly and written to a JSON file if --metrics is given.
+
+Stop the daemon with Ctrl-C, the current wait is cancelled and the checkpoint saved:
+
+    python lcc_daemon.py --ip 10.11.112.16 --basepath Z:\\MatrixExportFolder --job 7 --camjob hires myanalysis:find_cells
+"""
+
+import imp
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+import cam_communicator_class as cc
+from field_index import FieldIndex, fieldKey
+from field_index import fieldTimepoint
+from checkpoint import Checkpoint, checkpoint_filename, ProcessedFields
+
+# the keys of a job passed to CAMcommunicator.addJobToCAMlist(), as in LCCimageObject
+CAM_JOB_ARGS = ('jobname', 'dxpos', 'dypos', 'slide', 'wellx', 'welly', 'fieldx', 'fieldy')
+
+# seconds between attempts to reconnect to the CAM server
+RECONNECT_INTERVAL = 5
+
+# when to send the "stop waiting for CAM" command, as LCCimageObject's choices
+STOPWAIT_FIELD = "field" # after every field
+STOPWAIT_END = "end" # once, when the daemon stops
+STOPWAIT_NONE = "none"
+STOPWAIT_CHOICES = (STOPWAIT_FIELD, STOPWAIT_END, STOPWAIT_NONE)
+
+
+class AnalysisFunction:
+    """a Python function given as module:function or file.py:function, reloaded when its file changes"""
+    def __init__(self, spec):
+        self.spec = spec
+        self.location, self.name = spec.rsplit(":", 1)
+        self.function = None
+        self.filename = None
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        if self.location.endswith(".py"):
+            modulename = os.path.splitext(os.path.basename(self.location))[0]
+            module = imp.load_source(modulename, self.location)
+        else:
+            module = __import__(self.location, fromlist=[self.name])
+            if self.function is not None:
+                module = reload(module)
+        self.filename = os.path.splitext(module.__file__)[0] + ".py"
+        self.mtime = self.modificationTime()
+        self.function = getattr(module, self.name)
+
+    def modificationTime(self):
+        try:
+            return os.path.getmtime(self.filename)
+        except OSError:
+            return None
+
+    def reloadIfChanged(self):
+        """reloads the function if its file has changed. A file that fails to load keeps the previous function."""
+        if self.modificationTime() == self.mtime:
+            return
+        print "Reloading analysis", self.spec
+        try:
+            self.load()
+        except Exception, e:
+            print "Could not reload analysis:", repr(e)
+            self.mtime = self.modificationTime()
+
+    def __call__(self, filename, metadata, field):
+        self.reloadIfChanged()
+        return self.function(filename, metadata, field)
+
+
+class CommandAnalysis:
+    """runs a command for every field, e.g. a headless CellProfiler pipeline.
+    {filename} in the command is replaced by the file name of the field, {files} by the file names of all its planes.
+    The command prints one job per line as key=value pairs, e.g. "dxpos=120 dypos=-35", other lines are ignored."""
+    def __init__(self, command):
+        self.command = command
+
+    def __call__(self, filename, metadata, field):
+        files = [filename]
+        if field is not None:
+            files = [f for (z, c), f in sorted(field.planes.items())]
+        args = []
+        for arg in shlex.split(self.command, posix=(os.name != 'nt')):
+            if arg == "{files}":
+                args.extend(files)
+            else:
+                args.append(arg.replace("{filename}", filename))
+        process = subprocess.Popen(args, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise Exception("analysis command returned " + str(process.returncode))
+        jobs = []
+        for line in output.splitlines():
+            pairs = [p.split("=", 1) for p in line.split() if "=" in p]
+            job = dict(pairs)
+            if 'dxpos' in job and 'dypos' in job:
+                jobs.append(job)
+        return jobs
+
+
+def load_analysis(spec):
+    """the analysis for a module:function or file.py:function spec, or a command if spec starts with !"""
+    if spec.startswith("!"):
+        return CommandAnalysis(spec[1:])
+    return AnalysisFunction(spec)
+
+
+class Metrics:
+    """counters and timings of the daemon, written to a JSON file at most every interval seconds"""
+    def __init__(self, filename=None, interval=60):
+        self.filename = filename
+        self.interval = interval
+        self.started = time.time()
+        self.last_report = self.started
+        self.counters = dict(images=0, fields=0, fields_skipped=0, analysis_errors=0, camlists=0, jobs=0, reconnects=0)
+        self.timings = {} # name -> [count, total seconds, maximum seconds]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def time(self, name, seconds):
+        t = self.timings.setdefault(name, [0, 0.0, 0.0])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+    def snapshot(self):
+        d = dict(self.counters)
+        d['uptime'] = time.time() - self.started
+        for name, (n, total, maximum) in self.timings.items():
+            d[name + '_mean'] = total / n
+            d[name + '_max'] = maximum
+        return d
+
+    def report(self, force=False):
+        """prints the metrics and writes them to the file, at most every interval seconds unless force is True"""
+        if not force and time.time() - self.last_report < self.interval:
+            return
+        self.last_report = time.time()
+        d = self.snapshot()
+        print "Metrics:", ", ".join("%s %s" % (k, ("%.2f" % v) if isinstance(v, float) else v) for k, v in sorted(d.items()))
+        if self.filename is None:
+            return
+        tmpname = self.filename + ".tmp"
+        try:
+            f = open(tmpname, 'w')
+            try:
+                json.dump(d, f, indent=1)
+            finally:
+                f.close()
+            if os.path.exists(self.filename):
+                os.remove(self.filename) # os.rename doesn't replace files on Windows
+            os.rename(tmpname, self.filename)
+        except (IOError, OSError), e:
+            print "Could not write metrics", self.filename, e
+
+
+class FeedbackLoopDaemon:
+    def __init__(self, camc, analysis, jobnr=None, camjob="", nr_of_slices=1, channels=(0,), field_timeout=60,
+                 checkpoint=None, metrics=None, delete_list=True, start_scan=True, stopwait=STOPWAIT_FIELD):
+        """camc - CAMcommunicator, connected directly or through the broker
+        analysis - callable analysis(filename, metadata, field) returning a list of jobs
+        jobnr - job number of the images to analyse, None for all images
+        camjob - name of the job for the CAM list, used for jobs without a jobname
+        nr_of_slices, channels, field_timeout - see FieldIndex
+        checkpoint - Checkpoint recording the fields analysed, or None
+        stopwait - when to send the "stop waiting for CAM" command, one of STOPWAIT_CHOICES"""
+        self.camc = camc
+        self.analysis = analysis
+        self.jobnr = jobnr
+        self.camjob = camjob
+        self.index = FieldIndex(nr_of_slices, channels, field_timeout)
+        self.checkpoint = checkpoint
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.delete_list = delete_list
+        self.start_scan = start_scan
+        self.stopwait = stopwait
+        self.processed_fields = ProcessedFields()
+        self.running = False
+
+    def stop(self):
+        """stops the daemon, can be called from a signal handler or another thread"""
+        self.running = False
+        self.camc.cancel()
+
+    def fieldKey(self, md):
+        """the field key relative to the base path, as LCCwaitForImage records it"""
+        key = fieldKey(md)
+        if self.camc.basepath != "" and key.startswith(self.camc.basepath):
+            key = key[len(self.camc.basepath):]
+        return key
+
+    def connect(self):
+        """(re)connects to the CAM server until it succeeds or the daemon is stopped"""
+        while self.running and not self.camc.isConnected():
+            if self.camc.open():
+                return True
+            print "Could not connect to CAM server, retrying in", RECONNECT_INTERVAL, "seconds"
+            time.sleep(RECONNECT_INTERVAL)
+        return self.camc.isConnected()
+
+    def run(self):
+        """waits for fields and analyses them until stop() is called"""
+        self.running = True
+        self.camc.resetCancel()
+        if self.checkpoint is not None and self.checkpoint.load():
+            if self.checkpoint.get("daemon_fields") is not None:
+                self.processed_fields.restore(self.checkpoint.get("daemon_fields"))
+            print "Resuming,", len(self.processed_fields), "fields of the latest timepoint were analysed before"
+        if not self.connect():
+            return
+        try:
+            while self.running:
+                field = self.wait_for_field()
+                if field is not None:
+                    self.process_field(field)
+                if self.checkpoint is not None:
+                    self.checkpoint.save()
+                self.metrics.report()
+        finally:
+            self.running = False
+            if self.stopwait == STOPWAIT_END and self.camc.isConnected():
+                self.camc.stopWaitingForCAM()
+            if self.checkpoint is not None:
+                self.checkpoint.save(force=True)
+            self.metrics.report(force=True)
+            self.camc.close()
+
+    def wait_for_field(self):
+        """the next complete (or timed out) field, or None if no field is ready yet"""
+        field = self.index.popReady()
+        if field is not None:
+            return field
+        waittime = self.camc.poll_interval * 10
+        deadline = self.index.nextDeadline()
+        if deadline is not None:
+            waittime = max(0, min(waittime, deadline - time.time()))
+        response = self.camc.waitforimage(jobnr=self.jobnr, timeout=waittime)
+        if response is None:
+            if self.camc.isCancelled():
+                if self.running:
+                    # cancelled from outside, carry on with a new connection
+                    self.camc.resetCancel()
+                    self.connect()
+            elif not self.camc.isConnected():
+                self.metrics.count('reconnects')
+                self.connect()
+            return self.index.popReady()
+        filename, md = response
+        self.metrics.count('images')
+        self.index.add(filename, md)
+        return self.index.popReady()
+
+    def process_field(self, field):
+        """analyses a field and sends the resulting jobs"""
+        key = self.fieldKey(field.metadata)
+        timepoint = fieldTimepoint(field.metadata)
+        if self.processed_fields.contains(key, timepoint):
+            print "Skipping field analysed before", key
+            self.metrics.count('fields_skipped')
+            # the microscope may be waiting for the CAM list of this field
+            self.stop_waiting()
+            return
+        t0 = time.time()
+        jobs = None
+        try:
+            jobs = []
+            for job in self.analysis(field.filename, field.metadata, field) or []:
+                try:
+                    jobs.append(self.complete_job(job, field.metadata))
+                except (TypeError, ValueError, KeyError), e:
+                    print "Dropping invalid job", job, "of", field.filename + ":", e
+                    self.metrics.count('analysis_errors')
+        except Exception, e:
+            print "Analysis of", field.filename, "failed:", repr(e)
+            self.metrics.count('analysis_errors')
+            jobs = None
+        t1 = time.time()
+        self.metrics.time('analysis', t1 - t0)
+        if jobs is not None:
+            self.send_jobs(jobs)
+            self.metrics.time('latency', time.time() - field.first_seen)
+        self.stop_waiting()
+        self.metrics.count('fields')
+        self.processed_fields.add(key, timepoint)
+        if self.checkpoint is not None:
+            self.checkpoint.set("daemon_fields", self.processed_fields.state())
+
+    def stop_waiting(self):
+        """lets a Matrix Screener template that waits for the CAM list carry on, if selected"""
+        if self.stopwait == STOPWAIT_FIELD:
+            self.camc.stopWaitingForCAM()
+
+    def complete_job(self, job, md):
+        """job with the CAM list position taken from the field metadata where it isn't given.
+        Raises KeyError, TypeError or ValueError if the job has no valid dxpos and dypos."""
+        job = dict(job)
+        job['dxpos'] = float(job['dxpos'])
+        job['dypos'] = float(job['dypos'])
+        complete = dict(jobname=self.camjob,
+                        slide=int(md['slide'][3:]) + 1,
+                        wellx=int(md['U'][3:]) + 1,
+                        welly=int(md['V'][3:]) + 1,
+                        fieldx=int(md['X'][3:]) + 1,
+                        fieldy=int(md['Y'][3:]) + 1)
+        complete.update(job)
+        return complete
+
+    def send_jobs(self, jobs):
+        """replaces the CAM list by jobs and starts the CAM scan"""
+        self.camc.beginCommands()
+        if self.delete_list:
+            self.camc.deleteCAMList()
+        for job in jobs:
+            self.camc.addJobToCAMlist(**dict((key, job[key]) for key in CAM_JOB_ARGS))
+        if self.start_scan:
+            self.camc.resetScanFinished()
+            self.camc.startCAMScan()
+        self.camc.endCommands()
+        self.metrics.count('camlists')
+        self.metrics.count('jobs', len(jobs))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Runs the CAM feedback loop without CellProfiler")
+    parser.add_argument("analysis", help="module:function or file.py:function called for every field, or !command run for every field")
+    parser.add_argument("--ip", default=cc.iplocal, help="IP address of the CAM server")
+    parser.add_argument("--port", type=int, default=8895, help="port of the CAM server")
+    parser.add_argument("--sysid", default="0", help="Leica /sys value")
+    parser.add_argument("--basepath", default="", help="path to the exported images, as in LCConnect")
+    parser.add_argument("--broker", type=int, default=0, help="connect through the CAM broker on this local port instead")
+    parser.add_argument("--job", type=int, default=None, help="job number of the images to analyse (default: all images)")
+    parser.add_argument("--camjob", default="", help="job name for the CAM list")
+    parser.add_argument("--slices", type=int, default=1, help="number of Z slices per field")
+    parser.add_argument("--channels", type=int, nargs="+", default=[0], help="channel indices per field")
+    parser.add_argument("--field-timeout", type=float, default=60, help="seconds to wait for the remaining planes of a field")
+    parser.add_argument("--no-delete", action="store_true", help="don't delete the CAM list before adding the jobs")
+    parser.add_argument("--no-start", action="store_true", help="don't start the CAM scan after adding the jobs")
+    parser.add_argument("--stopwait", choices=STOPWAIT_CHOICES, default=STOPWAIT_FIELD,
+                        help="send the 'stop waiting for CAM' command after every field (default), once when the daemon stops, or never")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (default: next to the export folder, if --basepath is given)")
+    parser.add_argument("--metrics", default=None, help="JSON file the metrics are written to")
+    parser.add_argument("--metrics-interval", type=float, default=60, help="seconds between metrics reports")
+    args = parser.parse_args()
+
+    camc = cc.CAMcommunicator()
+    camc.setIP(args.ip)
+    camc.port = args.port
+    camc.setSysID(args.sysid)
+    camc.basepath = args.basepath
+    if args.broker > 0:
+        camc.setBroker(('localhost', args.broker))
+    checkpoint = None
+    if args.checkpoint is not None:
+        checkpoint = Checkpoint(args.checkpoint)
+    elif args.basepath != "":
+        checkpoint = Checkpoint(checkpoint_filename(args.basepath))
+    daemon = FeedbackLoopDaemon(camc, load_analysis(args.analysis), args.job, args.camjob,
+                                args.slices, args.channels, args.field_timeout, checkpoint,
+                                Metrics(args.metrics, args.metrics_interval),
+                                not args.no_delete, not args.no_start, args.stopwait)
+    signal.signal(signal.SIGINT, lambda signum, frame: daemon.stop())
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    daemon.run()
+    print "Feedback loop daemon stopped"
+    sys.exit(0)
@@ -0,0 +1,187 @@
+####################################################################
+#  WellMosaic
+#  On-the-fly mosaic assembly for the "LCC Module" suite
+#
+#  Stitches the fields of a well into one canvas as they arrive,
+#  so that objects on field borders are not cut.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage and
+#        LCCimageObject modules.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Well mosaic.
+
+The canvas of a well is a memory-mapped temporary file, so large mosaics don't have to
+fit into memory. Field (fx, fy) is nominally placed at fx * (tile width - overlap),
+fy * (tile height - overlap). With refinement switched on the overlap of a new field with
+its left (or upper) neighbour is registered by phase correlation and the field is placed
+relative to where that neighbour actually went. Shifts larger than max_shift are
+considered registration failures and the nominal position is used.
+
+The canvas has a margin of max_shift pixels on all sides, so refined fields never
+fall off the canvas. Later fields overwrite the overlap of earlier ones.
+
+LCCwaitForImage registers the mosaic it is currently assembling with set_current_mosaic(),
+LCCimageObject uses get_current_mosaic() and WellMosaic.fieldAt() to map object coordinates
+on the mosaic back to a field and the coordinates within that field.
+
+The images handed to the pipeline are views of the canvas, so an image set may still map the
+file when the next well starts. Windows can't delete a mapped file: close() drops the mosaic's
+own reference and files that can't be deleted yet are retried on the next close() and at exit.
+"""
+
+import atexit
+import os
+import tempfile
+import numpy as np
+
+from image_registration import phase_correlation
+
+# correlation peaks below this are considered registration failures
+MIN_PEAK = 0.05
+
+
+class WellMosaic:
+    def __init__(self, key, nr_fields_x, nr_fields_y, tile_shape, dtype, overlap=0.1, refine=False, max_shift=20):
+        """key - identifies the well, e.g. (timepoint, slide, U, V)
+        nr_fields_x, nr_fields_y - number of fields per well
+        tile_shape - (rows, columns) of a field
+        overlap - overlap between neighbouring fields as a fraction of the field size"""
+        self.key = key
+        self.nr_fields_x = nr_fields_x
+        self.nr_fields_y = nr_fields_y
+        self.tile_shape = tuple(tile_shape)
+        self.refine = refine
+        self.max_shift = max_shift
+        h, w = self.tile_shape
+        self.step_y = h - int(round(h * overlap))
+        self.step_x = w - int(round(w * overlap))
+        self.margin = max_shift
+        shape = (self.step_y * (nr_fields_y - 1) + h + 2 * self.margin,
+                 self.step_x * (nr_fields_x - 1) + w + 2 * self.margin)
+        fd, self.filename = tempfile.mkstemp(suffix=".mosaic")
+        os.close(fd)
+        self.canvas = np.memmap(self.filename, dtype=dtype, mode='w+', shape=shape)
+        self.positions = {} # (fx, fy) -> (y0, x0) of the placed field on the canvas
+        self.shifts = {} # (fx, fy) -> (dy, dx) applied by refinement
+
+    def nominalPosition(self, fx, fy):
+        return self.margin + fy * self.step_y, self.margin + fx * self.step_x
+
+    def add(self, fx, fy, tile):
+        """places field (fx, fy) on the canvas. Returns the position (y0, x0) of the field on the canvas"""
+        if tile.shape != self.tile_shape:
+            raise ValueError("field shape " + str(tile.shape) + " does not match mosaic field shape " + str(self.tile_shape))
+        y0, x0 = self.nominalPosition(fx, fy)
+        dy, dx = 0, 0
+        if self.refine:
+            y0, x0, dy, dx = self.refinePosition(fx, fy, tile, y0, x0)
+        h, w = self.tile_shape
+        # never leave the canvas
+        y0 = min(max(y0, 0), self.canvas.shape[0] - h)
+        x0 = min(max(x0, 0), self.canvas.shape[1] - w)
+        self.canvas[y0:y0+h, x0:x0+w] = tile
+        self.positions[(fx, fy)] = (y0, x0)
+        self.shifts[(fx, fy)] = (dy, dx)
+        return y0, x0
+
+    def refinePosition(self, fx, fy, tile, y0, x0):
+        """registers the overlap of the tile with an already placed neighbour.
+        Returns the refined position and the shift relative to the neighbour's nominal offset"""
+        h, w = self.tile_shape
+        if (fx - 1, fy) in self.positions and w > self.step_x:
+            ny0, nx0 = self.positions[(fx - 1, fy)]
+            y0, x0 = ny0, nx0 + self.step_x
+            ov = w - self.step_x
+            ref = self.canvas[y0:y0+h, x0:x0+ov]
+            img = tile[:, :ov]
+        elif (fx, fy - 1) in self.positions and h > self.step_y:
+            ny0, nx0 = self.positions[(fx, fy - 1)]
+            y0, x0 = ny0 + self.step_y, nx0
+            ov = h - self.step_y
+            ref = self.canvas[y0:y0+ov, x0:x0+w]
+            img = tile[:ov, :]
+        else:
+            return y0, x0, 0, 0
+        if ref.shape != img.shape:
+            # the neighbour was clipped at the canvas border
+            return y0, x0, 0, 0
+        dy, dx, peak = phase_correlation(np.asarray(ref, np.float32), np.asarray(img, np.float32))
+        if peak < MIN_PEAK or abs(dy) > self.max_shift or abs(dx) > self.max_shift:
+            print "Mosaic registration of field", (fx, fy), "failed, shift", (dy, dx), "peak", peak
+            return y0, x0, 0, 0
+        return y0 + dy, x0 + dx, dy, dx
+
+    def isComplete(self):
+        return len(self.positions) >= self.nr_fields_x * self.nr_fields_y
+
+    def image(self):
+        """the canvas as a plain ndarray view (no copy)"""
+        return self.canvas.view(np.ndarray)
+
+    def fieldAt(self, x, y):
+        """maps mosaic coordinates to the field they belong to. If the point lies in the overlap of several
+        fields, the field whose centre is closest is chosen, so objects are imaged from the field they are
+        least likely to be cut in. Returns (fx, fy, x in field, y in field) or None if no field covers the point."""
+        h, w = self.tile_shape
+        best = None
+        for (fx, fy), (y0, x0) in self.positions.items():
+            if x0 <= x < x0 + w and y0 <= y < y0 + h:
+                dist = (x - x0 - w / 2.0) ** 2 + (y - y0 - h / 2.0) ** 2
+                if best is None or dist < best[0]:
+                    best = (dist, fx, fy, x - x0, y - y0)
+        if best is None:
+            return None
+        return best[1:]
+
+    def close(self):
+        """releases the canvas and deletes its file, or schedules it for deletion if it is still mapped"""
+        if self.canvas is not None:
+            del self.canvas
+            self.canvas = None
+            undeleted_files.append(self.filename)
+        delete_mosaic_files()
+
+
+# canvas files that couldn't be deleted yet, see delete_mosaic_files()
+undeleted_files = []
+
+
+def delete_mosaic_files():
+    """deletes the canvas files of closed mosaics. Files still mapped by images (on Windows) are kept for the next attempt."""
+    for filename in list(undeleted_files):
+        try:
+            if os.path.exists(filename):
+                os.remove(filename)
+            undeleted_files.remove(filename)
+        except OSError:
+            pass
+
+atexit.register(delete_mosaic_files)
+
+
+# the mosaic LCCwaitForImage is currently assembling, see set_current_mosaic()
+current_mosaic = None
+
+
+def set_current_mosaic(mosaic):
+    """registers the mosaic of the current well, the previous one is released"""
+    global current_mosaic
+    if current_mosaic is not None and current_mosaic is not mosaic:
+        current_mosaic.close()
+    current_mosaic = mosaic
+
+
+def get_current_mosaic():
+    return current_mosaic
@@ -0,0 +1,209 @@
+####################################################################
+#  StackProjector
+#  Streaming Z projection for the "LCC Module" suite
+#
+#  Reduces a Z-stack slice by slice into a single projected image
+#  without ever holding the whole stack in memory.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCwaitForImage module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Streaming Z projection.
+
+The projector keeps preallocated accumulators of the requested dtype (float32 by default) and
+updates them in place with out= numpy operations as slices arrive, so the only per-slice
+allocation is the slice itself that the reader hands us.
+
+Supported projections are mean, max, min, sum and standard deviation. The standard deviation
+is computed with Welford's running update, which is numerically stable in float32.
+
+BestFocusSelector works the same way but instead of projecting it scores every slice with a
+focus metric and only keeps the best slice seen so far.
+
+Usage:
+
+    proj = StackProjector(PROJ_MEAN)
+    for z in slices:
+        proj.add(read_slice(z))
+    img = proj.result()
+"""
+
+import numpy as np
+
+PROJ_MEAN = "mean"
+PROJ_MAX = "max"
+PROJ_MIN = "min"
+PROJ_SUM = "sum"
+PROJ_STD = "std"
+
+PROJECTIONS = (PROJ_MEAN, PROJ_MAX, PROJ_MIN, PROJ_SUM, PROJ_STD)
+
+FOCUS_NORMALIZED_VARIANCE = "normvar"
+FOCUS_LAPLACIAN = "laplacian"
+FOCUS_BRENNER = "brenner"
+
+FOCUS_METRICS = (FOCUS_NORMALIZED_VARIANCE, FOCUS_LAPLACIAN, FOCUS_BRENNER)
+
+
+class StackProjector:
+    """Streaming projection of a Z stack. dtype is the accumulation type, if dtype is None
+    the type of the first slice is used (only sensible for max and min projections)."""
+    def __init__(self, projection, dtype=np.float32):
+        if projection not in PROJECTIONS:
+            raise ValueError("unknown projection " + str(projection))
+        self.projection = projection
+        self.fixed_dtype = dtype is not None
+        if self.fixed_dtype:
+            self.dtype = np.dtype(dtype)
+        else:
+            self.dtype = None
+        self.reset()
+
+    def reset(self):
+        """forget all slices added so far. Scratch buffers are kept and reused if the next stack has the same shape"""
+        self.n = 0
+        self.finished = False
+
+    def _allocate(self, shape):
+        # (re)allocate accumulators only if the slice shape changed
+        if getattr(self, 'acc', None) is None or self.acc.shape != shape:
+            self.acc = np.empty(shape, self.dtype)
+        if self.projection == PROJ_STD and (getattr(self, 'm2', None) is None or self.m2.shape != shape):
+            self.m2 = np.empty(shape, self.dtype)
+            self.delta = np.empty(shape, self.dtype)
+            self.delta2 = np.empty(shape, self.dtype)
+
+    def add(self, slice_data):
+        """add one slice to the running projection. Adding a slice after result() has been called starts a new stack."""
+        if self.finished:
+            # the previous result has been handed out, don't overwrite it
+            self.acc = None
+            self.reset()
+        if self.n == 0:
+            if not self.fixed_dtype and (self.dtype is None or self.dtype != slice_data.dtype):
+                self.dtype = slice_data.dtype
+                self.acc = None
+            self._allocate(slice_data.shape)
+            # copy first slice into the accumulator, converting to the accumulation type on the fly
+            self.acc[...] = slice_data
+            if self.projection == PROJ_STD:
+                self.m2.fill(0)
+            self.n = 1
+            return
+        if slice_data.shape != self.acc.shape:
+            raise ValueError("slice shape " + str(slice_data.shape) + " does not match stack shape " + str(self.acc.shape))
+        self.n += 1
+        if self.projection in (PROJ_MEAN, PROJ_SUM):
+            np.add(self.acc, slice_data, out=self.acc, casting='unsafe')
+        elif self.projection == PROJ_MAX:
+            np.maximum(self.acc, slice_data, out=self.acc, casting='unsafe')
+        elif self.projection == PROJ_MIN:
+            np.minimum(self.acc, slice_data, out=self.acc, casting='unsafe')
+        elif self.projection == PROJ_STD:
+            # Welford update, acc holds the running mean, m2 the sum of squared differences
+            #   delta = x - mean ; mean += delta/n ; m2 += delta * (x - mean)
+            np.subtract(slice_data, self.acc, out=self.delta, casting='unsafe')
+            np.divide(self.delta, self.dtype.type(self.n), out=self.delta2)
+            self.acc += self.delta2
+            np.subtract(slice_data, self.acc, out=self.delta2, casting='unsafe')
+            self.delta *= self.delta2
+            self.m2 += self.delta
+
+    def result(self):
+        """returns the projection of all slices added so far, or None if no slice was added.
+        The accumulator itself is returned (no copy). The next call to add() allocates a fresh accumulator,
+        so the returned array is never overwritten."""
+        if self.n == 0:
+            return None
+        if not self.finished:
+            if self.projection == PROJ_MEAN:
+                self.acc /= self.dtype.type(self.n)
+            elif self.projection == PROJ_STD:
+                np.divide(self.m2, self.dtype.type(self.n), out=self.acc)
+                np.sqrt(self.acc, out=self.acc)
+            self.finished = True
+        return self.acc
+
+
+class BestFocusSelector:
+    """Scores slices with a focus metric as they are streamed in and keeps only the sharpest one.
+    Higher scores mean better focus for all metrics.
+
+    normvar   - normalized variance, var(I)/mean(I)
+    laplacian - mean energy of the discrete 4-neighbour Laplacian
+    brenner   - Brenner gradient, mean of (I(x+2,y)-I(x,y))^2
+    """
+    def __init__(self, metric=FOCUS_NORMALIZED_VARIANCE):
+        if metric not in FOCUS_METRICS:
+            raise ValueError("unknown focus metric " + str(metric))
+        self.metric = metric
+        self.buf = None
+        self.reset()
+
+    def reset(self):
+        self.best = None
+        self.best_z = -1
+        self.best_score = -np.inf
+        self.n = 0
+
+    def score(self, img):
+        """computes the focus score of a single 2D slice.
+        The gradient based metrics need at least 3 pixels in each direction they differentiate, smaller
+        slices (e.g. after heavy binning) are scored with the normalized variance instead."""
+        too_small = img.shape[1] < 3 or (self.metric == FOCUS_LAPLACIAN and img.shape[0] < 3)
+        if self.metric == FOCUS_NORMALIZED_VARIANCE or too_small:
+            if img.size == 0:
+                return 0.0
+            mean = img.mean(dtype=np.float64)
+            if mean == 0:
+                return 0.0
+            return img.var(dtype=np.float64) / mean
+
+        # the gradient based metrics need a signed scratch buffer, reuse it between slices
+        if self.metric == FOCUS_LAPLACIAN:
+            shape = (img.shape[0]-2, img.shape[1]-2)
+        else:
+            shape = (img.shape[0], img.shape[1]-2)
+        if self.buf is None or self.buf.shape != shape:
+            self.buf = np.empty(shape, np.float32)
+        buf = self.buf
+
+        if self.metric == FOCUS_LAPLACIAN:
+            centre = img[1:-1, 1:-1]
+            np.multiply(centre, 4, out=buf, dtype=np.float32)
+            buf -= img[:-2, 1:-1]
+            buf -= img[2:, 1:-1]
+            buf -= img[1:-1, :-2]
+            buf -= img[1:-1, 2:]
+        else:
+            np.subtract(img[:, 2:], img[:, :-2], out=buf, dtype=np.float32)
+        np.square(buf, out=buf)
+        return buf.mean(dtype=np.float64)
+
+    def add(self, slice_data, z=None):
+        """scores slice_data and keeps it if it is the best focused slice so far. Returns the score.
+        If z is None the slices are numbered in the order they are added."""
+        if z is None:
+            z = self.n
+        self.n += 1
+        score = self.score(slice_data)
+        if score > self.best_score:
+            self.best = slice_data
+            self.best_z = z
+            self.best_score = score
+        return score
+
+    def result(self):
+        """returns a tuple (best slice, z index of best slice, focus score)"""
+        return self.best, self.best_z, self.best_score
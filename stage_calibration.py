@@ -0,0 +1,152 @@
+####################################################################
+#  stage_calibration
+#  Pixel to CAM list offset transform for the "LCC Module" suite
+#
+#  Maps object centres in the lowres image to the dxpos/dypos
+#  offsets of CAM list jobs with a 2D affine transform.
+#
+######################################################################
+#
+#  NOTE: this file is required by the LCCimageObject module.
+#
+######################################################################
+#
+#
+#  LICENSE:
+#  This software is distributed under an EMBLEM academic use software
+#  license, see the file LCC_license.txt for details.
+#
+######################################################################
+
+"""
+Stage calibration.
+
+A transform is a 2 x 3 matrix M that maps a pixel position (x, y) of the lowres image to the
+offsets of the CAM list job:
+
+    (dxpos, dypos) = M[:, :2] . (x, y) + M[:, 2]
+
+legacy_affine() expresses the flip, swap and offset settings of LCCimageObject as such a
+matrix. fit_affine() fits a matrix to reference points, e.g. beads whose pixel positions were
+measured in the lowres image and whose offsets were adjusted until they were centred in the
+hires image. This also captures rotation and scale differences between the two objectives.
+
+Calibrations are kept in a JSON file, one matrix per name (e.g. per objective pair):
+
+    store = CalibrationStore("calibration.json")
+    store.set("10x-63x", fit_affine(pixels, offsets)[0])
+    store.save()
+
+or from the command line, with a CSV file with the columns x, y, dxpos, dypos:
+python stage_calibration.py calibration.json 10x-63x points.csv
+"""
+
+import json
+import os
+import numpy as np
+
+
+def legacy_affine(nx, ny, flipx=False, flipy=False, swapxy=False, offsetx=0, offsety=0):
+    """the transform applied by the flip, swap and offset settings to an image of width nx and height ny"""
+    # flipping: x -> (nx - 1) - x
+    flip = np.array([[-1.0 if flipx else 1.0, 0.0, (nx - 1.0) if flipx else 0.0],
+                     [0.0, -1.0 if flipy else 1.0, (ny - 1.0) if flipy else 0.0],
+                     [0.0, 0.0, 1.0]])
+    swap = np.eye(3)
+    if swapxy:
+        swap[:2, :2] = [[0.0, 1.0], [1.0, 0.0]]
+    # offset from the image centre
+    centre = np.array([[1.0, 0.0, offsetx - nx / 2.0],
+                       [0.0, 1.0, offsety - ny / 2.0],
+                       [0.0, 0.0, 1.0]])
+    return np.dot(centre, np.dot(swap, flip))[:2]
+
+
+def fit_affine(src, dst):
+    """least squares affine transform mapping the points src (N x 2) onto dst (N x 2), N >= 3 points
+    that are not on a line. Returns (matrix, rms residual)."""
+    src = np.asarray(src, np.float64).reshape(-1, 2)
+    dst = np.asarray(dst, np.float64).reshape(-1, 2)
+    if len(src) != len(dst):
+        raise ValueError("got " + str(len(src)) + " source and " + str(len(dst)) + " target points")
+    if len(src) < 3:
+        raise ValueError("at least 3 reference points are required, got " + str(len(src)))
+    A = np.column_stack((src, np.ones(len(src))))
+    solution, residuals, rank, sv = np.linalg.lstsq(A, dst, rcond=-1)
+    if rank < 3:
+        raise ValueError("the reference points are on a line")
+    matrix = solution.T
+    rms = float(np.sqrt(((apply_affine_points(matrix, src) - dst) ** 2).sum(axis=1).mean()))
+    return matrix, rms
+
+
+def apply_affine_points(matrix, points):
+    """applies the transform to an N x 2 array of points"""
+    return np.dot(points, matrix[:, :2].T) + matrix[:, 2]
+
+
+def apply_affine(matrix, x, y):
+    """applies the transform to the coordinate arrays x and y, returns the arrays (u, v)"""
+    uv = apply_affine_points(matrix, np.column_stack((np.asarray(x, np.float64), np.asarray(y, np.float64))))
+    return uv[:, 0], uv[:, 1]
+
+
+def field_limits(matrix, nx, ny):
+    """the range of offsets ((umin, umax), (vmin, vmax)) of the pixels of an nx x ny image after the transform,
+    i.e. the offsets that still lie within the lowres field. This is the bounding box of the transformed
+    image corners, so flips, swaps and the translation are taken into account."""
+    corners = np.array([[0.0, 0.0], [nx - 1.0, 0.0], [0.0, ny - 1.0], [nx - 1.0, ny - 1.0]])
+    mapped = apply_affine_points(matrix, corners)
+    return ((float(mapped[:, 0].min()), float(mapped[:, 0].max())),
+            (float(mapped[:, 1].min()), float(mapped[:, 1].max())))
+
+
+class CalibrationStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.matrices = {} # name -> 2 x 3 matrix
+        if os.path.exists(filename):
+            f = open(filename)
+            try:
+                for name, matrix in json.load(f).items():
+                    self.matrices[name] = np.asarray(matrix, np.float64).reshape(2, 3)
+            finally:
+                f.close()
+
+    def names(self):
+        return sorted(self.matrices.keys())
+
+    def get(self, name):
+        """the matrix stored under name, or None"""
+        return self.matrices.get(name)
+
+    def set(self, name, matrix):
+        self.matrices[name] = np.asarray(matrix, np.float64).reshape(2, 3)
+
+    def save(self):
+        tmpname = self.filename + ".tmp"
+        f = open(tmpname, 'w')
+        try:
+            json.dump(dict((name, matrix.tolist()) for name, matrix in self.matrices.items()), f, indent=1)
+        finally:
+            f.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename) # os.rename doesn't replace files on Windows
+        os.rename(tmpname, self.filename)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Fits the pixel to CAM list offset transform to reference points")
+    parser.add_argument("filename", help="calibration file, created if it doesn't exist")
+    parser.add_argument("name", help="name of the calibration, e.g. the objective pair")
+    parser.add_argument("points", help="CSV file with the columns x, y, dxpos, dypos (one header line)")
+    args = parser.parse_args()
+    points = np.loadtxt(args.points, delimiter=",", skiprows=1, ndmin=2)
+    matrix, rms = fit_affine(points[:, :2], points[:, 2:4])
+    print "Transform", args.name
+    print matrix
+    print "rms residual %.2f pixels for %d points" % (rms, len(points))
+    store = CalibrationStore(args.filename)
+    store.set(args.name, matrix)
+    store.save()
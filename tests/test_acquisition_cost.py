@@ -0,0 +1,101 @@
+"""
+Tests for acquisition_cost.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from acquisition_cost import CostModel, path_length, simulate, DEFAULT_JOB_TIME
+
+
+def make_round(rs, start, job_time, move_time, overhead, n_jobs, images_per_job=2):
+    """a round of n_jobs at random positions whose images arrive as the model predicts"""
+    positions = rs.rand(n_jobs, 2) * 10000
+    travel = np.zeros(n_jobs)
+    travel[1:] = np.sqrt((np.diff(positions, axis=0) ** 2).sum(axis=1))
+    ends = start + overhead + np.cumsum(job_time + move_time * travel)
+    arrivals = []
+    for k in range(n_jobs):
+        begin = ends[k - 1] if k > 0 else start + overhead
+        arrivals += list(np.linspace(begin, ends[k], images_per_job + 1)[1:])
+    return positions, range(n_jobs), arrivals
+
+
+class CostModelTest(unittest.TestCase):
+    def test_path_length(self):
+        self.assertEqual(path_length(np.zeros((1, 2))), 0.0)
+        self.assertAlmostEqual(path_length(np.array([[0, 0], [3, 4], [3, 0]], float)), 9.0)
+
+    def test_fit_recovers_parameters(self):
+        rs = np.random.RandomState(0)
+        model = CostModel()
+        for k in range(5):
+            model.observe(1000.0 * k, *make_round(rs, 1000.0 * k, 12.0, 0.001, 4.0, 6))
+        self.assertAlmostEqual(model.job_time, 12.0, 6)
+        self.assertAlmostEqual(model.move_time, 0.001, 9)
+        self.assertAlmostEqual(model.overhead, 4.0, 6)
+
+    def test_too_few_observations(self):
+        model = CostModel()
+        model.observe(0, [[0, 0]], [0], [10.0])
+        self.assertEqual(model.job_time, DEFAULT_JOB_TIME)
+        # fewer images than jobs, the round can't be split into jobs
+        model.observe(0, [[0, 0], [1, 1], [2, 2]], [0, 1, 2], [5.0])
+        self.assertEqual(model.job_time, DEFAULT_JOB_TIME)
+
+    def test_max_rounds(self):
+        model = CostModel(max_rounds=3)
+        for k in range(5):
+            model.observe(k, [[0, 0]], [0], [k + 1.0])
+        self.assertEqual([r['start'] for r in model.rounds], [2.0, 3.0, 4.0])
+
+    def test_estimate(self):
+        model = CostModel(10.0, 0.5, 3.0)
+        self.assertEqual(model.estimate(np.zeros((0, 2))), 0.0)
+        self.assertAlmostEqual(model.estimate(np.array([[0, 0], [0, 4]], float)), 3.0 + 20.0 + 2.0)
+
+    def test_cap(self):
+        model = CostModel(10.0, 0.0, 0.0)
+        positions = np.zeros((5, 2))
+        self.assertEqual(model.cap(positions, [0, 1, 2, 3, 4], 100), range(5))
+        self.assertEqual(model.cap(positions, [0, 1, 2, 3, 4], 30), [0, 1, 2])
+        # highest rank first, the later job first among equal ranks
+        self.assertEqual(model.cap(positions, [4, 0, 0, 0, 1], 30), [1, 2, 3])
+        self.assertEqual(model.cap(positions, [0, 0, 0, 0, 0], 20), [0, 1])
+        self.assertEqual(model.cap(positions, [0, 0, 0, 0, 0], 5), [])
+
+    def test_save_load(self):
+        rs = np.random.RandomState(1)
+        model = CostModel()
+        for k in range(3):
+            model.observe(100.0 * k, *make_round(rs, 100.0 * k, 8.0, 0.002, 1.0, 4))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "costs.json")
+            model.save(filename)
+            model.save(filename) # replaces the file
+            loaded = CostModel.load(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(loaded.rounds, model.rounds)
+        self.assertAlmostEqual(loaded.job_time, model.job_time)
+        self.assertAlmostEqual(loaded.move_time, model.move_time)
+        self.assertAlmostEqual(loaded.overhead, model.overhead)
+
+    def test_simulate(self):
+        model = CostModel(10.0, 0.0, 0.0)
+        model.rounds = [dict(start=0, positions=np.zeros((4, 2)).tolist(), ranks=[0, 1, 2, 3], arrivals=[]),
+                        dict(start=0, positions=np.zeros((2, 2)).tolist(), ranks=[0, 1], arrivals=[])]
+        r = simulate(model, 0, interval=30)
+        self.assertEqual((r['rounds'], r['jobs'], r['kept'], r['overruns']), (2, 6, 6, 1))
+        self.assertAlmostEqual(r['time'], 60.0)
+        r = simulate(model, 20)
+        self.assertEqual((r['kept'], r['overruns']), (4, 0))
+        self.assertAlmostEqual(r['time'], 40.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
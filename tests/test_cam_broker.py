@@ -0,0 +1,203 @@
+"""
+Tests for cam_broker, with the broker and its workers in one process.
+"""
+
+import threading
+import time
+import unittest
+from multiprocessing.connection import Listener
+
+import cam_communicator_class as cc
+from cam_broker import CAMBroker
+
+NAME = "image--L0000--S00--U00--V00--J%02d--E00--O00--X%02d--Y00--T0000--Z%02d--C00.ome.tif"
+
+
+class FakeCAMcommunicator(cc.CAMcommunicator):
+    """records the commands instead of sending them to a CAM server"""
+    def __init__(self):
+        cc.CAMcommunicator.__init__(self)
+        self.connected = True
+        self.verbose = False
+        self.sent = []
+
+    def sendCMDstring(self, cmdstr, seq_counter=False):
+        if self.isBrokered():
+            return cc.CAMcommunicator.sendCMDstring(self, cmdstr, seq_counter)
+        self.sent.append(cmdstr)
+        # give other threads a chance to get in between
+        time.sleep(0.001)
+
+
+def image(job, x, z=0):
+    return dict(relpath=NAME % (job, x, z))
+
+
+class CAMBrokerTest(unittest.TestCase):
+    def setUp(self):
+        self.camc = FakeCAMcommunicator()
+        self.broker = CAMBroker(self.camc)
+
+    def announce(self, msgs):
+        """what the reader thread does with notifications of the CAM server"""
+        self.broker.images.acquire()
+        try:
+            self.camc.queueImagesFromMessages(msgs)
+            self.broker.images.notify_all()
+        finally:
+            self.broker.images.release()
+
+    def run_workers(self, target, n):
+        results = [[] for i in range(n)]
+        threads = [threading.Thread(target=target, args=(results[i],)) for i in range(n)]
+        for t in threads:
+            t.start()
+        return threads, results
+
+    def test_each_image_to_one_worker(self):
+        def worker(received):
+            while True:
+                response, finished = self.broker.do_waitforimage(7, None, 0.5, False)
+                if response is None:
+                    return
+                received.append(response[0])
+        threads, results = self.run_workers(worker, 4)
+        announced = []
+        for x in range(20):
+            # images of other jobs stay in their queues
+            msgs = [image(7, x), image(8, x)]
+            announced.append(msgs[0]['relpath'])
+            self.announce(msgs)
+            time.sleep(0.002)
+        for t in threads:
+            t.join()
+        received = sum(results, [])
+        self.assertEqual(sorted(received), sorted(announced))
+        self.assertEqual(len(self.camc.getQueuedImages(jobnr=8)), 20)
+
+    def test_whole_fields_to_one_worker(self):
+        def worker(received):
+            while True:
+                field, finished = self.broker.do_waitforfield(7, None, 2, [0], 60, 0.5, False)
+                if field is None:
+                    return
+                received.append(field)
+        threads, results = self.run_workers(worker, 3)
+        # the planes of neighbouring fields arrive interleaved
+        for x in range(0, 10, 2):
+            self.announce([image(7, x, 0), image(7, x + 1, 0)])
+            self.announce([image(7, x, 1), image(7, x + 1, 1)])
+        for t in threads:
+            t.join()
+        fields = sum(results, [])
+        self.assertEqual(sorted(int(field.metadata['X'][3:]) for field in fields), range(10))
+        for field in fields:
+            self.assertEqual(sorted(field.planes.keys()), [(0, 0), (1, 0)])
+
+    def test_incomplete_field_after_scan_finished(self):
+        self.announce([image(7, 0, 0)])
+        field, finished = self.broker.do_waitforfield(7, None, 2, [0], 60, 0.1, False)
+        self.assertEqual((field, finished), (None, False))
+        self.announce([dict(inf="scanfinished")])
+        # not handed out unless asked for
+        field, finished = self.broker.do_waitforfield(7, None, 2, [0], 60, 0.1, False)
+        self.assertEqual((field, finished), (None, True))
+        field, finished = self.broker.do_waitforfield(7, None, 2, [0], 60, 0.1, True)
+        self.assertTrue(finished)
+        self.assertEqual(field.planes.keys(), [(0, 0)])
+        self.assertEqual(self.broker.do_waitforfield(7, None, 2, [0], 60, 0.1, True), (None, True))
+        self.broker.do_resetScanFinished()
+        self.assertFalse(self.camc.scan_finished)
+
+    def test_timed_out_field(self):
+        self.announce([image(7, 0, 0)])
+        start = time.time()
+        field, finished = self.broker.do_waitforfield(7, None, 2, [0], 0.2, 5, False)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(field.planes.keys(), [(0, 0)])
+
+    def test_batches_not_interleaved(self):
+        def worker(received, k):
+            for i in range(5):
+                self.broker.do_sendCommands(["batch %d.%d cmd %d" % (k, i, j) for j in range(4)])
+        threads = [threading.Thread(target=worker, args=(None, k)) for k in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        sent = self.camc.sent
+        self.assertEqual(len(sent), 4 * 5 * 4)
+        for start in range(0, len(sent), 4):
+            batch = sent[start].split(" cmd ")[0]
+            self.assertEqual(sent[start:start + 4], [batch + " cmd %d" % j for j in range(4)])
+
+
+class BrokeredWorkerTest(unittest.TestCase):
+    """workers talking to the broker through multiprocessing connections, as in CellProfiler's analysis workers"""
+    def setUp(self):
+        self.camc = FakeCAMcommunicator()
+        self.broker = CAMBroker(self.camc)
+        self.listener = Listener(('localhost', 0), authkey=cc.BROKER_AUTHKEY)
+        accept = threading.Thread(target=self.accept)
+        accept.daemon = True
+        accept.start()
+
+    def tearDown(self):
+        self.listener.close()
+
+    def accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception:
+                return
+            worker = threading.Thread(target=self.broker.serve_worker, args=(conn,))
+            worker.daemon = True
+            worker.start()
+
+    def worker(self):
+        camc = FakeCAMcommunicator()
+        camc.poll_interval = 0.05
+        camc.setBroker(self.listener.address)
+        self.assertTrue(camc.open())
+        return camc
+
+    def test_images_and_fields(self):
+        worker = self.worker()
+        self.broker.images.acquire()
+        try:
+            self.camc.queueImagesFromMessages([image(7, 0), image(9, 0, 0), image(9, 0, 1)])
+        finally:
+            self.broker.images.release()
+        self.assertEqual(worker.waitforimage(jobnr=7, timeout=5)[1]['X'], "--X00")
+        self.assertEqual(worker.waitforimage(jobnr=7, timeout=0.2), None)
+        field = worker.waitforfieldFromBroker(9, 2, [0], 60, timeout=5)
+        self.assertEqual(sorted(field.planes.keys()), [(0, 0), (1, 0)])
+
+    def test_command_batches(self):
+        workers = [self.worker() for k in range(3)]
+        def send(camc, k):
+            for i in range(3):
+                camc.beginCommands()
+                camc.deleteCAMList()
+                for j in range(3):
+                    camc.addJobToCAMlist("hires%d.%d" % (k, i), j, j)
+                camc.startCAMScan()
+                camc.endCommands()
+        threads = [threading.Thread(target=send, args=(workers[k], k)) for k in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        sent = self.camc.sent
+        self.assertEqual(len(sent), 3 * 3 * 5)
+        for start in range(0, len(sent), 5):
+            batch = sent[start:start + 5]
+            self.assertTrue("deletelist" in batch[0])
+            self.assertTrue("startcamscan" in batch[4])
+            names = set(cmd.split("/exp:")[1].split()[0] for cmd in batch[1:4])
+            self.assertEqual(len(names), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+"""
+Tests for the image queues of cam_communicator_class.
+"""
+
+import errno
+import socket
+import threading
+import time
+import unittest
+
+from cam_communicator_class import CAMcommunicator
+
+
+def message(job, x=0, z=0, jobname=None, u=0):
+    m = dict(relpath="image--L0000--S00--U%02d--V00--J%02d--E00--O00--X%02d--Y00--T0000--Z%02d--C00.ome.tif" % (u, job, x, z))
+    if jobname is not None:
+        m['jobname'] = jobname
+    return m
+
+
+class ImageQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.camc = CAMcommunicator()
+        self.camc.basepath = "/data/"
+
+    def test_demultiplexed_per_job(self):
+        msgs = [message(7, 0), message(8, 0), message(7, 1), dict(inf="other"), message(8, 1)]
+        self.assertEqual(self.camc.queueImagesFromMessages(msgs), 4)
+        first = self.camc.popQueuedImage(jobnr=7)
+        self.assertEqual(first[0], "/data/" + msgs[0]['relpath'])
+        self.assertEqual(first[1]['job'], "--J07")
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7)[0], "/data/" + msgs[2]['relpath'])
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7), None)
+        # the images of job 8 are still there
+        self.assertEqual(self.camc.popQueuedImage(jobnr=8)[0], "/data/" + msgs[1]['relpath'])
+
+    def test_pop_oldest_of_any_job(self):
+        msgs = [message(8, 0), message(7, 0), message(8, 1)]
+        self.camc.queueImagesFromMessages(msgs)
+        popped = [self.camc.popQueuedImage()[0] for m in msgs]
+        self.assertEqual(popped, ["/data/" + m['relpath'] for m in msgs])
+        self.assertEqual(self.camc.popQueuedImage(), None)
+
+    def test_duplicates(self):
+        msgs = [message(7, 0), message(7, 0), message(7, 1), message(7, 0)]
+        # only a repeated notification of the same file is a duplicate
+        self.assertEqual(self.camc.queueImagesFromMessages(msgs), 3)
+        self.camc.clearImageQueues()
+        self.camc.previous_file = ""
+        self.assertEqual(self.camc.queueImagesFromMessages(msgs, ignoreduplicates=False), 4)
+
+    def test_duplicates_across_calls(self):
+        self.camc.queueImagesFromMessages([message(7, 0)])
+        self.assertEqual(self.camc.queueImagesFromMessages([message(7, 0)]), 0)
+
+    def test_unparsable_filename(self):
+        self.assertEqual(self.camc.queueImagesFromMessages([dict(relpath="notes.txt")]), 0)
+        self.assertEqual(self.camc.popQueuedImage(), None)
+
+    def test_jobname(self):
+        self.camc.queueImagesFromMessages([message(7, 0, jobname="LowRes"), message(7, 1, jobname="hires"), message(7, 2)])
+        self.assertEqual(self.camc.popQueuedImage(jobname="lowres")[1]['X'], "--X00")
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7, jobname="lowres"), None)
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7, jobname="HIRES")[1]['X'], "--X01")
+        # images without a job name only match if no job name is asked for
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7)[1]['X'], "--X02")
+
+    def test_get_queued_images(self):
+        msgs = [message(7, 0), message(8, 0, jobname="hires"), message(9, 0), message(8, 1, jobname="hires")]
+        self.camc.queueImagesFromMessages(msgs)
+        collected = self.camc.getQueuedImages(excludeJobnr=7)
+        self.assertEqual([fname for arrival, fname, md, jobname in collected], ["/data/" + msgs[k]['relpath'] for k in (1, 2, 3)])
+        self.assertEqual([jobname for arrival, fname, md, jobname in collected], ["hires", None, "hires"])
+        arrivals = [arrival for arrival, fname, md, jobname in collected]
+        self.assertEqual(arrivals, sorted(arrivals))
+        # each image is handed out only once
+        self.assertEqual(self.camc.getQueuedImages(excludeJobnr=7), [])
+        self.assertEqual(self.camc.popQueuedImage(jobnr=7)[0], "/data/" + msgs[0]['relpath'])
+
+    def test_queue_limit(self):
+        self.camc.max_queued_images = 3
+        self.camc.queueImagesFromMessages([message(7, x) for x in range(5)])
+        self.assertEqual([md['X'] for arrival, fname, md, jobname in self.camc.getQueuedImages(jobnr=7)], ["--X02", "--X03", "--X04"])
+
+    def test_scan_finished(self):
+        self.camc.queueImagesFromMessages([message(7, 0), dict(inf="scanfinished")])
+        self.assertTrue(self.camc.scan_finished)
+        self.camc.resetScanFinished()
+        self.assertFalse(self.camc.scan_finished)
+
+    def test_image_arrivals(self):
+        self.camc.queueImagesFromMessages([message(7, 0), message(9, 0, jobname="hires"), message(9, 1, jobname="hires", u=2),
+                                           message(9, 2, u=2)])
+        # taking images from the queues doesn't affect the log
+        self.camc.getQueuedImages()
+        self.assertEqual(len(self.camc.getImageArrivals()), 4)
+        self.assertEqual(len(self.camc.getImageArrivals(jobname="HiRes")), 2)
+        self.assertEqual(len(self.camc.getImageArrivals(jobnr=9)), 3)
+        self.assertEqual(len(self.camc.getImageArrivals(excludeJobnr=9)), 1)
+        # fields are (slide, U, V, X, Y)
+        self.assertEqual(len(self.camc.getImageArrivals(fields=[(0, 0, 0, 0, 0)])), 2)
+        self.assertEqual(len(self.camc.getImageArrivals(excludeJobnr=7, fields=[[0, 0, 0, 0, 0], (0, 2, 0, 2, 0)])), 2)
+        self.assertEqual(self.camc.getImageArrivals(since=self.camc.getImageArrivals()[-1]), [])
+
+    def test_waitforimage_takes_queued_images_first(self):
+        # no connection is needed for images that were already received
+        self.camc.queueImagesFromMessages([message(8, 0), message(7, 0)])
+        self.assertEqual(self.camc.waitforimage(jobnr=7)[1]['job'], "--J07")
+        self.assertEqual(self.camc.waitforimage(jobnr=8)[1]['job'], "--J08")
+
+
+class FailingSocket:
+    """wraps a socket, recv() raises the given errors first, the last one on every call if persistent is True"""
+    def __init__(self, sock, errors, persistent=False):
+        self.sock = sock
+        self.errors = list(errors)
+        self.persistent = persistent
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, size):
+        if self.persistent and len(self.errors) == 1:
+            raise self.errors[0]
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.sock.recv(size)
+
+    def close(self):
+        self.sock.close()
+
+
+class ConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.camc = CAMcommunicator()
+        self.camc.basepath = "/data/"
+        self.camc.poll_interval = 0.05
+        self.camc.leicasocket, self.server = socket.socketpair()
+        self.camc.connected = True
+
+    def tearDown(self):
+        self.server.close()
+        self.camc.leicasocket.close()
+
+    def notify(self, job, x=0):
+        self.server.sendall("/cli:EMBL /app:matrix /relpath:" + message(job, x)['relpath'] + "\r\n")
+
+    def test_receives_notifications(self):
+        self.notify(7)
+        self.assertEqual(self.camc.waitforimage(jobnr=7, timeout=5)[1]['job'], "--J07")
+        self.assertTrue(self.camc.isConnected())
+
+    def test_closed_by_server(self):
+        self.server.close()
+        start = time.time()
+        self.assertEqual(self.camc.waitforimage(jobnr=7), None)
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(self.camc.isConnected())
+
+    def test_connection_reset(self):
+        # without a timeout the wait must not keep polling a dead socket, the timer only ends the test if it does
+        self.camc.leicasocket = FailingSocket(self.camc.leicasocket, [socket.error(errno.ECONNRESET, "Connection reset by peer")], True)
+        self.notify(7)
+        timer = threading.Timer(3, self.camc.cancel)
+        timer.start()
+        try:
+            self.assertEqual(self.camc.waitforimage(jobnr=7), None)
+        finally:
+            timer.cancel()
+        self.assertFalse(self.camc.isCancelled())
+        self.assertFalse(self.camc.isConnected())
+
+    def test_interrupted_receive_is_retried(self):
+        self.camc.leicasocket = FailingSocket(self.camc.leicasocket, [socket.error(errno.EINTR, "Interrupted system call")])
+        self.notify(7)
+        self.assertEqual(self.camc.waitforimage(jobnr=7, timeout=5)[1]['job'], "--J07")
+        self.assertTrue(self.camc.isConnected())
+
+
+if __name__ == "__main__":
+    unittest.main()
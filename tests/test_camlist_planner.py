@@ -0,0 +1,245 @@
+"""
+Tests for camlist_planner.
+"""
+
+import json
+import time
+import unittest
+import numpy as np
+
+from camlist_planner import TopKSelector, cluster_points, order_positions, order_jobs, job_field, JobAccumulator
+
+
+class TopKSelectorTest(unittest.TestCase):
+    def test_keeps_best_over_fields(self):
+        rs = np.random.RandomState(0)
+        selector = TopKSelector(5)
+        scores = []
+        for field in range(4):
+            s = rs.rand(20)
+            items = ["f%d-%d" % (field, i) for i in range(20)]
+            selector.addField("well", s, items)
+            scores += zip(s, items)
+        expected = [item for score, item in sorted(scores, reverse=True)[:5]]
+        self.assertEqual(selector.pop("well"), expected)
+        self.assertEqual(selector.keys(), [])
+
+    def test_smallest(self):
+        selector = TopKSelector(2, largest=False)
+        selector.addField("w", [3.0, 1.0, 2.0, 0.5], ["a", "b", "c", "d"])
+        self.assertEqual(selector.pop("w"), ["d", "b"])
+
+    def test_nan_ranks_last(self):
+        selector = TopKSelector(2)
+        selector.addField("w", [np.nan, 1.0, np.nan], ["a", "b", "c"])
+        self.assertEqual(selector.pop("w")[0], "b")
+
+    def test_fewer_candidates_than_k(self):
+        selector = TopKSelector(10)
+        selector.addField("w", [1.0, 2.0], ["a", "b"])
+        self.assertEqual(selector.pop("w"), ["b", "a"])
+
+    def test_keys_are_independent(self):
+        selector = TopKSelector(1)
+        selector.addField("a", [1.0], ["x"])
+        selector.addField("b", [5.0], ["y"])
+        self.assertEqual(selector.pop("a"), ["x"])
+        self.assertEqual(selector.pop("b"), ["y"])
+        self.assertEqual(selector.pop("c"), [])
+
+    def test_equal_scores_never_compare_items(self):
+        selector = TopKSelector(2)
+        selector.addField("w", [1.0, 1.0, 1.0], [dict(n=1), dict(n=2), dict(n=3)])
+        self.assertEqual(len(selector.pop("w")), 2)
+
+    def test_k_zero(self):
+        selector = TopKSelector(0)
+        selector.addField("w", [1.0], ["a"])
+        self.assertEqual(selector.keys(), [])
+
+    def test_late_objects_fill_remaining_places(self):
+        selector = TopKSelector(3)
+        selector.addField("w", [5.0, 4.0], ["a", "b"])
+        # deadline: the well is popped before it is done
+        self.assertEqual(selector.pop("w", done=False), ["a", "b"])
+        self.assertEqual(selector.age("w"), 0.0)
+        selector.addField("w", [9.0, 8.0, 7.0], ["c", "d", "e"])
+        self.assertEqual(selector.pop("w", done=False), ["c"])
+        # the well has had its k objects, later ones are ignored
+        selector.addField("w", [10.0], ["f"])
+        self.assertEqual(selector.keys(), ["w"])
+        self.assertEqual(selector.pop("w"), [])
+        # once the well is done its count is forgotten
+        self.assertEqual(selector.keys(), [])
+        selector.addField("w", [1.0, 2.0, 3.0, 4.0], ["g", "h", "i", "j"])
+        self.assertEqual(selector.pop("w"), ["j", "i", "h"])
+
+    def test_state_round_trip(self):
+        selector = TopKSelector(2)
+        selector.addField("w", [1.0, 3.0, 2.0], ["a", "b", "c"])
+        selector.addField("x", [1.0], ["y"])
+        selector.pop("x", done=False)
+        restored = TopKSelector(2)
+        restored.restore(json.loads(json.dumps(selector.state())))
+        restored.addField("w", [2.5], ["d"])
+        self.assertEqual(restored.pop("w"), ["b", "d"])
+        restored.addField("x", [3.0, 2.0], ["z", "v"])
+        self.assertEqual(restored.pop("x"), ["z"])
+
+
+class ClusterPointsTest(unittest.TestCase):
+    def check_clusters(self, x, y, width, height, labels, centres):
+        self.assertTrue((labels >= 0).all())
+        self.assertEqual(len(centres), labels.max() + 1)
+        for label, (cx, cy) in enumerate(centres):
+            members = labels == label
+            self.assertTrue(members.any())
+            self.assertTrue(np.ptp(x[members]) <= width and np.ptp(y[members]) <= height)
+            self.assertAlmostEqual(cx, (x[members].min() + x[members].max()) / 2.0)
+            self.assertAlmostEqual(cy, (y[members].min() + y[members].max()) / 2.0)
+
+    def test_empty(self):
+        labels, centres = cluster_points([], [], 10, 10)
+        self.assertEqual(len(labels), 0)
+        self.assertEqual(centres, [])
+
+    def test_separate_groups(self):
+        x = np.array([0, 2, 1, 100, 103, 500])
+        y = np.array([0, 1, 3, 100, 98, 0])
+        labels, centres = cluster_points(x, y, 10, 10)
+        self.assertEqual(len(centres), 3)
+        self.assertEqual(len(set(labels[:3])), 1)
+        self.assertEqual(len(set(labels[3:5])), 1)
+        self.assertEqual(len(set(labels)), 3)
+        self.check_clusters(x, y, 10, 10, labels, centres)
+
+    def test_random_points_fit_field(self):
+        rs = np.random.RandomState(1)
+        x = rs.rand(300) * 1000
+        y = rs.rand(300) * 500
+        labels, centres = cluster_points(x, y, 64, 48)
+        self.check_clusters(x, y, 64, 48, labels, centres)
+        self.assertTrue(len(centres) < 300)
+
+    def test_points_on_cell_borders(self):
+        # points just across a grid cell border still end up together
+        x = np.array([9.9, 10.1])
+        y = np.array([5.0, 5.0])
+        labels, centres = cluster_points(x, y, 10, 10)
+        self.assertEqual(len(centres), 1)
+        self.assertAlmostEqual(centres[0][0], 10.0)
+
+
+def path_length(positions, order):
+    steps = np.diff(positions[order], axis=0)
+    return np.sqrt((steps ** 2).sum(axis=1)).sum()
+
+
+def job(slide, wellx, welly, fieldx=1, fieldy=1, dxpos=0, dypos=0):
+    return dict(slide=slide, wellx=wellx, welly=welly, fieldx=fieldx, fieldy=fieldy, dxpos=dxpos, dypos=dypos)
+
+
+class OrderTest(unittest.TestCase):
+    def test_small(self):
+        self.assertEqual(list(order_positions(np.zeros((0, 2)))), [])
+        self.assertEqual(list(order_positions(np.zeros((2, 2)))), [0, 1])
+
+    def test_permutation_starting_at_first(self):
+        rs = np.random.RandomState(2)
+        positions = rs.rand(60, 2) * 100
+        order = order_positions(positions)
+        self.assertEqual(order[0], 0)
+        self.assertEqual(sorted(order), range(60))
+        self.assertTrue(path_length(positions, order) < path_length(positions, np.arange(60)))
+
+    def test_line(self):
+        # points on a line, shuffled, must be visited in sequence
+        rs = np.random.RandomState(3)
+        x = np.concatenate([[0], rs.permutation(np.arange(1, 20))])
+        positions = np.column_stack([x, np.zeros(20)]).astype(float)
+        order = order_positions(positions)
+        self.assertEqual(list(x[order]), range(20))
+
+    def test_two_opt_local_optimum(self):
+        rs = np.random.RandomState(4)
+        positions = rs.rand(40, 2)
+        nearest = order_positions(positions, 0)
+        order = order_positions(positions)
+        length = path_length(positions, order)
+        self.assertTrue(length < path_length(positions, nearest))
+        # no reversal of a section after the first position shortens the path
+        for i in range(1, 40):
+            for j in range(i + 1, 40):
+                other = order.copy()
+                other[i:j + 1] = other[i:j + 1][::-1]
+                self.assertTrue(path_length(positions, other) >= length - 1e-9)
+
+    def test_job_field(self):
+        self.assertEqual(job_field(job(1, 3, 2, fieldx=4, fieldy=1)), (0, 2, 1, 3, 0))
+        self.assertEqual(job_field(dict(slide="2", wellx="1", welly="1", fieldx="1", fieldy="2")), (1, 0, 0, 0, 1))
+
+    def test_jobs_keep_slides(self):
+        jobs = [job(2, 3, 1), job(1, 1, 1), job(2, 1, 1), job(1, 3, 1), job(1, 2, 1), job(2, 2, 1)]
+        ordered = order_jobs(jobs, 9.0, 1.0, 0.001)
+        self.assertEqual([j['slide'] for j in ordered], [2, 2, 2, 1, 1, 1])
+        self.assertEqual([j['wellx'] for j in ordered], [3, 2, 1, 1, 2, 3])
+        self.assertEqual(sorted(map(id, ordered)), sorted(map(id, jobs)))
+
+
+class JobAccumulatorTest(unittest.TestCase):
+    def test_max_jobs(self):
+        acc = JobAccumulator(max_jobs=3)
+        self.assertEqual(acc.add([1, 2]), None)
+        self.assertEqual(len(acc), 2)
+        self.assertEqual(acc.add([3, 4]), [1, 2, 3, 4])
+        self.assertEqual(len(acc), 0)
+
+    def test_max_fields(self):
+        acc = JobAccumulator(max_fields=2)
+        self.assertEqual(acc.add([]), None)
+        self.assertEqual(acc.add([1]), [1])
+        self.assertEqual(acc.add([2]), None)
+
+    def test_max_age(self):
+        acc = JobAccumulator(max_age=0.05)
+        self.assertEqual(acc.add([1]), None)
+        # image sets without jobs do not start the clock
+        acc.flush()
+        self.assertEqual(acc.add([]), None)
+        time.sleep(0.1)
+        self.assertEqual(acc.add([2]), None)
+        time.sleep(0.1)
+        self.assertEqual(acc.add([3]), [2, 3])
+
+    def test_no_limits(self):
+        acc = JobAccumulator()
+        for k in range(10):
+            self.assertEqual(acc.add([k]), None)
+        self.assertEqual(acc.flush(), range(10))
+        self.assertEqual(acc.flush(), [])
+
+    def test_group_change(self):
+        acc = JobAccumulator(max_jobs=10)
+        self.assertEqual(acc.add([1], group=("A", 1)), None)
+        self.assertEqual(acc.add([2], group=("A", 1)), None)
+        self.assertEqual(acc.add([3], group=("B", 1)), [1, 2])
+        self.assertEqual(len(acc), 1)
+
+    def test_group_change_and_limit(self):
+        acc = JobAccumulator(max_jobs=2)
+        acc.add([1], group="A")
+        self.assertEqual(acc.add([2, 3], group="B"), [1, 2, 3])
+
+    def test_state_round_trip(self):
+        acc = JobAccumulator(max_jobs=10)
+        acc.add([dict(n=1)], group=("A", 1))
+        restored = JobAccumulator(max_jobs=10)
+        restored.restore(json.loads(json.dumps(acc.state())))
+        self.assertEqual(len(restored), 1)
+        # the restored group still matches a tuple group
+        self.assertEqual(restored.add([dict(n=2)], group=("A", 1)), None)
+        self.assertEqual(restored.add([], group=("B", 1)), [dict(n=1), dict(n=2)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+Tests for checkpoint.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from checkpoint import Checkpoint, ProcessedFields, checkpoint_filename
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "export.lcc_checkpoint")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_filename(self):
+        self.assertEqual(checkpoint_filename(os.path.join("a", "export") + os.sep),
+                         checkpoint_filename(os.path.join("a", "export")))
+        # not the current directory
+        self.assertRaises(ValueError, checkpoint_filename, "")
+        self.assertRaises(ValueError, checkpoint_filename, " ")
+
+    def test_round_trip(self):
+        checkpoint = Checkpoint(self.filename)
+        self.assertFalse(checkpoint.load())
+        checkpoint.set("fields", dict(n=3))
+        checkpoint.save(force=True)
+        loaded = Checkpoint(self.filename)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.get("fields"), dict(n=3))
+        self.assertEqual(loaded.get("missing", 5), 5)
+
+    def test_interval(self):
+        checkpoint = Checkpoint(self.filename, interval=3600)
+        checkpoint.set("a", 1)
+        checkpoint.save(force=True)
+        checkpoint.set("a", 2)
+        checkpoint.save() # too soon after the last save
+        loaded = Checkpoint(self.filename)
+        loaded.load()
+        self.assertEqual(loaded.get("a"), 1)
+        checkpoint.save(force=True)
+        loaded.load()
+        self.assertEqual(loaded.get("a"), 2)
+
+    def test_temporary_file(self):
+        # a crash between writing the temporary file and renaming it
+        checkpoint = Checkpoint(self.filename)
+        checkpoint.set("a", 1)
+        checkpoint.save(force=True)
+        os.rename(self.filename, self.filename + ".tmp")
+        loaded = Checkpoint(self.filename)
+        self.assertTrue(loaded.load())
+        self.assertEqual(loaded.get("a"), 1)
+
+    def test_corrupt_file(self):
+        f = open(self.filename, 'w')
+        f.write("{")
+        f.close()
+        self.assertFalse(Checkpoint(self.filename).load())
+
+
+class ProcessedFieldsTest(unittest.TestCase):
+    def test_pruned_per_timepoint(self):
+        fields = ProcessedFields()
+        fields.add("A", (1, 0))
+        fields.add("B", (1, 0))
+        self.assertTrue(fields.contains("A", (1, 0)))
+        self.assertFalse(fields.contains("C", (1, 0)))
+        fields.add("A", (1, 1))
+        self.assertEqual(len(fields), 1)
+        # earlier timepoints count as processed
+        self.assertTrue(fields.contains("B", (1, 0)))
+        self.assertFalse(fields.contains("B", (1, 1)))
+        # a late field of an earlier timepoint doesn't reset the current one
+        fields.add("C", (1, 0))
+        self.assertEqual(fields.timepoint, (1, 1))
+
+    def test_state_round_trip(self):
+        fields = ProcessedFields()
+        fields.add("A", (2, 3))
+        restored = ProcessedFields()
+        restored.restore(json.loads(json.dumps(fields.state())))
+        self.assertEqual(restored.timepoint, (2, 3))
+        self.assertTrue(restored.contains("A", (2, 3)))
+        self.assertTrue(restored.contains("Z", (2, 2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
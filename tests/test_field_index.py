@@ -0,0 +1,82 @@
+"""
+Tests for field_index.
+"""
+
+import time
+import unittest
+
+from field_index import FieldIndex, fieldKey, fieldTimepoint
+
+NAME = "image--L0000--S00--U01--V02--J07--E00--O00--X%02d--Y00--T%04d--Z%02d--C%02d.ome.tif"
+
+
+def metadata(x=0, z=0, c=0, t=0):
+    """what CAMcommunicator.parseLeicaFilename() returns for NAME % (x, t, z, c)"""
+    return dict(prefix="image", loop="--L0000", slide="--S00", M="", U="--U01", V="--V02", job="--J07", E="--E00",
+                other="--O00", X="--X%02d" % x, Y="--Y00", tpoint="--T%04d" % t, zpos="--Z%02d" % z,
+                channel="--C%02d" % c, suffix="")
+
+
+def announce(index, x=0, z=0, c=0, t=0):
+    return index.add(NAME % (x, t, z, c), metadata(x, z, c, t))
+
+
+class FieldKeyTest(unittest.TestCase):
+    def test_planes_of_a_field_share_the_key(self):
+        self.assertEqual(fieldKey(metadata(z=0, c=0)), fieldKey(metadata(z=3, c=1)))
+        self.assertNotEqual(fieldKey(metadata(x=0)), fieldKey(metadata(x=1)))
+        self.assertNotEqual(fieldKey(metadata(t=0)), fieldKey(metadata(t=1)))
+
+    def test_timepoint(self):
+        self.assertEqual(fieldTimepoint(metadata(t=12)), (0, 12))
+        self.assertTrue(fieldTimepoint(metadata(t=2)) < fieldTimepoint(metadata(t=10)))
+
+
+class FieldIndexTest(unittest.TestCase):
+    def test_complete_field(self):
+        index = FieldIndex(nr_of_slices=2, channels=(0, 1), timeout=60)
+        planes = [(0, 0), (1, 0), (0, 1)]
+        for z, c in planes:
+            self.assertFalse(announce(index, z=z, c=c))
+            self.assertTrue(index.popReady() is None)
+        self.assertEqual(index.pending(), 1)
+        self.assertTrue(announce(index, z=1, c=1))
+        field = index.popReady()
+        self.assertEqual(sorted(field.planes.keys()), [(0, 0), (0, 1), (1, 0), (1, 1)])
+        self.assertEqual(field.slices(1), [(0, NAME % (0, 0, 0, 1)), (1, NAME % (0, 0, 1, 1))])
+        # the metadata of the highest Z slice is kept
+        self.assertEqual(field.metadata['zpos'], "--Z01")
+        self.assertEqual(index.pending(), 0)
+
+    def test_fields_in_completion_order(self):
+        index = FieldIndex(nr_of_slices=2)
+        announce(index, x=0, z=0)
+        announce(index, x=1, z=0)
+        announce(index, x=1, z=1)
+        announce(index, x=0, z=1)
+        self.assertEqual(index.popReady().metadata['X'], "--X01")
+        self.assertEqual(index.popReady().metadata['X'], "--X00")
+        self.assertTrue(index.popReady() is None)
+
+    def test_timeout_hands_out_incomplete_field(self):
+        index = FieldIndex(nr_of_slices=3, timeout=0.05)
+        announce(index, z=0)
+        self.assertTrue(index.nextDeadline() is not None)
+        self.assertTrue(index.popReady() is None)
+        time.sleep(0.1)
+        field = index.popReady()
+        self.assertEqual(list(field.planes.keys()), [(0, 0)])
+        self.assertTrue(index.nextDeadline() is None)
+
+    def test_pop_oldest(self):
+        index = FieldIndex(nr_of_slices=3)
+        self.assertTrue(index.popOldest() is None)
+        announce(index, x=0)
+        time.sleep(0.01)
+        announce(index, x=1)
+        self.assertEqual(index.popOldest().metadata['X'], "--X00")
+        self.assertEqual(index.popOldest().metadata['X'], "--X01")
+
+
+if __name__ == "__main__":
+    unittest.main()
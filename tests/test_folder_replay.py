@@ -0,0 +1,96 @@
+"""
+Tests for folder_replay.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import folder_replay
+from folder_replay import FolderReplay
+from cam_communicator_class import CAMcommunicator
+
+NAME = "image--L0000--S00--U%02d--V00--J%02d--E00--O00--X%02d--Y00--T0000--Z%02d--C%02d.ome.tif"
+
+
+class FolderReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.parse = CAMcommunicator().parseLeicaFilename
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, mtime, subdir=""):
+        dirname = os.path.join(self.tmpdir, subdir)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fname = os.path.join(dirname, name)
+        f = open(fname, 'wb')
+        f.write(b'\0' * 100)
+        f.close()
+        os.utime(fname, (mtime, mtime))
+        return fname
+
+    def test_acquisition_order(self):
+        # fields in acquisition order: U01/X00, U00/X01, U00/X00, spread over two folders
+        self.write(NAME % (0, 7, 0, 0, 0), 3000, "chamber--U00")
+        self.write(NAME % (0, 7, 0, 1, 0), 3001, "chamber--U00")
+        self.write(NAME % (0, 7, 1, 0, 0), 2000, "chamber--U00")
+        self.write(NAME % (1, 7, 0, 0, 0), 1000, "chamber--U01")
+        self.write(NAME % (1, 7, 0, 0, 1), 999, "chamber--U01")
+        self.write("notes.txt", 0)
+        replay = FolderReplay(self.tmpdir, self.parse, jobnr=7)
+        self.assertEqual(replay.scan(), 3)
+        self.assertEqual([(replay.field(i).metadata['U'], replay.field(i).metadata['X']) for i in range(len(replay))],
+                         [("--U01", "--X00"), ("--U00", "--X01"), ("--U00", "--X00")])
+        self.assertEqual(sorted(replay.field(0).planes.keys()), [(0, 0), (0, 1)])
+        self.assertEqual(sorted(replay.field(2).planes.keys()), [(0, 0), (1, 0)])
+        # the field is represented by its plane with the highest Z index
+        self.assertEqual(replay.field(2).metadata['zpos'], "--Z01")
+
+    def test_job_filter(self):
+        self.write(NAME % (0, 3, 0, 0, 0), 1000) # e.g. an autofocus job, acquired first
+        self.write(NAME % (0, 7, 0, 0, 0), 2000)
+        self.write(NAME % (0, 7, 1, 0, 0), 3000)
+        replay = FolderReplay(self.tmpdir, self.parse, jobnr=7)
+        self.assertEqual(replay.scan(), 2)
+        # without a job number, the job of the first acquired image is replayed
+        replay = FolderReplay(self.tmpdir, self.parse)
+        self.assertEqual(replay.scan(), 1)
+        self.assertEqual(replay.jobnr, 3)
+
+    def test_empty_folder(self):
+        replay = FolderReplay(self.tmpdir, self.parse)
+        self.assertEqual(replay.scan(), 0)
+        replay.close()
+
+    def test_prefetch_and_close(self):
+        for x in range(6):
+            self.write(NAME % (0, 7, x, 0, 0), 1000 + x)
+        replay = FolderReplay(self.tmpdir, self.parse, jobnr=7)
+        replay.scan()
+        warmed = []
+        original = folder_replay.warmFile
+        folder_replay.warmFile = warmed.append
+        try:
+            replay.prefetch(0, 2)
+            replay.prefetch(1, 2) # only the field not handed out yet is added
+            threads = list(replay.prefetch_threads)
+            self.assertEqual(len(threads), folder_replay.PREFETCH_THREADS)
+            replay.close()
+        finally:
+            folder_replay.warmFile = original
+        for t in threads:
+            self.assertFalse(t.is_alive())
+        self.assertEqual(replay.prefetch_threads, [])
+        self.assertTrue(set(warmed) <= set(replay.field(i).filename for i in (1, 2, 3)))
+        # prefetching starts new threads after close()
+        replay.prefetch(0, 1)
+        self.assertEqual(len(replay.prefetch_threads), folder_replay.PREFETCH_THREADS)
+        replay.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Tests for illumination.
+"""
+
+import unittest
+import numpy as np
+
+from illumination import RunningFlatField, upsample_linear
+
+
+def vignetting(shape=(64, 64)):
+    """illumination falling off towards the corners, mean about 1"""
+    y, x = np.mgrid[0:shape[0], 0:shape[1]].astype(np.float32)
+    r2 = ((y - shape[0] / 2.0) / shape[0]) ** 2 + ((x - shape[1] / 2.0) / shape[1]) ** 2
+    illum = 1.0 - r2
+    return illum / illum.mean()
+
+
+def fields(n, shape=(64, 64), seed=0):
+    """n fields of a flat sample with a few bright objects at random places, under vignetting"""
+    rs = np.random.RandomState(seed)
+    illum = vignetting(shape)
+    for i in range(n):
+        sample = np.full(shape, 1000.0, np.float32)
+        for j in range(3):
+            y, x = rs.randint(0, shape[0] - 8), rs.randint(0, shape[1] - 8)
+            sample[y:y+8, x:x+8] = 4000
+        yield sample * illum
+
+
+class UpsampleTest(unittest.TestCase):
+    def test_constant(self):
+        np.testing.assert_allclose(upsample_linear(np.full((4, 4), 2.0), (16, 16), 4), 2.0)
+
+    def test_shape_and_block_centres(self):
+        small = np.array([[0.0, 1.0], [2.0, 3.0]])
+        big = upsample_linear(small, (8, 8), 4)
+        self.assertEqual(big.shape, (8, 8))
+        # pixels around a block centre and at the borders keep the block value
+        self.assertAlmostEqual(big[0, 0], 0.0)
+        self.assertAlmostEqual(big[7, 7], 3.0)
+        self.assertTrue(0 < big[3, 4] < 3)
+
+
+class RunningFlatFieldTest(unittest.TestCase):
+    def test_no_correction_before_min_images(self):
+        ff = RunningFlatField(factor=8, history=20, min_images=5, update_interval=1)
+        for img in fields(4):
+            ff.add(img)
+        self.assertTrue(ff.illumination() is None)
+        img = np.ones((64, 64), np.float32)
+        self.assertTrue(ff.apply(img) is img)
+
+    def test_recovers_vignetting(self):
+        ff = RunningFlatField(factor=8, history=20, min_images=5, update_interval=1)
+        for img in fields(20):
+            ff.add(img)
+        self.assertEqual(ff.nrOfImages(), 20)
+        illum = ff.illumination()
+        self.assertAlmostEqual(float(illum.mean()), 1.0, places=1)
+        # the objects are removed by the median, the smooth pattern is recovered closely
+        np.testing.assert_allclose(illum[8:-8, 8:-8], vignetting()[8:-8, 8:-8], rtol=0.05)
+        corrected = ff.apply(next(fields(1, seed=99)))
+        background = corrected[corrected < 2000]
+        self.assertTrue(background.std() / background.mean() < 0.03)
+
+    def test_integer_images_keep_their_type(self):
+        ff = RunningFlatField(factor=8, min_images=1, update_interval=1)
+        img = np.full((64, 64), 65000, np.uint16)
+        ff.add(np.full((64, 64), 1.0, np.float32) * vignetting())
+        corrected = ff.apply(img)
+        self.assertEqual(corrected.dtype, np.uint16)
+        self.assertEqual(corrected.max(), 65535)
+
+    def test_history_is_bounded(self):
+        ff = RunningFlatField(factor=8, history=3, min_images=1)
+        for img in fields(10):
+            ff.add(img)
+        self.assertEqual(ff.nrOfImages(), 3)
+        self.assertEqual(ff.buffer.shape[0], 3)
+
+    def test_shape_change_restarts(self):
+        ff = RunningFlatField(factor=8, min_images=1)
+        ff.add(np.ones((64, 64)))
+        ff.add(np.ones((32, 32)))
+        self.assertEqual(ff.count, 1)
+        self.assertEqual(ff.shape, (32, 32))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Tests for the native TIFF reader in image_readers.
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import numpy as np
+
+from image_readers import read_tiff_plane, read_tiff_layout, UnsupportedTiffError
+
+
+def tiff_bytes(img, compression=1, bo='<'):
+    """a minimal single strip TIFF of a uint16 image, little endian unless bo is '>'"""
+    h, w = img.shape
+    data = img.astype(bo + 'u2').tostring()
+    entries = [(256, 3, w), (257, 3, h), (258, 3, 16), (259, 3, compression), (273, 4, 8), (277, 3, 1), (279, 4, len(data))]
+    out = (b'II' if bo == '<' else b'MM') + struct.pack(bo + 'HI', 42, 8 + len(data)) + data + struct.pack(bo + 'H', len(entries))
+    for tag, typ, value in entries:
+        if typ == 3:
+            out += struct.pack(bo + 'HHIHH', tag, typ, 1, value, 0)
+        else:
+            out += struct.pack(bo + 'HHII', tag, typ, 1, value)
+    return out + struct.pack(bo + 'I', 0)
+
+
+class NativeTiffReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "plane.ome.tif")
+        self.img = np.arange(12, dtype=np.uint16).reshape(3, 4) * 1000
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        f = open(self.filename, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_reads_plane(self):
+        self.write(tiff_bytes(self.img))
+        pixels, scale = read_tiff_plane(self.filename)
+        np.testing.assert_array_equal(pixels, self.img)
+        self.assertEqual(scale, 65535)
+        self.assertEqual(type(pixels), np.ndarray)
+        del pixels
+
+    def test_big_endian_is_native_order(self):
+        self.write(tiff_bytes(self.img, bo='>'))
+        pixels, scale = read_tiff_plane(self.filename)
+        np.testing.assert_array_equal(pixels, self.img)
+        self.assertTrue(pixels.dtype.isnative)
+        self.assertEqual(pixels.dtype, np.uint16)
+        del pixels
+
+    def test_compressed_is_unsupported(self):
+        self.write(tiff_bytes(self.img, compression=5))
+        self.assertRaises(UnsupportedTiffError, read_tiff_layout, self.filename)
+
+    def test_not_a_tiff(self):
+        self.write(b'\x89PNG\r\n\x1a\n' + b'\0' * 32)
+        self.assertRaises(UnsupportedTiffError, read_tiff_layout, self.filename)
+
+    def test_truncated_files_are_unsupported(self):
+        data = tiff_bytes(self.img)
+        for n in range(len(data)):
+            self.write(data[:n])
+            self.assertRaises(UnsupportedTiffError, read_tiff_layout, self.filename)
+
+    def test_corrupted_files_raise_only_unsupported(self):
+        data = tiff_bytes(self.img)
+        rs = np.random.RandomState(0)
+        for i in range(500):
+            corrupted = bytearray(data)
+            corrupted[rs.randint(len(data))] = rs.randint(256)
+            self.write(bytes(corrupted))
+            try:
+                read_tiff_layout(self.filename)
+            except UnsupportedTiffError:
+                pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Tests for image_registration.
+"""
+
+import unittest
+import numpy as np
+
+from image_registration import phase_correlation, downsample, DriftEstimator
+
+
+def texture(shape=(64, 64), seed=0):
+    return np.random.RandomState(seed).rand(*shape).astype(np.float32)
+
+
+class PhaseCorrelationTest(unittest.TestCase):
+    def test_shift_sign(self):
+        ref = texture()
+        for shift in [(0, 0), (3, -5), (-7, 2), (10, 10)]:
+            img = np.roll(np.roll(ref, -shift[0], axis=0), -shift[1], axis=1)
+            dy, dx, peak = phase_correlation(ref, img)
+            self.assertEqual((dy, dx), shift)
+            # ref[y, x] ~ img[y - dy, x - dx]
+            np.testing.assert_array_equal(np.roll(np.roll(img, dy, axis=0), dx, axis=1), ref)
+            self.assertTrue(peak > 0.9)
+
+    def test_unrelated_images_have_low_peak(self):
+        dy, dx, peak = phase_correlation(texture(seed=1), texture(seed=2))
+        self.assertTrue(peak < 0.2)
+
+    def test_shape_mismatch(self):
+        self.assertRaises(ValueError, phase_correlation, np.zeros((8, 8)), np.zeros((8, 9)))
+
+
+class DownsampleTest(unittest.TestCase):
+    def test_block_average(self):
+        img = np.arange(36, dtype=np.uint16).reshape(6, 6)
+        small = downsample(img, 3)
+        self.assertEqual(small.dtype, np.float32)
+        np.testing.assert_allclose(small, [[7, 10], [25, 28]])
+
+    def test_incomplete_blocks_are_dropped(self):
+        self.assertEqual(downsample(np.zeros((10, 7)), 4).shape, (2, 1))
+
+    def test_factor_one(self):
+        img = np.arange(6).reshape(2, 3)
+        np.testing.assert_array_equal(downsample(img, 1), img)
+
+
+class DriftEstimatorTest(unittest.TestCase):
+    def test_drift_between_time_points(self):
+        estimator = DriftEstimator(factor=4)
+        previous = texture((128, 128))
+        self.assertTrue(estimator.estimate("field", previous) is None)
+        # content moves by (8, -12) pixels
+        current = np.roll(np.roll(previous, 8, axis=0), -12, axis=1)
+        dy, dx, peak = estimator.estimate("field", current)
+        self.assertEqual((dy, dx), (8, -12))
+        self.assertTrue(peak > 0.5)
+        # the next estimate is relative to the current image
+        self.assertEqual(estimator.estimate("field", current)[:2], (0, 0))
+
+    def test_fields_are_independent(self):
+        estimator = DriftEstimator(factor=2)
+        estimator.estimate("a", texture(seed=1))
+        self.assertTrue(estimator.estimate("b", texture(seed=2)) is None)
+        self.assertEqual(estimator.estimate("a", texture(seed=1))[:2], (0, 0))
+
+    def test_cache_size(self):
+        estimator = DriftEstimator(factor=2, cache_size=2)
+        for key in "abc":
+            estimator.estimate(key, texture())
+        self.assertEqual(list(estimator.cache.keys()), ["b", "c"])
+        self.assertTrue(estimator.estimate("a", texture()) is None)
+
+    def test_size_change_restarts(self):
+        estimator = DriftEstimator(factor=2)
+        estimator.estimate("a", texture((32, 32)))
+        self.assertTrue(estimator.estimate("a", texture((64, 64))) is None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,356 @@
+"""
+Tests for lcc_daemon.
+"""
+
+import errno
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import cam_communicator_class as cc
+import lcc_daemon
+from checkpoint import Checkpoint
+from lcc_daemon import FeedbackLoopDaemon, CommandAnalysis, Metrics, STOPWAIT_END, STOPWAIT_NONE
+
+NAME = "image--L0000--S00--U01--V02--J07--E00--O00--X%02d--Y01--T0000--Z00--C00.ome.tif"
+
+ADD = "/cmd:add"
+DELETE = "/cmd:deletelist"
+START = "/cmd:startcamscan"
+STOPWAIT = "/cmd:stopwaitingforcam"
+
+
+class RecordingCAMcommunicator(cc.CAMcommunicator):
+    """records the commands instead of sending them to the CAM server"""
+    def __init__(self):
+        cc.CAMcommunicator.__init__(self)
+        self.basepath = "/data/"
+        self.verbose = False
+        self.sent = []
+
+    def sendCMDstring(self, cmdstr, seq_counter=False):
+        self.sent.append(cmdstr)
+
+    def commands(self):
+        """the /cmd: parts of the commands sent"""
+        return [cmd[cmd.index("/cmd:"):].split()[0] for cmd in self.sent]
+
+
+class FakeCAMcommunicator(RecordingCAMcommunicator):
+    """reports the images of script one by one. "reset" drops the connection, at the end of the script the daemon is stopped."""
+    def __init__(self, script):
+        RecordingCAMcommunicator.__init__(self)
+        self.script = list(script)
+        self.opened = 0
+        self.daemon = None
+
+    def open(self):
+        self.opened += 1
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+        return True
+
+    def waitforimage(self, jobnr=None, jobname=None, ignoreduplicates=True, timeout=None, stopcallback=None,
+                     processGUIEvents=None, stopOnScanFinished=False):
+        if not self.script:
+            self.daemon.stop()
+            return None
+        step = self.script.pop(0)
+        if step == "reset":
+            self.connected = False
+            return None
+        return self.basepath + step, self.parseLeicaFilename(step)
+
+
+def field(camc, filename):
+    index = lcc_daemon.FieldIndex()
+    index.add(camc.basepath + filename, camc.parseLeicaFilename(filename))
+    return index.popReady()
+
+
+class CompleteJobTest(unittest.TestCase):
+    def setUp(self):
+        self.camc = RecordingCAMcommunicator()
+        self.daemon = FeedbackLoopDaemon(self.camc, None, camjob="hires")
+        self.md = self.camc.parseLeicaFilename(NAME % 3)
+
+    def test_position_fromfield(self):
+        job = self.daemon.complete_job(dict(dxpos="12.5", dypos=-3), self.md)
+        self.assertEqual(job, dict(jobname="hires", dxpos=12.5, dypos=-3.0, slide=1, wellx=2, welly=3, fieldx=4, fieldy=2))
+
+    def test_given_values_kept(self):
+        job = self.daemon.complete_job(dict(dxpos=0, dypos=0, jobname="other", fieldx=9), self.md)
+        self.assertEqual((job['jobname'], job['fieldx'], job['fieldy']), ("other", 9, 2))
+
+    def test_invalid_jobs(self):
+        self.assertRaises(KeyError, self.daemon.complete_job, dict(dxpos=1), self.md)
+        self.assertRaises(ValueError, self.daemon.complete_job, dict(dxpos="left", dypos=1), self.md)
+        self.assertRaises(TypeError, self.daemon.complete_job, dict(dxpos=None, dypos=1), self.md)
+
+
+class CommandAnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, "analysis.py")
+        f = open(self.script, "w")
+        f.write("import sys\n"
+                "print 'found %d files' % len(sys.argv[1:])\n"
+                "print 'dxpos=%d dypos=-2 jobname=hires' % len(sys.argv[1:])\n"
+                "print 'dxpos=5'\n"
+                "print 'dypos=1 dxpos=%s' % sys.argv[-1]\n"
+                "sys.exit(len(sys.argv) > 3)\n")
+        f.close()
+        self.camc = RecordingCAMcommunicator()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def command(self, args):
+        return CommandAnalysis('"%s" "%s" %s' % (sys.executable, self.script, args))
+
+    def test_jobs_parsed(self):
+        jobs = self.command("{filename}")("a.tif", {}, None)
+        self.assertEqual(jobs, [dict(dxpos="1", dypos="-2", jobname="hires"), dict(dxpos="a.tif", dypos="1")])
+
+    def test_files_offield(self):
+        f = field(self.camc, NAME % 0)
+        jobs = self.command("x{filename}x {files}")(f.filename, f.metadata, f)
+        self.assertEqual(jobs[0]['dxpos'], "2")
+        self.assertEqual(jobs[1]['dxpos'], f.filename)
+
+    def test_failing_command(self):
+        self.assertRaises(Exception, self.command("a b c"), "a.tif", {}, None)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "metrics.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_counters_and_timings(self):
+        metrics = Metrics()
+        metrics.count('fields')
+        metrics.count('jobs', 3)
+        metrics.count('custom')
+        metrics.time('analysis', 1.0)
+        metrics.time('analysis', 3.0)
+        d = metrics.snapshot()
+        self.assertEqual((d['fields'], d['jobs'], d['custom'], d['images']), (1, 3, 1, 0))
+        self.assertEqual((d['analysis_mean'], d['analysis_max']), (2.0, 3.0))
+        self.assertTrue(d['uptime'] >= 0)
+
+    def test_report_interval(self):
+        metrics = Metrics(self.filename, interval=3600)
+        metrics.report()
+        self.assertFalse(os.path.exists(self.filename))
+        metrics.count('fields')
+        metrics.report(force=True)
+        self.assertEqual(json.load(open(self.filename))['fields'], 1)
+        metrics.count('fields')
+        metrics.report(force=True)
+        self.assertEqual(json.load(open(self.filename))['fields'], 2)
+        self.assertFalse(os.path.exists(self.filename + ".tmp"))
+
+
+class ProcessFieldTest(unittest.TestCase):
+    def setUp(self):
+        self.camc = RecordingCAMcommunicator()
+        self.analysed = []
+        self.jobs = [dict(dxpos=1, dypos=2), dict(dxpos="bad", dypos=0), dict(dxpos=3, dypos=4, jobname="other")]
+
+    def analysis(self, filename, metadata, field):
+        self.analysed.append(filename)
+        if self.jobs is None:
+            raise RuntimeError("analysis failed")
+        return self.jobs
+
+    def daemon(self, **kwargs):
+        return FeedbackLoopDaemon(self.camc, self.analysis, camjob="hires", **kwargs)
+
+    def test_jobs_sent(self):
+        daemon = self.daemon()
+        daemon.process_field(field(self.camc, NAME % 0))
+        self.assertEqual(self.camc.commands(), [DELETE, ADD, ADD, START, STOPWAIT])
+        self.assertTrue("/exp:hires" in self.camc.sent[1] and "/exp:other" in self.camc.sent[2])
+        d = daemon.metrics.snapshot()
+        self.assertEqual((d['fields'], d['jobs'], d['camlists'], d['analysis_errors']), (1, 2, 1, 1))
+
+    def test_failed_analysis(self):
+        self.jobs = None
+        daemon = self.daemon()
+        daemon.process_field(field(self.camc, NAME % 0))
+        # no CAM list, but the microscope doesn't wait for it
+        self.assertEqual(self.camc.commands(), [STOPWAIT])
+        self.assertEqual(daemon.metrics.snapshot()['analysis_errors'], 1)
+        self.assertTrue(daemon.processed_fields.contains(daemon.fieldKey(field(self.camc, NAME % 0).metadata), (0, 0)))
+
+    def test_processed_field_skipped(self):
+        daemon = self.daemon()
+        daemon.process_field(field(self.camc, NAME % 0))
+        self.camc.sent = []
+        daemon.process_field(field(self.camc, NAME % 0))
+        self.assertEqual(len(self.analysed), 1)
+        self.assertEqual(self.camc.commands(), [STOPWAIT])
+        self.assertEqual(daemon.metrics.snapshot()['fields_skipped'], 1)
+        daemon.process_field(field(self.camc, NAME % 1))
+        self.assertEqual(len(self.analysed), 2)
+
+    def test_field_key_relative_to_basepath(self):
+        daemon = self.daemon()
+        self.assertFalse(daemon.fieldKey(field(self.camc, NAME % 0).metadata).startswith("/data/"))
+
+    def test_stopwait_none(self):
+        self.jobs = []
+        self.daemon(stopwait=STOPWAIT_NONE).process_field(field(self.camc, NAME % 0))
+        self.assertEqual(self.camc.commands(), [DELETE, START])
+
+
+class RunTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.analysed = []
+        self.reconnect_interval = lcc_daemon.RECONNECT_INTERVAL
+        lcc_daemon.RECONNECT_INTERVAL = 0.05
+
+    def tearDown(self):
+        lcc_daemon.RECONNECT_INTERVAL = self.reconnect_interval
+        shutil.rmtree(self.tmpdir)
+
+    def analysis(self, filename, metadata, field):
+        self.analysed.append(os.path.basename(filename))
+        return []
+
+    def run_daemon(self, camc, **kwargs):
+        daemon = FeedbackLoopDaemon(camc, self.analysis, **kwargs)
+        camc.daemon = daemon
+        daemon.run()
+        return daemon
+
+    def test_checkpoint(self):
+        checkpoint = os.path.join(self.tmpdir, "export.lcc_checkpoint")
+        self.run_daemon(FakeCAMcommunicator([NAME % 0, NAME % 1]), checkpoint=Checkpoint(checkpoint))
+        self.assertEqual(self.analysed, [NAME % 0, NAME % 1])
+        # a restarted daemon only analyses the new field
+        camc = FakeCAMcommunicator([NAME % 0, NAME % 1, NAME % 2])
+        daemon = self.run_daemon(camc, checkpoint=Checkpoint(checkpoint), stopwait=STOPWAIT_END)
+        self.assertEqual(self.analysed, [NAME % 0, NAME % 1, NAME % 2])
+        self.assertEqual(daemon.metrics.snapshot()['fields_skipped'], 2)
+        # only once, at the end
+        self.assertEqual(camc.commands(), [DELETE, START, STOPWAIT])
+        self.assertFalse(camc.isConnected())
+
+    def test_reconnect(self):
+        camc = FakeCAMcommunicator([NAME % 0, "reset", NAME % 1])
+        daemon = self.run_daemon(camc)
+        self.assertEqual(self.analysed, [NAME % 0, NAME % 1])
+        self.assertEqual(camc.opened, 2)
+        self.assertEqual(daemon.metrics.snapshot()['reconnects'], 1)
+
+
+class ResetSocket:
+    """a socket that keeps failing once it was reset, instead of reporting the end of the connection"""
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = False
+
+    def recv(self, bufsize):
+        if self.received:
+            raise socket.error(errno.ECONNRESET, "Connection reset by peer")
+        self.received = True
+        return self.sock.recv(bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class ResetCAMcommunicator(RecordingCAMcommunicator):
+    """the first connection keeps failing once it was reset"""
+    def open(self):
+        first = self.leicasocket is None
+        opened = RecordingCAMcommunicator.open(self)
+        if opened and first:
+            self.leicasocket = ResetSocket(self.leicasocket)
+        return opened
+
+
+class FakeCAMServer:
+    """a CAM server on localhost that reports one image per connection and resets the connection after the first"""
+    def __init__(self, filenames):
+        self.filenames = filenames
+        self.listener = socket.socket()
+        self.listener.bind(("localhost", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        for i, filename in enumerate(self.filenames):
+            try:
+                conn = self.listener.accept()[0]
+            except socket.error:
+                return
+            self.connections.append(conn)
+            conn.sendall("/cli:EMBL /app:matrix /relpath:" + filename + "\r\n")
+            if i == 0:
+                time.sleep(0.3)
+                # close with a TCP reset
+                conn.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                conn.close()
+
+    def close(self):
+        self.listener.close()
+        for conn in self.connections:
+            conn.close()
+
+
+class ServerConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeCAMServer([NAME % 0, NAME % 1])
+        self.reconnect_interval = lcc_daemon.RECONNECT_INTERVAL
+        lcc_daemon.RECONNECT_INTERVAL = 0.05
+        self.analysed = []
+
+    def tearDown(self):
+        lcc_daemon.RECONNECT_INTERVAL = self.reconnect_interval
+        self.server.close()
+
+    def test_reconnect_after_connection_reset(self):
+        camc = ResetCAMcommunicator()
+        camc.setIP("localhost")
+        camc.port = self.server.port
+        camc.poll_interval = 0.05
+        def analysis(filename, metadata, field):
+            self.analysed.append(os.path.basename(filename))
+            if len(self.analysed) == 2:
+                daemon.stop()
+            return []
+        daemon = FeedbackLoopDaemon(camc, analysis, jobnr=7)
+        # only ends the test if the daemon doesn't reconnect
+        timer = threading.Timer(10, daemon.stop)
+        timer.start()
+        try:
+            daemon.run()
+        finally:
+            timer.cancel()
+        self.assertEqual(self.analysed, [NAME % 0, NAME % 1])
+        self.assertEqual(daemon.metrics.snapshot()['reconnects'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""
+Tests for mosaic.
+"""
+
+import os
+import unittest
+import numpy as np
+
+import mosaic
+from mosaic import WellMosaic, set_current_mosaic, get_current_mosaic
+
+
+def scene(shape=(200, 300), seed=0):
+    rs = np.random.RandomState(seed)
+    return rs.rand(*shape).astype(np.float32)
+
+
+class WellMosaicTest(unittest.TestCase):
+    def setUp(self):
+        self.mosaics = []
+
+    def tearDown(self):
+        for m in self.mosaics:
+            m.close()
+
+    def mosaic(self, *args, **kwargs):
+        m = WellMosaic(*args, **kwargs)
+        self.mosaics.append(m)
+        return m
+
+    def test_nominal_placement(self):
+        m = self.mosaic("well", 3, 2, (40, 50), np.float32, overlap=0.2, max_shift=5)
+        self.assertEqual((m.step_y, m.step_x), (32, 40))
+        self.assertEqual(m.image().shape, (32 + 40 + 10, 2 * 40 + 50 + 10))
+        s = scene()
+        for fy in range(2):
+            for fx in range(3):
+                self.assertFalse(m.isComplete())
+                y0, x0 = m.add(fx, fy, s[fy * 32:fy * 32 + 40, fx * 40:fx * 40 + 50])
+                self.assertEqual((y0, x0), (5 + fy * 32, 5 + fx * 40))
+        self.assertTrue(m.isComplete())
+        # the canvas shows the scene, surrounded by the empty margin
+        np.testing.assert_array_equal(m.image()[5:5 + 72, 5:5 + 130], s[:72, :130])
+        self.assertEqual(m.image()[:5].max(), 0)
+        self.assertEqual(type(m.image()), np.ndarray)
+
+    def test_wrong_shape(self):
+        m = self.mosaic("well", 2, 1, (40, 50), np.float32)
+        self.assertRaises(ValueError, m.add, 0, 0, np.zeros((50, 40), np.float32))
+
+    def test_refinement_with_known_shift(self):
+        s = scene()
+        m = self.mosaic("well", 2, 2, (64, 64), np.float32, overlap=0.25, refine=True, max_shift=6)
+        step = m.step_x
+        self.assertEqual(step, 48)
+        # field (1, 0) was acquired 3 pixels further right and 2 pixels higher than nominal,
+        # field (0, 1) 4 pixels lower and 1 pixel to the left of its upper neighbour (0, 0)
+        origin = 10
+        m.add(0, 0, s[origin:origin + 64, origin:origin + 64])
+        y0, x0 = m.add(1, 0, s[origin - 2:origin - 2 + 64, origin + step + 3:origin + step + 3 + 64])
+        self.assertEqual(m.shifts[(1, 0)], (-2, 3))
+        self.assertEqual((y0, x0), (6 - 2, 6 + step + 3))
+        y0, x0 = m.add(0, 1, s[origin + step + 4:origin + step + 4 + 64, origin - 1:origin - 1 + 64])
+        self.assertEqual(m.shifts[(0, 1)], (4, -1))
+        self.assertEqual((y0, x0), (6 + step + 4, 6 - 1))
+        # registered against its left neighbour (0, 1), relative to where that one actually went
+        y0, x0 = m.add(1, 1, s[origin + step - 2:origin + step - 2 + 64, origin + step + 3:origin + step + 3 + 64])
+        self.assertEqual(m.shifts[(1, 1)], (-6, 4))
+        self.assertEqual((y0, x0), (6 + step - 2, 6 + step + 3))
+        # the canvas is the scene, shifted by the margin and origin
+        canvas = m.image()
+        np.testing.assert_array_equal(canvas[6 + step + 4:6 + step + 4 + 64, 6 - 1:6 - 1 + 64],
+                                      s[origin + step + 4:origin + step + 4 + 64, origin - 1:origin - 1 + 64])
+
+    def test_failed_registration_uses_nominal_position(self):
+        m = self.mosaic("well", 2, 1, (64, 64), np.float32, overlap=0.25, refine=True, max_shift=2)
+        s = scene()
+        m.add(0, 0, s[:64, :64])
+        # shifted further than max_shift
+        y0, x0 = m.add(1, 0, s[:64, 48 + 10:48 + 10 + 64])
+        self.assertEqual((y0, x0), m.nominalPosition(1, 0))
+        self.assertEqual(m.shifts[(1, 0)], (0, 0))
+
+    def test_field_at(self):
+        m = self.mosaic("well", 2, 1, (40, 50), np.float32, overlap=0.2, max_shift=5)
+        m.add(0, 0, np.zeros((40, 50), np.float32))
+        self.assertEqual(m.fieldAt(5 + 10, 5 + 20), (0, 0, 10, 20))
+        # the second field isn't placed yet
+        self.assertEqual(m.fieldAt(5 + 52, 5 + 20), None)
+        m.add(1, 0, np.zeros((40, 50), np.float32))
+        self.assertEqual(m.fieldAt(5 + 52, 5 + 20), (1, 0, 12, 20))
+        # the overlap (x 40..49 on the scene) goes to the field whose centre is closer
+        self.assertEqual(m.fieldAt(5 + 42, 5 + 20)[:2], (0, 0))
+        self.assertEqual(m.fieldAt(5 + 48, 5 + 20)[:2], (1, 0))
+        # the margin belongs to no field
+        self.assertEqual(m.fieldAt(2, 2), None)
+        self.assertEqual(m.fieldAt(5 + 10, 5 + 40), None)
+
+    def test_close_deletes_canvas(self):
+        m = WellMosaic("well", 1, 1, (10, 10), np.uint16)
+        filename = m.filename
+        self.assertTrue(os.path.exists(filename))
+        set_current_mosaic(m)
+        self.assertTrue(get_current_mosaic() is m)
+        set_current_mosaic(None)
+        self.assertEqual(get_current_mosaic(), None)
+        self.assertFalse(os.path.exists(filename))
+        self.assertFalse(filename in mosaic.undeleted_files)
+        m.close() # closing twice is harmless
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+Tests for stack_projection. Like all tests in this folder they only need numpy,
+run them from the repository root with Python 2:
+
+    python -m unittest discover tests
+"""
+
+import unittest
+import numpy as np
+
+from stack_projection import StackProjector, PROJ_MEAN, PROJ_MAX, PROJ_MIN, PROJ_SUM, PROJ_STD
+from stack_projection import BestFocusSelector, FOCUS_METRICS, FOCUS_NORMALIZED_VARIANCE
+
+
+def random_stack(nz=7, shape=(5, 6), seed=0):
+    return np.random.RandomState(seed).randint(0, 4096, (nz,) + shape).astype(np.uint16)
+
+
+class StackProjectorTest(unittest.TestCase):
+    def project(self, projection, stack, dtype=np.float32):
+        proj = StackProjector(projection, dtype)
+        for plane in stack:
+            proj.add(plane)
+        return proj.result()
+
+    def test_projections_match_numpy(self):
+        stack = random_stack()
+        expected = {PROJ_MEAN: stack.mean(axis=0),
+                    PROJ_MAX: stack.max(axis=0),
+                    PROJ_MIN: stack.min(axis=0),
+                    PROJ_SUM: stack.sum(axis=0),
+                    PROJ_STD: stack.std(axis=0)}
+        for projection, reference in expected.items():
+            result = self.project(projection, stack)
+            self.assertEqual(result.dtype, np.float32)
+            np.testing.assert_allclose(result, reference, rtol=1e-4, atol=1e-2)
+
+    def test_std_is_stable_with_large_offset(self):
+        # Welford's update doesn't lose the small variance on top of a large mean in float32
+        stack = random_stack() % 8 + 60000
+        result = self.project(PROJ_STD, stack)
+        np.testing.assert_allclose(result, stack.std(axis=0), atol=1e-2)
+
+    def test_single_slice(self):
+        stack = random_stack(nz=1)
+        np.testing.assert_array_equal(self.project(PROJ_STD, stack), np.zeros(stack.shape[1:]))
+        np.testing.assert_array_equal(self.project(PROJ_MEAN, stack), stack[0])
+
+    def test_no_slice(self):
+        self.assertTrue(StackProjector(PROJ_MAX).result() is None)
+
+    def test_native_dtype(self):
+        stack = random_stack()
+        result = self.project(PROJ_MAX, stack, dtype=None)
+        self.assertEqual(result.dtype, np.uint16)
+        np.testing.assert_array_equal(result, stack.max(axis=0))
+
+    def test_result_not_overwritten_by_next_stack(self):
+        proj = StackProjector(PROJ_SUM)
+        first = random_stack(seed=1)
+        for plane in first:
+            proj.add(plane)
+        result = proj.result()
+        kept = result.copy()
+        for plane in random_stack(seed=2):
+            proj.add(plane)
+        second = proj.result()
+        np.testing.assert_array_equal(result, kept)
+        self.assertFalse(second is result)
+
+    def test_shape_mismatch(self):
+        proj = StackProjector(PROJ_MEAN)
+        proj.add(np.zeros((4, 4)))
+        self.assertRaises(ValueError, proj.add, np.zeros((4, 5)))
+
+    def test_unknown_projection(self):
+        self.assertRaises(ValueError, StackProjector, "median")
+
+
+def blurred(img, passes):
+    """img smoothed with passes of a 3 x 3 box filter"""
+    img = img.astype(np.float64)
+    for i in range(passes):
+        padded = np.pad(img, 1, mode='edge')
+        img = sum(padded[dy:dy+img.shape[0], dx:dx+img.shape[1]] for dy in range(3) for dx in range(3)) / 9.0
+    return img
+
+
+class BestFocusSelectorTest(unittest.TestCase):
+    def test_picks_sharpest_slice(self):
+        sharp = np.random.RandomState(3).randint(0, 1000, (32, 32)) + 100
+        # slice 2 is in focus, the others are increasingly blurred
+        stack = [blurred(sharp, abs(z - 2) * 2) for z in range(6)]
+        for metric in FOCUS_METRICS:
+            selector = BestFocusSelector(metric)
+            for plane in stack:
+                selector.add(plane)
+            best, z, score = selector.result()
+            self.assertEqual(z, 2, metric)
+            self.assertTrue(best is stack[2])
+
+    def test_explicit_z(self):
+        selector = BestFocusSelector()
+        selector.add(np.ones((4, 4)), z=5)
+        selector.add(np.arange(16.0).reshape(4, 4) + 1, z=9)
+        self.assertEqual(selector.result()[1], 9)
+
+    def test_small_slices(self):
+        # too small for the gradient metrics, scored with the normalized variance instead
+        for metric in FOCUS_METRICS:
+            selector = BestFocusSelector(metric)
+            for shape in [(1, 1), (2, 2), (1, 5), (5, 1), (0, 0)]:
+                img = np.arange(np.prod(shape), dtype=np.float64).reshape(shape) + 1
+                score = selector.score(img)
+                self.assertTrue(np.isfinite(score), (metric, shape))
+                if shape in [(1, 1), (2, 2), (5, 1)]:
+                    self.assertAlmostEqual(score, BestFocusSelector(FOCUS_NORMALIZED_VARIANCE).score(img))
+
+    def test_unknown_metric(self):
+        self.assertRaises(ValueError, BestFocusSelector, "entropy")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Tests for stage_calibration.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from stage_calibration import legacy_affine, fit_affine, apply_affine, apply_affine_points, field_limits, CalibrationStore
+
+
+def legacy_offsets(x, y, nx, ny, flipx, flipy, swapxy, offsetx, offsety):
+    """the offsets as LCCimageObject computed them before the transforms were introduced"""
+    if flipx:
+        x = (nx - 1) - x
+    if flipy:
+        y = (ny - 1) - y
+    if swapxy:
+        x, y = y, x
+    return float(x) - float(nx) / 2.0 + offsetx, float(y) - float(ny) / 2.0 + offsety
+
+
+class StageCalibrationTest(unittest.TestCase):
+    def test_legacy_affine(self):
+        rs = np.random.RandomState(0)
+        nx, ny = 512, 384
+        x = rs.rand(20) * nx
+        y = rs.rand(20) * ny
+        for flipx in (False, True):
+            for flipy in (False, True):
+                for swapxy in (False, True):
+                    matrix = legacy_affine(nx, ny, flipx, flipy, swapxy, 7, -3)
+                    u, v = apply_affine(matrix, x, y)
+                    for k in range(len(x)):
+                        expected = legacy_offsets(x[k], y[k], nx, ny, flipx, flipy, swapxy, 7, -3)
+                        self.assertAlmostEqual(u[k], expected[0])
+                        self.assertAlmostEqual(v[k], expected[1])
+
+    def test_fit_affine(self):
+        rs = np.random.RandomState(1)
+        angle = np.deg2rad(2.0)
+        matrix = np.array([[6.3 * np.cos(angle), -6.3 * np.sin(angle), -1600.0],
+                           [6.3 * np.sin(angle), 6.3 * np.cos(angle), -1200.0]])
+        src = rs.rand(10, 2) * 500
+        fitted, rms = fit_affine(src, apply_affine_points(matrix, src))
+        np.testing.assert_allclose(fitted, matrix, atol=1e-6)
+        self.assertTrue(rms < 1e-6)
+        noisy = apply_affine_points(matrix, src) + rs.randn(10, 2)
+        fitted, rms = fit_affine(src, noisy)
+        self.assertTrue(0 < rms < 2)
+
+    def test_fit_affine_errors(self):
+        self.assertRaises(ValueError, fit_affine, [[0, 0], [1, 1]], [[0, 0], [1, 1]])
+        self.assertRaises(ValueError, fit_affine, [[0, 0], [1, 1], [2, 2]], [[0, 0], [1, 1]])
+        self.assertRaises(ValueError, fit_affine, [[0, 0], [1, 1], [2, 2], [3, 3]], [[0, 0], [1, 0], [2, 0], [3, 0]])
+
+    def test_field_limits(self):
+        self.assertEqual(field_limits(legacy_affine(100, 50), 100, 50), ((-50.0, 49.0), (-25.0, 24.0)))
+        # the translation is applied
+        matrix = np.array([[2.0, 0.0, 100.0], [0.0, -3.0, -100.0]])
+        self.assertEqual(field_limits(matrix, 10, 10), ((100.0, 118.0), (-127.0, -100.0)))
+
+    def test_field_limits_swapped(self):
+        nx, ny = 100, 50
+        for flipx in (False, True):
+            matrix = legacy_affine(nx, ny, flipx=flipx, swapxy=True, offsetx=7, offsety=-3)
+            (umin, umax), (vmin, vmax) = field_limits(matrix, nx, ny)
+            # u comes from y, v from x
+            self.assertEqual((umin, umax), (7 - 50.0, 7 - 50.0 + 49))
+            self.assertEqual((vmin, vmax), (-3 - 25.0, -3 - 25.0 + 99))
+            # every pixel of the field is in range, points beyond its border are not
+            x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+            u, v = apply_affine(matrix, x.ravel(), y.ravel())
+            self.assertTrue((u >= umin).all() and (u <= umax).all() and (v >= vmin).all() and (v <= vmax).all())
+            u, v = apply_affine(matrix, [-1, nx, 0, 0], [0, 0, -1, ny])
+            outside = (u < umin) | (u > umax) | (v < vmin) | (v > vmax)
+            self.assertTrue(outside.all())
+
+    def test_store(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "calibration.json")
+            store = CalibrationStore(filename)
+            self.assertEqual(store.names(), [])
+            self.assertEqual(store.get("10x-63x"), None)
+            store.set("10x-63x", [1, 2, 3, 4, 5, 6])
+            store.set("5x-20x", legacy_affine(10, 10))
+            store.save()
+            store.save() # replaces the file
+            loaded = CalibrationStore(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(loaded.names(), ["10x-63x", "5x-20x"])
+        np.testing.assert_array_equal(loaded.get("10x-63x"), [[1, 2, 3], [4, 5, 6]])
+        np.testing.assert_array_equal(loaded.get("5x-20x"), legacy_affine(10, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()